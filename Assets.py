@@ -0,0 +1,363 @@
+"""
+Bundles the web UI's scripts and styles into one minified, content-hashed file each, with gzip and brotli copies
+made ahead of time, and builds the country catalog the holiday form searches. The page then loads in two requests
+that browsers cache for a year, and needs nothing from the internet.
+
+`python Assets.py` builds them into static/dist. The web server also builds them when it starts if they are
+missing or older than their sources, so this is only needed to build them ahead of a deploy.
+`python Assets.py --countries [source]` rebuilds the country catalog, from the ISO 3166 list in iso-codes or the
+CSV at COUNTRIES_CSV_URL.
+"""
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+    import rcssmin
+except ImportError:
+    rjsmin = rcssmin = None
+
+# The web UI ships with the code, so find it next to this file wherever the server is started from
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT_DIR, "static")
+# Built bundles, named after a hash of their contents, and the manifest naming them
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+# The countries the holiday form can search, as a {"alpha-2 code": "name"} dict
+COUNTRIES_FILE = os.path.join(ROOT_DIR, "data", "countries.json")
+ISO_CODES_FILE = "/usr/share/iso-codes/json/iso_3166-1.json"
+COUNTRIES_CSV_URL = "https://raw.githubusercontent.com/lukes/ISO-3166-Countries-with-Regional-Codes/master/all/all.csv"
+
+# The files in each bundle, in the order the page loads them
+BUNDLES = {
+    "app.js": ["vendor/jquery-3.6.1.min.js", "countdown.js", "contacts.js", "names.js", "countries.js",
+               "datetime.js", "script.js"],
+    "app.css": ["styles.css"],
+}
+
+MIMETYPES = {
+    ".js": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".json": "application/json",
+}
+
+# Content encodings to make copies in, most preferred first, with the suffix of their files
+ENCODINGS = (("br", ".br"), ("gzip", ".gz")) if brotli is not None else (("gzip", ".gz"),)
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def hashed_name(name, data):
+    """
+    Returns the name of a file with the hash of its contents before the extension, e.g. app.3f2a9c0d41b7.js.
+    """
+    base, extension = os.path.splitext(name)
+    return f"{base}.{content_hash(data)}{extension}"
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data)
+    # A fixed mtime, so the same file always compresses the same
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+# The characters a regular expression literal can follow. After anything else a / is division.
+_REGEX_FOLLOWS = set("(,=:[!&|?{};+-*%<>~^")
+
+
+def _space(output, newline):
+    # Whitespace and comments become a single space, or a line break if they had one in them
+    if not output or output[-1] == "\n":
+        return
+    if output[-1] == " ":
+        if newline:
+            output[-1] = "\n"
+        return
+    output.append("\n" if newline else " ")
+
+
+def minify_js(text):
+    """
+    Remove the comments, indentation and blank lines from a script. Line breaks are kept, so statements without
+    semicolons still end where they did. Uses rjsmin instead if it is installed.
+    """
+    if rjsmin is not None:
+        return rjsmin.jsmin(text)
+    output = []
+    # The last character of code, to tell a regular expression from a division
+    last = "("
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c in "\"'`":
+            j = i + 1
+            while j < len(text) and text[j] != c:
+                j += 2 if text[j] == "\\" else 1
+            output.append(text[i:j + 1])
+            last = c
+            i = j + 1
+        elif text.startswith("//", i):
+            j = text.find("\n", i)
+            i = len(text) if j == -1 else j
+        elif text.startswith("/*", i):
+            j = text.find("*/", i + 2)
+            j = len(text) if j == -1 else j + 2
+            _space(output, "\n" in text[i:j])
+            i = j
+        elif c == "/" and (last in _REGEX_FOLLOWS or re.search(r"\b(return|typeof)\s*$", "".join(output[-4:]))):
+            j = i + 1
+            in_class = False
+            while j < len(text) and text[j] != "\n" and (in_class or text[j] != "/"):
+                if text[j] == "\\":
+                    j += 1
+                elif text[j] in "[]":
+                    in_class = text[j] == "["
+                j += 1
+            j += 1
+            while j < len(text) and text[j].isalpha():
+                j += 1
+            output.append(text[i:j])
+            last = "/"
+            i = j
+        elif c.isspace():
+            j = i
+            while j < len(text) and text[j].isspace():
+                j += 1
+            _space(output, "\n" in text[i:j])
+            i = j
+        else:
+            output.append(c)
+            last = c
+            i += 1
+    return "".join(output).strip() + "\n"
+
+
+def minify_css(text):
+    """
+    Remove the comments and unneeded whitespace from a style sheet. Uses rcssmin instead if it is installed.
+    """
+    if rcssmin is not None:
+        return rcssmin.cssmin(text)
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}").strip() + "\n"
+
+
+def concatenate(names, static_dir=STATIC_DIR):
+    """
+    Concatenate and minify the files of a bundle. Files that are already minified are included as they are.
+    :return: The bundle as bytes.
+    """
+    parts = []
+    for name in names:
+        with open(os.path.join(static_dir, name), encoding="utf-8") as f:
+            text = f.read()
+        if not name.endswith((".min.js", ".min.css")):
+            text = minify_css(text) if name.endswith(".css") else minify_js(text)
+        parts.append(text)
+    # A semicolon between scripts, so one without a final semicolon can't run into the next
+    separator = "\n;\n" if names[0].endswith(".js") else "\n"
+    return separator.join(parts).encode("utf-8")
+
+
+def source_hashes(static_dir=STATIC_DIR, countries_file=COUNTRIES_FILE):
+    """
+    Returns the hash of every file the assets are built from, to tell when they need building again.
+    """
+    paths = {name: os.path.join(static_dir, name) for names in BUNDLES.values() for name in names}
+    paths["countries.json"] = countries_file
+    hashes = {}
+    for name, path in paths.items():
+        with open(path, "rb") as f:
+            hashes[name] = content_hash(f.read())
+    return hashes
+
+
+def _write(path, data):
+    # Write to a temporary file first, so a server starting at the same time never reads half a file
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(data)
+    os.replace(temporary_path, path)
+
+
+def build(static_dir=STATIC_DIR, dist_dir=None, countries_file=COUNTRIES_FILE):
+    """
+    Build the bundles and the country catalog into dist_dir, with a compressed copy of each, and a manifest
+    naming them.
+    :return: The manifest, as a dict.
+    """
+    dist_dir = dist_dir or os.path.join(static_dir, "dist")
+    os.makedirs(dist_dir, exist_ok=True)
+    contents = {name: concatenate(names, static_dir) for name, names in BUNDLES.items()}
+    with open(countries_file, encoding="utf-8") as f:
+        contents["countries.json"] = json.dumps(json.load(f), separators=(",", ":"),
+                                                ensure_ascii=False).encode("utf-8")
+
+    manifest = {"sources": source_hashes(static_dir, countries_file), "files": {}}
+    for name, data in contents.items():
+        file_name = hashed_name(name, data)
+        path = os.path.join(dist_dir, file_name)
+        if not os.path.exists(path):
+            _write(path, data)
+            for encoding, suffix in ENCODINGS:
+                _write(path + suffix, compress(data, encoding))
+        manifest["files"][name] = file_name
+
+    # Remove the files of earlier builds
+    built = {file_name + suffix for file_name in manifest["files"].values() for suffix in ("", ".gz", ".br")}
+    for file_name in os.listdir(dist_dir):
+        if file_name not in built and file_name != "manifest.json" and not file_name.endswith(".tmp"):
+            os.remove(os.path.join(dist_dir, file_name))
+    _write(os.path.join(dist_dir, "manifest.json"), json.dumps(manifest, indent=2).encode("utf-8"))
+    return manifest
+
+
+def build_country_catalog(source=None, output=COUNTRIES_FILE):
+    """
+    Build the country catalog from a list of ISO 3166 countries.
+    :param source: The iso_3166-1.json of iso-codes, or a path or URL of a CSV with "alpha-2" and "name" columns
+    like the one at COUNTRIES_CSV_URL. Defaults to iso-codes if it is installed, or else that CSV.
+    :return: The number of countries in the catalog.
+    """
+    source = source or (ISO_CODES_FILE if os.path.exists(ISO_CODES_FILE) else COUNTRIES_CSV_URL)
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source) as response:
+            text = response.read().decode("utf-8")
+    else:
+        with open(source, encoding="utf-8") as f:
+            text = f.read()
+
+    if source.endswith(".json"):
+        # Common names (e.g. "Bolivia" rather than "Bolivia, Plurinational State of") are easier to search for
+        countries = {country["alpha_2"]: country.get("common_name", country["name"])
+                     for country in json.loads(text)["3166-1"]}
+    else:
+        countries = {row["alpha-2"]: row["name"] for row in csv.DictReader(io.StringIO(text)) if row.get("alpha-2")}
+
+    countries = dict(sorted(countries.items(), key=lambda item: item[1]))
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(countries, f, indent=0, ensure_ascii=False)
+    return len(countries)
+
+
+class Asset:
+    """
+    A built file, held in memory with its compressed copies.
+
+    Attributes:
+    - name (str): The content-hashed name it is served under, e.g. app.3f2a9c0d41b7.js.
+    - mimetype (str): Its content type.
+    - etag (str): The hash of its contents.
+    - contents (dict): The file as bytes, by content encoding, with "identity" for the file itself.
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.mimetype = MIMETYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+        self.contents = {}
+        for encoding, suffix in (("identity", ""),) + ENCODINGS:
+            if os.path.exists(path + suffix):
+                with open(path + suffix, "rb") as f:
+                    self.contents[encoding] = f.read()
+        self.etag = content_hash(self.contents["identity"])
+
+    def encoded(self, accept_encodings):
+        """
+        Returns the smallest copy the client accepts, as (encoding, bytes).
+        :param accept_encodings: A function returning the quality the client gives an encoding.
+        """
+        for encoding, _ in ENCODINGS:
+            if encoding in self.contents and accept_encodings(encoding) > 0:
+                return encoding, self.contents[encoding]
+        return "identity", self.contents["identity"]
+
+
+class AssetBundle:
+    """
+    The built assets the web server serves, loaded from the manifest and built first if they are out of date.
+    """
+
+    def __init__(self, static_dir=STATIC_DIR, countries_file=COUNTRIES_FILE):
+        self.static_dir = static_dir
+        self.dist_dir = os.path.join(static_dir, "dist")
+        self.countries_file = countries_file
+        # Assets by the name they are served under, and the served names by the name in BUNDLES
+        self._assets = {}
+        self._names = {}
+        self._sources = None
+        self._lock = threading.Lock()
+
+    def load(self, check=False):
+        """
+        Load the assets, building them first if they are missing or out of date.
+        :param check: Check that the sources haven't changed even if the assets are already loaded, e.g. while
+        developing.
+        """
+        with self._lock:
+            if self._names and not check:
+                return
+            sources = source_hashes(self.static_dir, self.countries_file)
+            if self._names and sources == self._sources:
+                return
+            try:
+                with open(os.path.join(self.dist_dir, "manifest.json")) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = None
+            if manifest is None or manifest["sources"] != sources:
+                print("Building the web UI's assets...")
+                manifest = build(self.static_dir, self.dist_dir, self.countries_file)
+            self._assets = {file_name: Asset(file_name, os.path.join(self.dist_dir, file_name))
+                            for file_name in manifest["files"].values()}
+            self._names = dict(manifest["files"])
+            self._sources = sources
+
+    def url(self, name):
+        """
+        Returns the URL of an asset, e.g. url("app.js") is /assets/app.3f2a9c0d41b7.js.
+        """
+        self.load()
+        return "/assets/" + self._names[name]
+
+    def get(self, name):
+        """
+        Returns an asset by the name it is served under, or by its name in BUNDLES, or None.
+        """
+        self.load()
+        return self._assets.get(name) or self._assets.get(self._names.get(name))
+
+
+bundle = AssetBundle()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the web UI's bundles and country catalog.")
+    parser.add_argument("--countries", nargs="?", const="", metavar="SOURCE",
+                        help="rebuild the country catalog first, from iso-codes or a CSV path or URL")
+    args = parser.parse_args()
+
+    if args.countries is not None:
+        print("Built a catalog of", build_country_catalog(args.countries or None), "countries.")
+    for name, file_name in build()["files"].items():
+        path = os.path.join(DIST_DIR, file_name)
+        sizes = ", ".join(f"{suffix[1:]} {os.path.getsize(path + suffix)}" for _, suffix in ENCODINGS)
+        print(f"{name}: {file_name} ({os.path.getsize(path)} bytes, {sizes})")
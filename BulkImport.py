@@ -0,0 +1,126 @@
+import csv
+import datetime
+import io
+
+import Phone
+from Campaign import Campaign
+from Message import Message
+
+REPEAT_UNITS = ("n", "y", "m", "w", "d", "hol")
+
+# Columns accepted in a bulk upload. Only recipient, message, date and time are required.
+COLUMNS = ("recipient", "message", "date", "time", "repeat", "repeat_unit", "holiday", "country_code")
+
+
+def rows_from_json(data):
+    """
+    Returns the rows of a JSON bulk upload, which is either a list of row objects or an object with a "messages"
+    list.
+    """
+    if isinstance(data, dict):
+        data = data.get("messages")
+    if not isinstance(data, list):
+        raise ValueError('Expected a list of messages or an object with a "messages" list')
+    return data
+
+
+def rows_from_csv(text):
+    """
+    Returns the rows of a CSV bulk upload. The first line is a header naming the columns.
+    """
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def _clean(row, columns):
+    if not isinstance(row, dict):
+        raise ValueError("Expected an object")
+    return {column: ("" if row.get(column) is None else str(row.get(column)).strip()) for column in columns}
+
+
+def _validate_schedule(row):
+    """
+    Validate the scheduling columns of a row.
+    :return: A tuple of (hour, minute, date, repeat, repeat_unit, holiday) to pass to Message.
+    :raises ValueError: If any of them are invalid.
+    """
+    try:
+        datetime.date.fromisoformat(row["date"])
+    except ValueError:
+        raise ValueError(f"Invalid date '{row['date']}', expected YYYY-MM-DD")
+
+    # A message without a time has no time to be sent at, so it would never be sent
+    if not row["time"]:
+        raise ValueError("Missing time")
+    try:
+        parsed_time = datetime.time.fromisoformat(row["time"])
+    except ValueError:
+        raise ValueError(f"Invalid time '{row['time']}', expected HH:MM")
+    hour, minute = str(parsed_time.hour), f"{parsed_time.minute:02d}"
+
+    repeat_unit = row["repeat_unit"] or "n"
+    if repeat_unit not in REPEAT_UNITS:
+        raise ValueError(f"Invalid repeat_unit '{repeat_unit}', expected one of {', '.join(REPEAT_UNITS)}")
+
+    repeat = row["repeat"] or "0"
+    if not repeat.isdigit():
+        raise ValueError(f"Invalid repeat '{repeat}', expected a whole number")
+
+    holiday = None
+    if repeat_unit == "hol":
+        if not row["holiday"] or not row["country_code"]:
+            raise ValueError("Holiday messages need a holiday and a country_code")
+        holiday = f"{row['holiday']}___{row['country_code']}"
+
+    return hour, minute, row["date"], repeat, repeat_unit, holiday
+
+
+def _validate_row(row):
+    """
+    Returns a Message for a single row of a bulk upload.
+    :raises ValueError: If the row is invalid.
+    """
+    row = _clean(row, COLUMNS)
+    if not row["recipient"]:
+        raise ValueError("Missing recipient")
+    if not row["message"]:
+        raise ValueError("Missing message")
+    # National numbers are read as being from the row's country
+    recipient = Phone.normalise(row["recipient"], row["country_code"] or Phone.DEFAULT_COUNTRY)
+    return Message(recipient, row["message"], *_validate_schedule(row))
+
+
+def validate_campaign(data):
+    """
+    Returns a Campaign for a campaign request. It has a "template", a "recipients" list and/or a "group", and the
+    same scheduling fields as a bulk upload row.
+    :raises ValueError: If the request is invalid.
+    """
+    row = _clean(data, COLUMNS + ("template", "group"))
+    recipients = data.get("recipients") or []
+    if not isinstance(recipients, list):
+        raise ValueError("recipients should be a list of phone numbers")
+    recipients = [str(recipient).strip() for recipient in recipients if str(recipient).strip()]
+
+    if not row["template"]:
+        raise ValueError("Missing template")
+    if not recipients and not row["group"]:
+        raise ValueError("A campaign needs recipients or a group")
+    hour, minute, date, repeat, repeat_unit, holiday = _validate_schedule(row)
+    return Campaign(row["template"], recipients, row["group"], hour, minute, date, repeat, repeat_unit, holiday)
+
+
+def validate_rows(rows):
+    """
+    Validate every row of a bulk upload in one pass.
+    :param rows: A list of dicts keyed by the names in COLUMNS.
+    :return: A tuple of (a list of Messages for the valid rows, a list of {"row", "error"} dicts for the invalid
+    rows). Rows are numbered from 1.
+    """
+    messages = []
+    errors = []
+    for number, row in enumerate(rows, start=1):
+        try:
+            messages.append(_validate_row(row))
+        except ValueError as e:
+            errors.append({"row": number, "error": str(e)})
+    return messages, errors
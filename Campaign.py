@@ -0,0 +1,76 @@
+import Contacts
+import Phone
+from Message import Message
+
+
+class _Fields(dict):
+    """
+    Template fields that leave unknown placeholders empty instead of raising.
+    """
+
+    def __missing__(self, key):
+        return ""
+
+
+class Campaign(Message):
+    """
+    A message template sent to many recipients at once, scheduled like a single message.
+
+    The template can use placeholders such as {first_name}, filled from the recipient's row in the contacts
+    file (see Contacts.template_fields). A campaign is stored once however many recipients it has, and is only
+    expanded into individual messages, one at a time, when it is due.
+
+    Attributes (in addition to those of Message, where message holds the template):
+    - recipients (list): The phone numbers to send to.
+    - group (str): A contact group to send to, as well as or instead of the listed recipients.
+    """
+
+    __slots__ = ("recipients", "group")
+
+    def __init__(self, template, recipients=None, group=None, hour=None, minute=None, date=None, repeat=None,
+                 repeat_unit=None, holiday=None, anchor=None):
+        self.recipients = Phone.normalise_many(recipients or [])
+        self.group = group or None
+        super().__init__(self.describe_recipients(), template, hour, minute, date, repeat, repeat_unit, holiday,
+                         anchor=anchor)
+
+    def describe_recipients(self):
+        """
+        Returns a short description of who the campaign is sent to.
+        """
+        description = []
+        if self.group:
+            description.append(f"group:{self.group}")
+        if self.recipients:
+            description.append(f"{len(self.recipients)} recipients")
+        return ", ".join(description)
+
+    def expand(self, contacts_file=Contacts.CONTACTS_FILE):
+        """
+        Yields a Message for each recipient of the campaign, with the template filled in. The contacts file is
+        streamed, so only the campaign's own recipient list is held in memory.
+        """
+        remaining = set(self.recipients)
+        seen = set()
+        for contact in Contacts.read_contacts(contacts_file):
+            phone = Contacts.contact_phone(contact)
+            if phone is None or phone in seen:
+                continue
+            if phone in remaining or (self.group and self.group in Contacts.contact_groups(contact)):
+                seen.add(phone)
+                remaining.discard(phone)
+                yield self._message_for(phone, Contacts.template_fields(contact))
+
+        # Recipients that aren't in the contacts file only get the {phone} placeholder
+        for phone in self.recipients:
+            if phone in remaining:
+                remaining.discard(phone)
+                yield self._message_for(phone, {"phone": phone})
+
+    def _message_for(self, phone, fields):
+        try:
+            text = self.message.format_map(_Fields(fields))
+        except (ValueError, IndexError, AttributeError):
+            # Braces that aren't placeholders are sent as they are
+            text = self.message
+        return Message(phone, text, self.hour, self.minute, self.date, self.repeat, "n")
@@ -0,0 +1,80 @@
+"""
+The clock every scheduling decision reads: when messages are due, which are old, how full the rate limits are and
+how late sends are. It is the real clock unless a VirtualClock is swapped in with use(), e.g. by Simulation.py to
+replay a year of schedules in seconds.
+"""
+import datetime
+import time
+
+
+class Clock:
+    """
+    The real clock.
+    """
+
+    def time(self):
+        """
+        Returns the epoch time in seconds.
+        """
+        return time.time()
+
+    def monotonic(self):
+        """
+        Returns a time in seconds that never goes backwards, for measuring intervals.
+        """
+        return time.monotonic()
+
+    def now(self):
+        """
+        Returns the local date and time.
+        """
+        return datetime.datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """
+    A clock that only moves when it is told to, so time passes as fast as the code reading it can run.
+    """
+
+    def __init__(self, start=None):
+        """
+        :param start: The epoch time to start at. Defaults to the current time.
+        """
+        self._now = time.time() if start is None else start
+
+    def time(self):
+        return self._now
+
+    def monotonic(self):
+        return self._now
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self._now)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self._now += max(seconds, 0)
+
+    def advance_to(self, timestamp):
+        """
+        Move the clock on to an epoch time. A time in the past leaves it where it is.
+        """
+        self._now = max(self._now, timestamp)
+
+
+clock = Clock()
+
+
+def use(new_clock):
+    """
+    Make every scheduling decision read a different clock.
+    :return: The clock that was in use, to put back afterwards.
+    """
+    global clock
+    previous, clock = clock, new_clock
+    return previous
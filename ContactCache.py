@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import threading
+
+import Contacts
+import Metrics
+import Phone
+
+CACHE_FILE = os.path.join("data", "contacts.db")
+
+# The number of rows written to the cache at a time while ingesting, which bounds memory use
+INGEST_CHUNK = 1000
+
+# Changed whenever the way contacts are cached changes, so caches made before are ingested again
+CACHE_VERSION = 2
+
+
+class ContactCache:
+    """
+    A compact SQLite copy of the contacts and groups CSV files, holding just each contact's id, name, phone number
+    and groups.
+
+    A source file is only read again when its (mtime, size, inode) fingerprint changes, and then it is streamed a
+    chunk of rows at a time, so opening the cache costs the same however big the address book is. The source
+    files are never written to.
+
+    Each contact keeps the same id across ingests. Contacts are matched by their "ID" column if the file has one,
+    otherwise by phone number and name together, so people who share a number (e.g. a landline) are kept apart.
+    """
+
+    def __init__(self, path=CACHE_FILE, sources=(Contacts.CONTACTS_FILE, Contacts.GROUPS_FILE)):
+        """
+        :param path: The path of the cache database. It is created if it does not exist.
+        :param sources: The contact CSV files to ingest. They do not need to exist yet.
+        """
+        self.path = path
+        self.sources = sources
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS contacts ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT, contact_key TEXT, "
+                "name TEXT, phone TEXT, groups TEXT, generation INTEGER, UNIQUE (source, contact_key))"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS contacts_phone ON contacts (phone)")
+            # The fingerprint of each source file when it was last ingested
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, fingerprint TEXT, generation INTEGER)"
+            )
+
+    @staticmethod
+    def fingerprint(path):
+        """
+        Returns a string that changes whenever the file does, or CACHE_VERSION does, or None if it doesn't exist. The
+        file isn't read.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return f"{CACHE_VERSION}:{stat.st_mtime_ns}:{stat.st_size}:{stat.st_ino}"
+
+    def refresh(self):
+        """
+        Ingest the source files that have changed since they were last ingested.
+        :return: The number of source files that were ingested.
+        """
+        ingested = 0
+        for source in self.sources:
+            fingerprint = self.fingerprint(source)
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT fingerprint, generation FROM sources WHERE source = ?", (source,)
+                ).fetchone()
+            if row is not None and row[0] == fingerprint:
+                continue
+            self._ingest(source, fingerprint, (row[1] if row else 0) + 1)
+            ingested += 1
+        return ingested
+
+    @staticmethod
+    def _normalise(contact):
+        """
+        Returns a contact row as an (ID column, name, phone number as written, groups) tuple, or None if it has no
+        name or phone number.
+        """
+        contact = {column.strip(): (value or "").strip() for column, value in contact.items()
+                   if isinstance(column, str) and isinstance(value, str)}
+        name = f"{contact.get('First name', '')} {contact.get('Last name', '')}".strip()
+        phone = Contacts.raw_contact_phone(contact) or ""
+        if not name and not phone:
+            return None
+        return contact.get("ID", ""), name, phone, ";".join(sorted(Contacts.contact_groups(contact)))
+
+    def _ingest(self, source, fingerprint, generation):
+        """
+        Stream a source file into the cache, then drop the contacts that are no longer in it.
+        """
+        print("Ingesting contacts from", source)
+        rows = []
+        count = 0
+        with Metrics.file_io("contacts", "read", source):
+            for contact in Contacts.read_contacts(source):
+                row = self._normalise(contact)
+                if row is None:
+                    continue
+                rows.append(row)
+                if len(rows) >= INGEST_CHUNK:
+                    count += self._write(source, rows, generation)
+                    rows = []
+            count += self._write(source, rows, generation)
+
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM contacts WHERE source = ? AND generation < ?", (source, generation))
+            self._connection.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                                     (source, fingerprint, generation))
+        print("Ingested", count, "contacts.")
+
+    def _write(self, source, rows, generation):
+        if not rows:
+            return 0
+        # Normalise the chunk's phone numbers together, so numbers that repeat are only normalised once
+        phones = Phone.normalise_many(row[2] for row in rows)
+        # Phone numbers are in E.164 format, so the first | always ends the number
+        rows = [(source, id_column or f"{phone}|{name}", name, phone, groups, generation)
+                for (id_column, name, _, groups), phone in zip(rows, phones)]
+        with self._lock, self._connection:
+            # Existing contacts are updated in place so they keep their id
+            self._connection.executemany(
+                "INSERT INTO contacts (source, contact_key, name, phone, groups, generation) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (source, contact_key) DO UPDATE SET "
+                "name = excluded.name, phone = excluded.phone, groups = excluded.groups, "
+                "generation = excluded.generation",
+                rows
+            )
+        return len(rows)
+
+    def contacts(self):
+        """
+        Yields every cached contact as an (id, name, phone, groups) tuple, where groups is a set. The phone number is
+        normalised, or "" if the contact has none.
+        """
+        last_id = 0
+        while True:
+            # Read a chunk at a time so the cache can be written to in between
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id, name, phone, groups FROM contacts WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, INGEST_CHUNK)
+                ).fetchall()
+            if not rows:
+                return
+            for contact_id, name, phone, groups in rows:
+                yield contact_id, name, phone, set(groups.split(";")) if groups else set()
+            last_id = rows[-1][0]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
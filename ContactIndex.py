@@ -0,0 +1,174 @@
+import bisect
+import collections
+import heapq
+import itertools
+import math
+import re
+import threading
+
+import Phone
+from ContactCache import ContactCache
+from Watcher import FileWatcher
+
+# Rebuild the prefix array from scratch rather than inserting into it when more entries than this change at once
+BULK_REBUILD = 1000
+
+_WORD = re.compile(r"\w+")
+_PHONE = re.compile(r"[+\d\s\-./()]+")
+
+
+def _trigrams(text):
+    """
+    Returns the set of trigrams of each word in a piece of text, padded so the start of a word counts for more.
+    """
+    trigrams = set()
+    for word in _WORD.findall(text.lower()):
+        padded = f"  {word} "
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+class ContactIndex:
+    """
+    A search index over the names and phone numbers in the contacts and groups CSV files, built from the
+    ContactCache the first time it is used.
+
+    Names are matched by prefix with a sorted array of (token, key) pairs, where the tokens are each word of the
+    name, the whole name and the phone number. If a query has too few prefix matches, the rest are filled by
+    trigram similarity, so typos and partial words still find someone.
+
+    The index is built once, and when the files change only the contacts that were added or removed are
+    re-indexed. Contacts are keyed by (name, phone), so an edited contact is one removal and one addition.
+    """
+
+    def __init__(self, cache=None):
+        """
+        :param cache: The ContactCache to index. Defaults to one over the contacts and groups CSV files.
+        """
+        self.cache = cache or ContactCache()
+        self._entries = {}
+        self._prefixes = []
+        self._trigrams = collections.defaultdict(set)
+        # Contact names keyed by normalised phone number, for showing who a message is to
+        self._names = {}
+        self._lock = threading.Lock()
+        self._watcher = FileWatcher(self.cache.sources)
+        self._built = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _read(self):
+        """
+        Returns every contact with a name, as a {(name, phone): {"id", "name", "phone"}} dict.
+        """
+        self.cache.refresh()
+        entries = {}
+        for contact_id, name, phone, _ in self.cache.contacts():
+            if name:
+                entries[(name, phone)] = {"id": contact_id, "name": name, "phone": phone}
+        return entries
+
+    @staticmethod
+    def _tokens(key):
+        name, phone = key
+        tokens = {word for word in _WORD.findall(name.lower())}
+        tokens.add(name.lower())
+        if phone:
+            tokens.add(phone.lstrip("+"))
+        return tokens
+
+    def _update(self, entries):
+        """
+        Re-index the contacts that differ between the index and the given entries.
+        """
+        with self._lock:
+            removed = self._entries.keys() - entries.keys()
+            added = entries.keys() - self._entries.keys()
+            bulk = len(removed) + len(added) > BULK_REBUILD
+
+            for key in removed:
+                if key[1] and self._names.get(key[1]) == key[0]:
+                    del self._names[key[1]]
+                for trigram in _trigrams(key[0]):
+                    self._trigrams[trigram].discard(key)
+                if not bulk:
+                    for token in self._tokens(key):
+                        del self._prefixes[bisect.bisect_left(self._prefixes, (token, key))]
+            for key in added:
+                if key[1]:
+                    self._names[key[1]] = key[0]
+                for trigram in _trigrams(key[0]):
+                    self._trigrams[trigram].add(key)
+                if not bulk:
+                    for token in self._tokens(key):
+                        bisect.insort(self._prefixes, (token, key))
+
+            self._entries = entries
+            if bulk:
+                self._prefixes = sorted((token, key) for key in entries for token in self._tokens(key))
+            if removed or added:
+                print(f"Contact index: {len(added)} added, {len(removed)} removed, {len(entries)} contacts")
+
+    def refresh(self):
+        """
+        Build the index if it hasn't been yet, or re-index the files if they have changed since the last call.
+        """
+        if self._watcher.has_changed() or not self._built:
+            self._built = True
+            self._update(self._read())
+
+    def names(self, phones):
+        """
+        Look up the names of the contacts with the given phone numbers.
+        :param phones: An iterable of phone numbers, as written anywhere.
+        :return: A {phone: name} dict for the numbers that belong to a contact.
+        """
+        self.refresh()
+        with self._lock:
+            names = {}
+            for phone in phones:
+                name = self._names.get(Phone.normalise(phone))
+                if name is not None:
+                    names[phone] = name
+            return names
+
+    def search(self, query, limit=10):
+        """
+        Find the contacts whose name or phone number matches a query.
+        :param query: Part of a name or phone number.
+        :param limit: The maximum number of results.
+        :return: A list of {"id", "name", "phone"} dicts, prefix matches first, then the closest fuzzy matches.
+        """
+        self.refresh()
+        query = query.strip().lower()
+        if not query or limit <= 0:
+            return []
+        if _PHONE.fullmatch(query):
+            # Phone numbers are indexed in E.164 format without the leading +
+            query = Phone.normalise(query).lstrip("+")
+
+        with self._lock:
+            keys = []
+            seen = set()
+            # Start at the first token at or after the query, so a lookup costs a binary search plus the matches
+            for i in range(bisect.bisect_left(self._prefixes, (query,)), len(self._prefixes)):
+                token, key = self._prefixes[i]
+                if not token.startswith(query) or len(keys) >= limit:
+                    break
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+
+            query_trigrams = _trigrams(query)
+            if len(keys) < limit and len(query) >= 3 and query_trigrams:
+                # Only keep contacts sharing at least a third of the query's trigrams, best matches first
+                postings = [self._trigrams[trigram] for trigram in query_trigrams if trigram in self._trigrams]
+                needed = math.ceil(len(query_trigrams) / 3)
+                scores = collections.Counter(itertools.chain.from_iterable(postings))
+                fuzzy = heapq.nsmallest(limit - len(keys),
+                                        (key for key, score in scores.items() if score >= needed and key not in seen),
+                                        key=lambda key: (-scores[key], key))
+                keys.extend(fuzzy)
+
+            return [self._entries[key] for key in keys]
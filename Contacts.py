@@ -0,0 +1,64 @@
+import csv
+import os
+
+import Phone
+
+CONTACTS_FILE = os.path.join("static", "contacts.csv")
+GROUPS_FILE = os.path.join("static", "groups.csv")
+
+# Columns holding a contact's phone numbers, in order of preference
+PHONE_COLUMNS = ("Telephone (mobile)", "Telephone (home)", "Telephone (work)", "Telephone (main)")
+
+# Columns holding the groups a contact belongs to, as exported by common address books
+GROUP_COLUMNS = ("Group Membership", "Labels", "Categories")
+
+
+def read_contacts(contacts_file=CONTACTS_FILE):
+    """
+    Yields each contact in a contacts CSV file as a dict keyed by column name, one row at a time.
+    """
+    if not os.path.exists(contacts_file):
+        return
+    with open(contacts_file, 'r', newline='', encoding='utf-8') as f:
+        yield from csv.DictReader(f)
+
+
+def raw_contact_phone(contact):
+    """
+    Returns the preferred phone number of a contact as written in the file, or None if it has none.
+    """
+    for column in PHONE_COLUMNS:
+        if contact.get(column) and contact[column].strip():
+            return contact[column]
+    return None
+
+
+def contact_phone(contact):
+    """
+    Returns the preferred phone number of a contact in E.164 format, or None if it has none.
+    """
+    phone = raw_contact_phone(contact)
+    return Phone.normalise(phone) if phone is not None else None
+
+
+def contact_groups(contact):
+    """
+    Returns the set of groups a contact belongs to.
+    """
+    groups = set()
+    for column in GROUP_COLUMNS:
+        for group in (contact.get(column) or "").replace(" ::: ", ";").split(";"):
+            if group.strip():
+                groups.add(group.strip().lstrip("* "))
+    return groups
+
+
+def template_fields(contact):
+    """
+    Returns the placeholders a message template can use for a contact: every column, lower case with spaces
+    replaced by underscores (e.g. {first_name}), plus {name} and {phone}.
+    """
+    fields = {(column or "").strip().lower().replace(" ", "_"): (value or "") for column, value in contact.items()}
+    fields["name"] = f"{contact.get('First name') or ''} {contact.get('Last name') or ''}".strip()
+    fields["phone"] = contact_phone(contact) or ""
+    return fields
@@ -0,0 +1,345 @@
+"""
+An append-only record of every send: the attempt, logged before a message is handed to the transport, and its
+outcome after. Messages that were missed, or skipped because the log shows they were already sent, are recorded
+too. It is what lets a restarted sender tell what it sent before it stopped, so nothing is sent twice.
+
+The log is a directory of JSON lines segments. The newest is appended to, and once it is SEGMENT_BYTES long it is
+gzipped and a new one started. index.db indexes every record by recipient, time and delivery key, with where it is
+in the segments, so history queries and the duplicate checks before each send never scan the log.
+"""
+import glob
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import zlib
+
+import Clock
+import Metrics
+from Campaign import Campaign
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks (e.g. on Windows) only one process can write to a log
+    fcntl = None
+
+# The size at which a segment is compressed and a new one started
+SEGMENT_BYTES = 8 * 1024 * 1024
+
+# The events that show a message may have reached the recipient, so it mustn't be sent again
+DELIVERED = ("sent", "unconfirmed")
+
+RECORDS = Metrics.registry.counter("delivery_log_records_total", "Records written to the delivery log", ("event",))
+
+
+def delivery_key(message):
+    """
+    Returns what identifies one delivery of a message: a stored message at one of its due times, or for a message
+    without a row of its own (e.g. from a campaign) its recipient, due time and text.
+    """
+    fire_at = "" if message.fire_at is None else f"{message.fire_at:.0f}"
+    if isinstance(message, Campaign):
+        return f"campaign-{message.id}@{fire_at}"
+    if message.id is not None:
+        return f"{message.id}@{fire_at}"
+    return f"{message.recipient}@{fire_at}#{zlib.crc32((message.message or '').encode()):08x}"
+
+
+class DeliveryLog:
+    """
+    The delivery log of one message store, shared by every process sending from it. Appends and rotations hold
+    an exclusive lock on the directory's lock file, so records from several processes never interleave.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_segments=None, sync=True):
+        """
+        :param directory: The directory of the log. It is created if it does not exist.
+        :param segment_bytes: The size at which a segment is compressed and a new one started.
+        :param max_segments: The number of segments to keep. The oldest are deleted. Defaults to keeping them all.
+        :param sync: Flush attempts to disk before the message is sent, so a crash can't lose them.
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.sync_attempts = sync
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._lock_file = open(os.path.join(directory, "lock"), "a")
+        self._connection = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries ("
+                "segment INTEGER, offset INTEGER, at REAL, event TEXT, delivery_key TEXT, recipient TEXT, "
+                "PRIMARY KEY (segment, offset))"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS deliveries_recipient ON deliveries (recipient, at)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS deliveries_at ON deliveries (at)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS deliveries_key ON deliveries (delivery_key)")
+        # The segment being appended to, and its file
+        self._segment = None
+        self._file = None
+        with self._locked():
+            self._recover()
+
+    def _locked(self):
+        return _FileLock(self._lock, self._lock_file)
+
+    def _path(self, segment, compressed=False):
+        return os.path.join(self.directory, f"deliveries-{segment:06d}.jsonl" + (".gz" if compressed else ""))
+
+    def _segments(self, pattern):
+        return sorted(int(re.search(r"deliveries-(\d+)", path).group(1))
+                      for path in glob.glob(os.path.join(self.directory, pattern)))
+
+    def _recover(self):
+        """
+        Finish what a process that stopped part way through an append or a rotation left undone: index records
+        that were written but not indexed, and compress segments that are no longer the newest.
+        """
+        open_segments = self._segments("deliveries-*.jsonl")
+        for segment in open_segments:
+            self._index_unindexed(segment)
+        for segment in open_segments[:-1]:
+            self._compress(segment)
+        if open_segments:
+            self._open(open_segments[-1])
+        else:
+            self._open(max(self._segments("deliveries-*.jsonl.gz"), default=0) + 1)
+
+    def _index_unindexed(self, segment):
+        last = self._connection.execute("SELECT MAX(offset) FROM deliveries WHERE segment = ?",
+                                        (segment,)).fetchone()[0]
+        with open(self._path(segment), "rb") as f:
+            if last is not None:
+                f.seek(last)
+                f.readline()
+            rows = []
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    # Nothing, or half a record from a write that was cut short
+                    break
+                rows.append(self._index_row(segment, offset, json.loads(line)))
+        if rows:
+            print("Indexing", len(rows), "unindexed delivery records")
+            with self._connection:
+                self._connection.executemany("INSERT OR IGNORE INTO deliveries VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    @staticmethod
+    def _index_row(segment, offset, record):
+        return segment, offset, record["at"], record["event"], record.get("key"), record.get("recipient")
+
+    def _open(self, segment):
+        if self._file is not None:
+            self._file.close()
+        self._segment = segment
+        self._file = open(self._path(segment), "ab")
+
+    def _compress(self, segment):
+        path = self._path(segment)
+        compressed_path = self._path(segment, compressed=True)
+        with Metrics.file_io("deliveries", "write", compressed_path):
+            with open(path, "rb") as f, gzip.open(compressed_path + ".tmp", "wb") as compressed:
+                compressed.write(f.read())
+            os.replace(compressed_path + ".tmp", compressed_path)
+        os.remove(path)
+
+    def _rotate(self):
+        segment = self._segment
+        self._open(segment + 1)
+        self._compress(segment)
+        compressed = self._segments("deliveries-*.jsonl.gz")
+        if self.max_segments is not None and len(compressed) > self.max_segments:
+            expired = compressed[:len(compressed) - self.max_segments]
+            for old_segment in expired:
+                os.remove(self._path(old_segment, compressed=True))
+            with self._connection:
+                self._connection.executemany("DELETE FROM deliveries WHERE segment = ?",
+                                             [(old_segment,) for old_segment in expired])
+
+    def record(self, event, messages, error=None, owner=None, sync=False):
+        """
+        Append a record for each of some messages.
+        :param event: "attempt", "sent", "failed", "missed" or "skipped".
+        :param messages: The messages the records are about.
+        :param error: Why the messages failed to send.
+        :param owner: The name of the process writing the records.
+        :param sync: Wait until the records are on disk.
+        """
+        now = Clock.clock.time()
+        records = []
+        for message in messages:
+            record = {"at": now, "event": event, "key": delivery_key(message), "id": message.id,
+                      "recipient": message.recipient, "message": message.message, "fire_at": message.fire_at,
+                      "error": None if error is None else str(error), "owner": owner}
+            records.append({name: value for name, value in record.items() if value is not None})
+        if not records:
+            return
+        lines = [json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n" for record in records]
+
+        with self._locked():
+            # Another process may have started a new segment since this one last wrote
+            if os.fstat(self._file.fileno()).st_nlink == 0:
+                self._recover()
+            offset = os.fstat(self._file.fileno()).st_size
+            self._file.write(b"".join(lines))
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+            rows = []
+            for record, line in zip(records, lines):
+                rows.append(self._index_row(self._segment, offset, record))
+                offset += len(line)
+            with self._connection:
+                self._connection.executemany("INSERT OR IGNORE INTO deliveries VALUES (?, ?, ?, ?, ?, ?)", rows)
+            if offset >= self.segment_bytes:
+                self._rotate()
+        RECORDS.inc(len(records), event=event)
+
+    def attempting(self, batch, owner=None):
+        """
+        Yields the messages of a send queue batch for the transport to send, recording an attempt for the parts of
+        each just before it is sent.
+        :param batch: A list of (message, parts) tuples, as SendQueue.next_batch() returns.
+        """
+        for message, parts in batch:
+            self.record("attempt", parts, owner=owner, sync=self.sync_attempts)
+            yield message
+
+    def statuses(self, messages):
+        """
+        Returns the last event recorded for the delivery of each of some messages, as a {delivery key: event}
+        dict. An attempt without an outcome is "unconfirmed", as the message may or may not have been sent.
+        """
+        keys = list({delivery_key(message) for message in messages})
+        statuses = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT delivery_key, event FROM deliveries WHERE delivery_key IN ({', '.join('?' * len(chunk))}) "
+                    f"ORDER BY segment, offset", chunk
+                ).fetchall()
+            for key, event in rows:
+                if event == "attempt":
+                    statuses[key] = "unconfirmed"
+                elif event != "skipped":
+                    statuses[key] = event
+        return statuses
+
+    def delivered(self, messages, include_unconfirmed=True):
+        """
+        Returns the delivery keys of the messages that the log shows were sent, and unless include_unconfirmed is
+        False those that may have been.
+        """
+        delivered = DELIVERED if include_unconfirmed else ("sent",)
+        return {key for key, status in self.statuses(messages).items() if status in delivered}
+
+    def unsent(self, messages, include_unconfirmed=True, chunk_size=100):
+        """
+        Yields the messages of an iterable, e.g. an expanding campaign, that delivered() wouldn't return, reading
+        it a chunk at a time.
+        """
+        chunk = []
+        for message in messages:
+            chunk.append(message)
+            if len(chunk) >= chunk_size:
+                yield from self._unsent(chunk, include_unconfirmed)
+                chunk = []
+        yield from self._unsent(chunk, include_unconfirmed)
+
+    def _unsent(self, messages, include_unconfirmed):
+        delivered = self.delivered(messages, include_unconfirmed) if messages else set()
+        return [message for message in messages if delivery_key(message) not in delivered]
+
+    def history(self, recipient=None, since=None, until=None, event=None, limit=100):
+        """
+        Returns the records for a recipient and/or a period, newest first.
+        :param recipient: Only records for this recipient.
+        :param since: Only records from this epoch time.
+        :param until: Only records before this epoch time.
+        :param event: Only records of this event.
+        :param limit: The maximum number of records.
+        :return: The records as dicts.
+        """
+        conditions, params = [], []
+        for condition, value in (("recipient = ?", recipient), ("at >= ?", since), ("at < ?", until),
+                                 ("event = ?", event)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT segment, offset FROM deliveries {where} ORDER BY at DESC, segment DESC, offset DESC LIMIT ?",
+                params + [limit]
+            ).fetchall()
+
+        records = {}
+        by_segment = {}
+        for segment, offset in rows:
+            by_segment.setdefault(segment, []).append(offset)
+        for segment, offsets in by_segment.items():
+            for offset, record in zip(offsets, self._read(segment, offsets)):
+                records[segment, offset] = record
+        return [records[row] for row in rows if records.get(row) is not None]
+
+    def _read(self, segment, offsets):
+        """
+        Returns the records at some offsets of a segment, or None for any that have since been deleted.
+        """
+        path = self._path(segment)
+        try:
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    lines = []
+                    for offset in offsets:
+                        f.seek(offset)
+                        lines.append(f.readline())
+            else:
+                with gzip.open(self._path(segment, compressed=True), "rb") as f:
+                    data = f.read()
+                lines = [data[offset:data.find(b"\n", offset) + 1] for offset in offsets]
+        except FileNotFoundError:
+            return [None] * len(offsets)
+        return [json.loads(line) if line else None for line in lines]
+
+    def sync(self):
+        """
+        Wait until every record written so far is on disk.
+        """
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._connection.close()
+            self._lock_file.close()
+
+
+class _FileLock:
+    """
+    Holds a thread lock and an exclusive lock on a file, so one thread of one process uses the log at a time.
+    """
+
+    def __init__(self, lock, lock_file):
+        self._lock = lock
+        self._lock_file = lock_file
+
+    def __enter__(self):
+        self._lock.acquire()
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock.release()
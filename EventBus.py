@@ -0,0 +1,127 @@
+import asyncio
+import collections
+import itertools
+import secrets
+import threading
+
+# The number of recent events kept for subscribers that fall behind or reconnect
+HISTORY_SIZE = 1000
+
+
+class Event:
+    """
+    A change to the scheduled messages, e.g. messages being added or sent.
+
+    Attributes:
+    - seq (int): The position of the event in the bus's history, counting from 1.
+    - type (str): "added", "sent", "failed", "missed" (not sent within the send window), "rescheduled",
+    "removed", or "reset" when the messages have been reloaded and subscribers should start again.
+    - messages (tuple): The messages and campaigns the event is about, as they are after it.
+    - error (str): Why the messages failed to send, for "failed" events.
+    """
+
+    __slots__ = ("seq", "type", "messages", "error", "_encoded")
+
+    def __init__(self, seq, type, messages=(), error=None):
+        self.seq = seq
+        self.type = type
+        self.messages = tuple(messages)
+        self.error = error
+        self._encoded = None
+
+    def encode(self, encoder):
+        """
+        Returns encoder(self), which is only called the first time, so however many subscribers there are the
+        event is encoded once.
+        """
+        if self._encoded is None:
+            self._encoded = encoder(self)
+        return self._encoded
+
+
+class EventBus:
+    """
+    Publishes events from the sender thread to any number of subscribers.
+
+    Events are kept in a bounded history rather than copied to a queue per subscriber, so publishing costs the
+    same however many subscribers there are. Each subscriber remembers the seq of the last event it has seen and
+    asks for the events after it, with wait() from a thread or wait_async() from an event loop. A subscriber that
+    falls further behind than the history gets None, and should start again.
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE):
+        # Distinguishes this bus's seqs from those of a previous run, for subscribers that reconnect
+        self.id = secrets.token_hex(4)
+        self._events = collections.deque(maxlen=history_size)
+        self._seq = 0
+        self._condition = threading.Condition()
+        # Futures of the subscribers waiting on event loops, as (loop, future) tuples
+        self._async_waiters = set()
+
+    @property
+    def last_seq(self):
+        return self._seq
+
+    def publish(self, event_type, messages=(), error=None):
+        with self._condition:
+            self._seq += 1
+            self._events.append(Event(self._seq, event_type, messages, error))
+            self._condition.notify_all()
+            waiters, self._async_waiters = self._async_waiters, set()
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                # The subscriber's event loop has closed
+                pass
+
+    def since(self, seq):
+        """
+        Returns the events after seq, or None if some of them are no longer in the history.
+        """
+        with self._condition:
+            return self._since(seq)
+
+    def _since(self, seq):
+        if seq == self._seq:
+            return []
+        if seq > self._seq or not self._events or self._events[0].seq > seq + 1:
+            return None
+        return list(itertools.islice(self._events, seq + 1 - self._events[0].seq, None))
+
+    def wait(self, seq, timeout=None):
+        """
+        Wait until there are events after seq.
+        :param seq: The seq of the last event the subscriber has seen.
+        :param timeout: The maximum number of seconds to wait.
+        :return: The events after seq, which is empty if the timeout passed first, or None if the subscriber has
+        fallen too far behind.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._seq != seq, timeout)
+            return self._since(seq)
+
+    async def wait_async(self, seq, timeout=None):
+        """
+        The same as wait(), but waits on the running event loop rather than blocking a thread.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._condition:
+            if self._seq != seq:
+                return self._since(seq)
+            self._async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+        return self.since(seq)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,93 @@
+"""
+A local stand-in for a WhatsApp Business Cloud style messages API, for testing Transport.HttpTransport without
+sending real messages.
+
+Run it with `python FakeCloudApi.py [port] [latency in seconds]` and point data/cloud_api.json at it:
+    {"base_url": "http://localhost:8080", "token": "test", "phone_number_id": "1"}
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeCloudApi(ThreadingHTTPServer):
+    """
+    An HTTP server that accepts POST /{phone_number_id}/messages and records each message it receives.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0):
+        """
+        :param port: The port to listen on. 0 picks a free port, which is then available as self.port.
+        :param latency: The number of seconds to wait before answering each request.
+        """
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.received = []
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        """
+        Serve requests on a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def record(self, message):
+        with self._lock:
+            self.received.append(message)
+            return len(self.received)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests, as the real API does
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[1] != "messages":
+            return self._reply(404, {"error": {"message": "Unknown path"}})
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            return self._reply(401, {"error": {"message": "Missing bearer token"}})
+        try:
+            message = json.loads(body)
+            recipient = message["to"]
+            message["text"]["body"]
+        except (ValueError, KeyError, TypeError):
+            return self._reply(400, {"error": {"message": "Invalid message"}})
+
+        time.sleep(self.server.latency)
+        number = self.server.record(message)
+        self._reply(200, {
+            "messaging_product": "whatsapp",
+            "contacts": [{"input": recipient, "wa_id": recipient.lstrip("+")}],
+            "messages": [{"id": f"wamid.{number}"}],
+        })
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    server = FakeCloudApi(int(sys.argv[1]) if len(sys.argv) > 1 else 8080,
+                          float(sys.argv[2]) if len(sys.argv) > 2 else 0.0)
+    print("Fake Cloud API listening on", server.base_url)
+    server.serve_forever()
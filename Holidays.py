@@ -1,8 +1,245 @@
+import collections
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
+import Metrics
+
+API_KEY_FILE = os.path.join("data", "calendarific_api_key.dat")
+# Holidays already looked up, one {name: date} JSON file per country and year
+HOLIDAYS_DIR = os.path.join("data", "holidays")
+
+# Seconds to wait for Calendarific before giving up on a lookup
+FETCH_TIMEOUT = 10
+# Seconds before a country and year that couldn't be found is looked up again, in case the source was only down
+RETRY_SECONDS = 5 * 60
+
+FETCH_SECONDS = Metrics.registry.histogram("holiday_fetch_seconds", "Time spent looking up holidays from the source")
+
+
+class CalendarificSource:
+    """
+    Looks up holidays with the Calendarific API.
+    """
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.session = requests.Session()
+
+    def fetch(self, country_code, year):
+        """
+        Returns the holidays of a country in a year as a {name: "YYYY-MM-DD"} dict, or None if they can't be found,
+        including when Calendarific can't be reached.
+        """
+        url = f"https://calendarific.com/api/v2/holidays?&api_key={self.api_key}&country={country_code}&year={year}"
+        try:
+            response = self.session.get(url, timeout=FETCH_TIMEOUT)
+            if response.status_code != 200:
+                return None
+            return holidays_by_name(response.json())
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            print("Couldn't look up the holidays of", country_code, year, e)
+            return None
+
+
+class LocalSource:
+    """
+    A local stand-in for the Calendarific API, for running offline. It reads Calendarific responses saved as
+    {country code}_{year}.json in a directory, and never uses the network.
+    """
+
+    def __init__(self, directory="data"):
+        self.directory = directory
+
+    def fetch(self, country_code, year):
+        path = os.path.join(self.directory, f"{country_code}_{year}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return holidays_by_name(json.load(f))
+
+
+def holidays_by_name(response):
+    """
+    Converts a Calendarific response to a {name: "YYYY-MM-DD"} dict. If a name appears more than once, its first
+    date is kept.
+    """
+    holidays = {}
+    for holiday in response['response']['holidays']:
+        holidays.setdefault(holiday['name'], holiday['date']['iso'][:10])
+    return holidays
+
+
+class HolidayCatalog:
+    """
+    A process-wide catalog of holidays by country and year.
+
+    Lookups are served from an in-memory LRU cache, then from the on-disk store in data/holidays, and only then
+    from the source (Calendarific, or a LocalSource when offline). Each (country, year) that is found is fetched at
+    most once. Those that aren't are looked up again after RETRY_SECONDS.
+    """
+
+    def __init__(self, source=None, directory=HOLIDAYS_DIR, cache_size=256):
+        """
+        :param source: Where to look up holidays that aren't stored yet. Defaults to Calendarific if
+        data/calendarific_api_key.dat exists, otherwise a LocalSource (offline).
+        :param directory: The directory of the on-disk store.
+        :param cache_size: The number of (country, year) entries to keep in memory.
+        """
+        self._source = source
+        self.directory = directory
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        # (country, year) keys that couldn't be found, and the monotonic time to look them up again
+        self._not_found = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def source(self):
+        if self._source is None:
+            if os.path.exists(API_KEY_FILE):
+                with open(API_KEY_FILE, 'r') as f:
+                    self._source = CalendarificSource(f.read().strip())
+            else:
+                self._source = LocalSource()
+        return self._source
+
+    def _path(self, country_code, year):
+        return os.path.join(self.directory, f"{country_code}_{year}.json")
+
+    def get(self, country_code, year):
+        """
+        Returns the holidays of a country in a year as a {name: "YYYY-MM-DD"} dict, or None if they can't be found.
+        """
+        if not country_code or len(country_code) != 2:
+            return None
+        key = (country_code.upper(), int(year))
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            if self._not_found.get(key, 0) > time.monotonic():
+                self.hits += 1
+                return None
+            self.misses += 1
+
+        path = self._path(*key)
+        if os.path.exists(path):
+            with Metrics.file_io("holidays", "read", path), open(path, 'r') as f:
+                holidays = json.load(f)
+        else:
+            with Metrics.timed(FETCH_SECONDS, "fetch holidays"):
+                holidays = self.source.fetch(*key)
+            if holidays is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                with Metrics.file_io("holidays", "write", path), open(path, 'w') as f:
+                    json.dump(holidays, f)
+
+        with self._lock:
+            if holidays is None:
+                # Not cached, as the source may only have been down for a moment
+                self._not_found[key] = time.monotonic() + RETRY_SECONDS
+                return None
+            self._not_found.pop(key, None)
+            self._cache[key] = holidays
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return holidays
+
+    def prefetch(self, country_codes, years, max_workers=8):
+        """
+        Load the holidays of many countries over a range of years into the catalog, looking up missing ones
+        concurrently.
+        :return: The number of (country, year) entries that were found.
+        """
+        keys = [(country_code, year) for country_code in country_codes for year in years]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return sum(holidays is not None for holidays in executor.map(lambda key: self.get(*key), keys))
+
+
+class HolidayResolver:
+    """
+    Resolves the dates of the holidays that messages repeat on ("holiday name___country code").
+
+    Each holiday found is looked up once per year and remembered until the year changes. resolve_many() fetches the
+    holidays of every country involved in one go, so a few thousand holiday messages across 20 countries take
+    about 20 catalog lookups per year instead of one per message.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._year = None
+        self._dates = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _split(holiday):
+        holiday_name, _, country_code = (holiday or "").partition("___")
+        return holiday_name, country_code
+
+    def _reset_if_new_year(self, year):
+        if year != self._year:
+            self._year = year
+            self._dates = {}
+
+    def candidate_dates(self, holiday, year):
+        """
+        Returns the dates of a holiday in the given year and the next, as "YYYY-MM-DD" strings or None where the
+        holiday can't be found.
+        """
+        with self._lock:
+            self._reset_if_new_year(year)
+            if holiday in self._dates:
+                return self._dates[holiday]
+
+        holiday_name, country_code = self._split(holiday)
+        dates = []
+        for candidate_year in (year, year + 1):
+            holidays = self.catalog.get(country_code, candidate_year)
+            dates.append(holidays.get(holiday_name) if holidays else None)
+        dates = tuple(dates)
+
+        # A date that wasn't found is looked up again next time, as the catalog may find it later, e.g. once
+        # Calendarific can be reached again
+        if None not in dates:
+            with self._lock:
+                self._reset_if_new_year(year)
+                self._dates[holiday] = dates
+        return dates
+
+    def resolve_many(self, holidays, year):
+        """
+        Resolve many holidays at once, fetching each country's holidays for the year and the next only once.
+        :param holidays: An iterable of "holiday name___country code" strings.
+        :param year: The current year.
+        """
+        with self._lock:
+            self._reset_if_new_year(year)
+            holidays = {holiday for holiday in holidays if holiday and holiday not in self._dates}
+        if not holidays:
+            return
+        self.catalog.prefetch({self._split(holiday)[1] for holiday in holidays}, (year, year + 1))
+        for holiday in holidays:
+            self.candidate_dates(holiday, year)
+
+
+# The catalog and resolver shared by the whole process
+catalog = HolidayCatalog()
+resolver = HolidayResolver(catalog)
+
+Metrics.registry.counter("holiday_cache_hits_total", "Holiday lookups served from memory").set_function(
+    lambda: catalog.hits)
+Metrics.registry.counter("holiday_cache_misses_total", "Holiday lookups that read the holiday store or the source"
+                         ).set_function(lambda: catalog.misses)
+
 
 class Holidays:
     def __init__(self, country_code, year):
@@ -10,49 +247,20 @@ class Holidays:
         :param country_code: The ISO 3166-1 alpha-2 country code of the country to get the holidays for (e.g. "GB" for the United Kingdom)
         :param year: The year to get the holidays for.
         """
-        self.API_KEY = open("data/calendarific_api_key.dat", "r").read()
         self.country_code = country_code
         self.year = year
         self.holidays = None
 
-    def get_holidays(self):
-        """
-        Returns a list of holidays for the given country code and year.
-        :return: A JSON response containing the holidays with the following format:
-            {
-               "date":"2023-01-01",
-               "localName":"New Year\\'s Day",
-               "name":"New Year\\'s Day",
-               "countryCode":"GB",
-               "fixed":false,
-               "global":false,
-               "counties":[
-                  "GB-NIR"
-               ],
-               "launchYear":null,
-               "types":[
-                  "Public"
-               ]
-            }
-        """
-
-        # Check if json already exists as a file
-        # If it does, load it
-        if os.path.exists(f"{self.country_code}_{self.year}.json"):
-            with open(f"data/{self.country_code}_{self.year}.json", 'r') as f:
-                self.holidays = json.load(f)
-        else:
-            if len(self.country_code) != 2:
-                return None
-
-            url = f"https://calendarific.com/api/v2/holidays?&api_key={self.API_KEY}&country={self.country_code}&year={self.year}"
-            response = requests.get(url)
-            self.holidays = response.json()
-            if response.status_code != 200:
-                return None
-            # Save json to file
-            with open(f"data/{self.country_code}_{self.year}.json", 'w') as f:
-                json.dump(self.holidays, f)
+    def get_holidays(self, year=None):
+        """
+        Returns the holidays for the country code and year from the shared catalog.
+        :param year: The year to get the holidays for. Defaults to the year given to the constructor.
+        :return: A dict of holiday names to dates in the format "YYYY-MM-DD", or None if they can't be found.
+        """
+        if year is not None and year != self.year:
+            return catalog.get(self.country_code, year)
+        if self.holidays is None:
+            self.holidays = catalog.get(self.country_code, self.year)
         return self.holidays
 
     def get_holiday_names_list(self):
@@ -60,46 +268,39 @@ class Holidays:
         Returns a list of holiday names for the given country code and year.
         :return: A list of holiday names
         """
-        if self.holidays is None:
-            holidays = self.get_holidays()
-            if holidays is None:
-                return None
-            self.holidays = self.get_holidays()
-        holiday_names = []
-        for holiday in self.holidays['response']['holidays']:
-            holiday_names.append(holiday['name'])
-        return holiday_names
+        holidays = self.get_holidays()
+        if holidays is None:
+            return None
+        return list(holidays)
 
-    def get_holiday_dates(self, country_code, year):
+    def get_holiday_dates(self):
         """
         Returns a list of holiday dates for the given country code and year.
-        :param country_code: The ISO 3166-1 alpha-2 country code of the country to get the holidays for (e.g. "GB" for the United Kingdom)
-        :param year: The year to get the holidays for.
         :return: A list of holiday dates in the format "YYYY-MM-DD"
         """
-        if self.holidays is None:
-            if self.holidays is None:
-                holidays = self.get_holidays()
-                if holidays is None:
-                    return None
-
-        holiday_dates = []
-        for holiday in self.holidays['response']['holidays']:
-            holiday_dates.append(holiday['date']['iso'])
-        return holiday_dates
+        holidays = self.get_holidays()
+        if holidays is None:
+            return None
+        return list(holidays.values())
 
-    def get_date_of_holiday(self, holiday_name):
+    def get_date_of_holiday(self, holiday_name, year=None):
         """
         Returns the date of the given holiday in the given country and year.
         :param holiday_name: The name of the holiday to get the date for.
+        :param year: The year to look in. Defaults to the year given to the constructor.
         :return: A date in the format "YYYY-MM-DD"
         """
-        if self.holidays is None:
-            if self.holidays is None:
-                holidays = self.get_holidays()
-                if holidays is None:
-                    return None
-        for holiday in self.holidays['response']['holidays']:
-            if holiday['name'] == holiday_name:
-                return holiday['date']['iso']
-        return None
+        holidays = self.get_holidays(year)
+        if holidays is None:
+            return None
+        return holidays.get(holiday_name)
+
+
+if __name__ == "__main__":
+    # Prefetch holidays for offline use, e.g. python Holidays.py GB,US,FR 2024 2030
+    import sys
+
+    countries = sys.argv[1].split(",")
+    first_year, last_year = int(sys.argv[2]), int(sys.argv[3])
+    found = catalog.prefetch(countries, range(first_year, last_year + 1))
+    print(f"Stored {found} of {len(countries) * (last_year - first_year + 1)} country years in {HOLIDAYS_DIR}")
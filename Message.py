@@ -1,7 +1,15 @@
 import datetime
 import json
+import sys
 
-from Holidays import Holidays
+import Clock
+import Holidays
+import Phone
+import Recurrence
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
 
 
 class Message:
@@ -9,7 +17,7 @@ class Message:
     A class representing a message that can be scheduled for a future date and time.
 
     Attributes:
-    - recipient (str): The recipient of the message.
+    - recipient (str): The phone number of the recipient, in E.164 format (see Phone.normalise).
     - message (str): The text of the message.
     - hour (int): The hour of the day when the message should be sent.
     - minute (int): The minute of the hour when the message should be sent.
@@ -19,88 +27,178 @@ class Message:
     'm' for monthly, 'w' for weekly, 'd' for daily, or 'hol' for on a holiday).
     - holiday (str): The holiday on which the message should be sent. This should be in the format
     'holiday name___country code'.
+    - id (int): The id of the message in the message store, or None if it has not been stored yet.
+    - fire_at (int): The epoch time (in seconds) the message is due, or None if it has no valid date and time.
+    - anchor (str): The date a recurring message was first scheduled for, in the format 'YYYY-MM-DD'. Its later
+    dates are counted from this one rather than from the last, so a monthly message started on the 31st goes back
+    to the 31st after a shorter month.
+
+    The fields are set once when the message is created. Only reschedule() changes them afterwards, so fire_at
+    is parsed once and the scheduling checks are integer comparisons.
     """
 
+    __slots__ = ("id", "recipient", "message", "hour", "minute", "date", "repeat", "repeat_unit", "holiday",
+                 "fire_at", "anchor")
+
+    FIELDS = ("recipient", "message", "hour", "minute", "date", "repeat", "repeat_unit", "holiday")
+
     def __init__(self, recipient=None, message=None, hour=None, minute=None, date=None, repeat=None, repeat_unit=None,
-                 holiday=None, csv_line=None):
+                 holiday=None, csv_line=None, anchor=None):
+        self.id = None
         if csv_line is not None:
-            self.recipient, self.message, self.hour, self.minute, self.date, self.repeat, self.repeat_unit, self.holiday \
-                = ["" if a == "None" else a for a in csv_line.strip().split(',')]
+            recipient, message, hour, minute, date, repeat, repeat_unit, holiday = self.parse_line(csv_line)
         else:
-            if recipient.startswith('0'):
-                recipient = '+44' + recipient[1:]
-
-            self.recipient = recipient
-            self.message = message
-            self.hour = hour
-            self.minute = minute
-            self.date = date
-            self.repeat = repeat
-            self.repeat_unit = repeat_unit
-            self.holiday = holiday
-
-        if self.date is not None:
-            self.formatted_datetime = datetime.datetime.strptime(self.date, '%Y-%m-%d').strftime('%d/%m/%Y')
-            if self.hour != "" and self.hour is not None:
-                self.formatted_datetime = self.formatted_datetime + " " + f"{self.hour}:{self.minute}"
+            recipient = Phone.normalise(recipient)
+
+        self.recipient = recipient
+        self.message = message
+        # The short scheduling fields repeat across messages, so share one copy of each
+        self.hour = _intern(hour)
+        self.minute = _intern(minute)
+        self.date = _intern(date)
+        self.repeat = _intern(repeat)
+        self.repeat_unit = _intern(repeat_unit)
+        self.holiday = _intern(holiday)
+        self.fire_at = self._parse_fire_at()
+        # Messages stored before anchors were kept start their series from their current date
+        self.anchor = _intern(anchor or date)
+
+    @staticmethod
+    def parse_line(line):
+        """
+        Split a line of a comma-separated messages file into the message fields with a single split. Commas in
+        the message text are kept.
+        """
+        fields = line.rstrip("\r\n").split(",")
+        if len(fields) > 8:
+            fields[1:-6] = [",".join(fields[1:-6])]
+        return ["" if field == "None" else field for field in fields]
+
+    def _parse_fire_at(self):
+        if not self.date or not self.hour:
+            return None
+        try:
+            date = datetime.date.fromisoformat(self.date)
+            return int(datetime.datetime(date.year, date.month, date.day, int(self.hour), int(self.minute))
+                       .timestamp())
+        except (TypeError, ValueError):
+            return None
+
+    def reschedule(self, date):
+        """
+        Move the message to a new date, keeping its time and the date its series is counted from.
+        :param date: The new date in the format 'YYYY-MM-DD'.
+        """
+        self.date = _intern(date)
+        self.fire_at = self._parse_fire_at()
+
+    @property
+    def formatted_datetime(self):
+        if not self.date:
+            return ""
+        formatted_datetime = datetime.datetime.strptime(self.date, '%Y-%m-%d').strftime('%d/%m/%Y')
+        if self.hour != "" and self.hour is not None:
+            formatted_datetime = formatted_datetime + " " + f"{self.hour}:{self.minute}"
+        return formatted_datetime
 
     def is_old_message(self):
         """
         Check if the current message is old.
-        A message is considered old if it is scheduled for a date that has already passed,
-        or if it is scheduled for the current date but at a time that has already passed.
+        A message is considered old if the time it is scheduled for has come, as it is when the scheduler pops it
+        (see Scheduler.pop_due).
 
         Returns:
             bool: True if the message is old, False otherwise.
         """
         try:
             if self.repeat_unit == "n":
-                if self.date is not None:
-                    date = datetime.datetime.strptime(self.date + " " + self.hour + ":" + self.minute, '%Y-%m-%d %H:%M')
-                    if date < datetime.datetime.now():
-                        return True
-                    else:
-                        return False
-                else:
-                    return False
+                return self.fire_at is not None and self.fire_at <= Clock.clock.time()
             else:
-                if datetime.datetime.strptime(self.date, '%Y-%m-%d') < datetime.datetime.now():
-                    if self.repeat_unit != "hol":
-                        date = self.date.split("-")
-                        year = int(date[0])
-                        month = int(date[1])
-                        day = int(date[2])
-                        repeat = int(self.repeat)
-                        if self.repeat_unit == "y":
-                            self.date = str(datetime.datetime(year + repeat, month, day)).split(" ")[0]
-                        elif self.repeat_unit == "m":
-                            self.date = str(datetime.datetime(year, month + repeat, day)).split(" ")[0]
-                        elif self.repeat_unit == "w":
-                            self.date = \
-                                str(datetime.datetime(year, month, day) + datetime.timedelta(days=7)).split(" ")[0]
-                        elif self.repeat_unit == "d":
-                            self.date = str(datetime.datetime(year, month, day + repeat)).split(" ")[0]
-                    else:
-                        year = int(self.date.split("-")[0])
-                        # get current year
-                        current_year = datetime.datetime.now().year
-                        if year < current_year:
-                            year = current_year
-                        elif year == current_year:
-                            year = current_year + 1
-
-                        holiday_name = self.holiday.split("___")[0]
-                        country_code = self.holiday.split("___")[1]
-                        holidayObj = Holidays(country_code, year)
-                        self.date = holidayObj.get_date_of_holiday(holiday_name)
-
-                return False
+                # Move the message straight on to its next occurrence, however far behind it is
+                now = Clock.clock.now()
+                start = self.start_datetime()
+                if start is not None and start <= now:
+                    next_fire_time = self.next_fire_time(now)
+                    if next_fire_time is not None:
+                        self.reschedule(next_fire_time.strftime('%Y-%m-%d'))
+
+            return False
         except Exception as e:
             print(e)
             return False
 
+    def start_datetime(self):
+        """
+        Returns the date and time the message is currently scheduled for, or None if it has no valid date.
+        Messages without a time are scheduled for midnight.
+        """
+        if self.fire_at is not None:
+            return datetime.datetime.fromtimestamp(self.fire_at)
+        try:
+            return datetime.datetime.combine(datetime.date.fromisoformat(self.date), datetime.time())
+        except (TypeError, ValueError):
+            return None
+
+    def series_start(self):
+        """
+        Returns the date and time of the first occurrence of the message's series, which its later dates are
+        counted from, or None if it has no valid date.
+        """
+        start = self.start_datetime()
+        try:
+            return datetime.datetime.combine(datetime.date.fromisoformat(self.anchor), start.time())
+        except (AttributeError, TypeError, ValueError):
+            return start
+
+    def next_fire_time(self, now=None):
+        """
+        Returns the next date and time the message should be sent after now, without changing the message.
+
+        Args:
+            now (datetime): The time to look after. Defaults to the current time.
+
+        Returns:
+            datetime: The next send time, or None if the message will not be sent again.
+        """
+        if now is None:
+            now = Clock.clock.now()
+        start = self.start_datetime()
+        if start is None:
+            return None
+        if self.repeat_unit == "hol":
+            if start > now:
+                return start
+            # The holiday's date this year if it is still to come, otherwise next year
+            for date in Holidays.resolver.candidate_dates(self.holiday, now.year):
+                if date is not None:
+                    candidate = datetime.datetime.combine(datetime.date.fromisoformat(date), start.time())
+                    if candidate > now:
+                        return candidate
+            return None
+        return Recurrence.next_occurrence(self.series_start(), self.repeat_unit, self.repeat, now)
+
     def make_line(self):
-        return f"{self.recipient},{self.message},{self.hour},{self.minute},{self.date},{self.repeat},{self.repeat_unit},{self.holiday}\n"
+        return ",".join(["None" if value is None else str(value) for value in self.fields()]) + "\n"
+
+    def fields(self):
+        """
+        Returns the message fields in the order they are stored.
+        """
+        return [getattr(self, field) for field in self.FIELDS]
+
+    @classmethod
+    def _slots(cls):
+        return [slot for klass in reversed(cls.__mro__) for slot in getattr(klass, "__slots__", ())]
+
+    def copy(self):
+        """
+        Returns a shallow copy of the message, so it can be rescheduled without changing a message other threads
+        may be reading.
+        """
+        copy = object.__new__(type(self))
+        for slot in self._slots():
+            setattr(copy, slot, getattr(self, slot))
+        return copy
 
     def __str__(self):
-        return json.dumps(self.__dict__)
\ No newline at end of file
+        return json.dumps({slot: getattr(self, slot) for slot in self._slots()})
\ No newline at end of file
@@ -1,286 +1,856 @@
-import atexit
-import csv
-import datetime
-import hashlib
+import asyncio
+import bisect
+import itertools
 import os
-import random
+import queue
+import socket
 import threading
-import time
-import webbrowser as web
+import types
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import Clock
+import Holidays
+import Metrics
+import SendQueue
+import Transport
+from Campaign import Campaign
+from DeliveryLog import DeliveryLog, delivery_key
+from EventBus import EventBus
+from Message import Message
+from MessageStore import LEASE_SECONDS, MessageStore
+from Scheduler import Scheduler
+from Watcher import FileWatcher
+
+
+def _start_time(message):
+    """
+    Returns the epoch time a message or campaign is scheduled for, counting messages without a time as midnight.
+    """
+    if message.fire_at is not None:
+        return message.fire_at
+    start = message.start_datetime()
+    return int(start.timestamp()) if start is not None else 0
+
+
+TICK_SECONDS = Metrics.registry.histogram("scheduler_tick_seconds", "How long each sender tick takes")
+SEND_LATENESS = Metrics.registry.histogram(
+    "send_lateness_seconds", "How long after its scheduled time each message was sent",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+MESSAGES_SENT = Metrics.registry.counter("messages_sent_total", "Messages handed to the transport, by result",
+                                         ("result",))
+
+
+# Messages that came due while nothing was sending, e.g. during a restart, are still sent if they are at most this
+# many seconds late, behind the messages that are on time. Older ones are recorded as missed.
+CATCH_UP_SECONDS = float(os.environ.get("MESSAGE_CATCH_UP_SECONDS", 6 * 60 * 60))
+
+# Set MESSAGE_SEND_FROM_WORKERS=1 when Workers.py sends the messages. The web server's sender then only keeps its
+# messages up to date for the web UI, rather than competing with the workers for the due messages.
+SEND_FROM_WORKERS = os.environ.get("MESSAGE_SEND_FROM_WORKERS", "") not in ("", "0")
+
+# Messages that fail to send are tried again after this many seconds, then twice as long after each further failure,
+# until they are too late to catch up on
+RETRY_SECONDS = 30
+
+
+def observe_lateness(messages, sent_at=None):
+    """
+    Record how late some messages were sent in SEND_LATENESS.
+    """
+    sent_at = Clock.clock.time() if sent_at is None else sent_at
+    for message in messages:
+        if message.fire_at is not None:
+            SEND_LATENESS.observe(max(sent_at - message.fire_at, 0))
+
+
+# The orders messages can be listed in, as functions returning each message's sort value
+LISTING_ORDERS = {
+    "date": _start_time,
+    "recipient": lambda message: message.recipient,
+    "message": lambda message: message.message,
+}
+
+
+def retire(messages, delete, update, due_after=None):
+    """
+    Delete old one-off messages or campaigns from the store and move recurring ones on to their next date. Only the
+    rows that change are written back.
+    :param messages: The messages or campaigns to check.
+    :param delete: A function that deletes rows by id.
+    :param update: A function that writes back changed messages.
+    :param due_after: Keep messages that were due after this epoch time as they are, as they are about to be sent.
+    None retires everything that is due.
+    :return: The messages that are still scheduled. Recurring messages that are due but can't be moved on are left
+    out, but stay in the store.
+    """
+    # Recurring messages that have passed are moved on, so work on copies of them rather than change messages
+    # that are in a published snapshot
+    now = Clock.clock.time()
+    messages = [message.copy() if message.repeat_unit != "n" and (message.fire_at or 0) <= now else message
+                for message in messages]
+    # Look up the next dates of all holiday messages together, a country at a time
+    Holidays.resolver.resolve_many((message.holiday for message in messages
+                                    if message.repeat_unit == "hol" and (message.fire_at or 0) <= now),
+                                   Clock.clock.now().year)
+
+    current_messages = []
+    old_ids = []
+    moved_messages = []
+    for message in messages:
+        date = message.date
+        if due_after is not None and message.fire_at is not None and message.fire_at >= due_after:
+            current_messages.append(message)
+        elif message.is_old_message():
+            if due_after is not None:
+                print("Skipping old message:", message)
+            old_ids.append(message.id)
+        elif message.repeat_unit != "n" and message.fire_at is not None and message.fire_at <= now:
+            # Its next date can't be found, e.g. a holiday missing from next year's holidays. Scheduled at the
+            # same time again it would be due again straight away, so it is left in the store unscheduled until
+            # the messages are next loaded.
+            print("Can't find the next date of message, leaving it unscheduled:", message)
+        else:
+            current_messages.append(message)
+            if message.date != date:
+                moved_messages.append(message)
+    delete(old_ids)
+    update(moved_messages)
+    return current_messages
+
+
+class CampaignSend:
+    """
+    A campaign that is being sent. Its row stays leased until every one of its messages has been sent, so a
+    sender that stops part way through leaves the rest to be sent after a restart.
+    """
+
+    __slots__ = ("campaign", "pending", "expanded", "lease_expires")
+
+    def __init__(self, campaign, lease_expires):
+        self.campaign = campaign
+        # Messages queued but not sent yet
+        self.pending = 0
+        # Whether every message has been queued
+        self.expanded = False
+        self.lease_expires = lease_expires
+
+    def expand(self, deliveries, include_unconfirmed, queued):
+        """
+        Yields the messages of the campaign, leaving out any that the delivery log shows were sent before, and
+        keeps count of those that haven't been sent yet.
+        :param deliveries: The DeliveryLog.
+        :param include_unconfirmed: Also leave out messages that may have been sent.
+        :param queued: A {id(message): CampaignSend} dict that each message is added to, so that its campaign can be
+        found once it is sent.
+        """
+        for message in deliveries.unsent(self.campaign.expand(), include_unconfirmed):
+            queued[id(message)] = self
+            self.pending += 1
+            yield message
+        self.expanded = True
 
-import pyautogui
+    def is_done(self):
+        return self.expanded and not self.pending
 
-import Utils
 
-import pywhatkit as kit
+def _shown(message):
+    """
+    Returns the fields of a message or campaign that the message table shows.
+    """
+    return message.recipient, message.message, message.fire_at, message.date
+
+
+def _snapshot(items):
+    """
+    Returns a read-only view of a dict of messages, which is never changed once published.
+    """
+    return types.MappingProxyType(items)
 
-from Message import Message
 
 class MessageSender:
-    def __init__(self, messages_file):
+    """
+    Schedules messages and campaigns and sends them when they are due.
+
+    Only one thread changes the messages: the sender thread once it has started, or the caller before then.
+    Other threads queue their changes with add_messages() and add_campaign(), which the sender thread applies
+    together in one store transaction. self.messages and self.campaigns are immutable snapshots that are
+    replaced, never changed, so readers such as the index page need no locking. Each change is also published to
+    self.events, for the live message table.
+    """
+
+    def __init__(self, messages_file, legacy_messages_file="messages.txt", transport=None,
+                 catch_up_seconds=CATCH_UP_SECONDS, resend_unconfirmed=False):
+        """
+        :param messages_file: The path of the SQLite message store.
+        :param legacy_messages_file: A comma-separated messages file from older versions. If it exists it is
+        imported into the message store once and renamed.
+        :param transport: The Transport to send messages with. Defaults to Transport.default_transport().
+        :param catch_up_seconds: How late a message can be and still be sent, e.g. after a restart. Messages are
+        never sent later than the send window if this is shorter.
+        :param resend_unconfirmed: Send messages again if the delivery log shows a send was attempted but not how
+        it went, e.g. because the sender stopped part way through. They may then be sent twice.
+        """
         self.message_send_buffer = 50
+        self.transport = transport or Transport.default_transport(self.message_send_buffer)
+        # Seconds between checks of the message store for changes made outside of add_message
+        self.file_check_interval = 10
+        self.catch_up_seconds = catch_up_seconds
+        self.resend_unconfirmed = resend_unconfirmed
         self.thread = None
         self.is_running = True
-        self.hash_of_file = None
         self.messages_file = messages_file
-        self.messages = []
-
-        # If messages_file does not exist, create it
-        if not os.path.exists(self.messages_file):
-            f = open(self.messages_file, "w")
-            f.close()
-
-        # # Read the messages from the CSV file
-        self.read_messages_from_csv()
-        self.delete_old_messages()
-
-        if os.path.exists(os.path.join("static", "contacts.csv")):
-            self.csv_validator(os.path.join("static", "contacts.csv"))
-            self.add_sequential_id_to_csv(os.path.join("static", "contacts.csv"))
-
-        if os.path.exists(os.path.join("static", "groups.csv")):
-            self.csv_validator(os.path.join("static", "groups.csv"))
-            self.add_sequential_id_to_csv(os.path.join("static", "groups.csv"))
-
-
-    def read_messages_from_csv(self):
-        print("Reading messages from CSV file...")
-        # Open the CSV file in read mode
-        with open(self.messages_file, 'r', encoding='UTF-8') as f:
-            # Create an empty list to store the new lines
-            new_lines = []
-
-            # Iterate through the lines in the CSV file
-            for line in f:
-                if len(line) > 5:
-                    # Create a message object for the line
-                    message = Message(csv_line=line)
-
-                    # If the message is not an old message, add the line to the list of new lines
-                    if not message.is_old_message():
-                        self.messages.append(message)
-                        new_lines.append(message.make_line())
-                    else:
-                        print("Skipping old message:", message)
-        # Open the CSV file in write mode and overwrite the file with the new lines
-        with open(self.messages_file, 'w', encoding='UTF-8') as f:
-            f.writelines(new_lines)
+        # Snapshots of the messages and campaigns, keyed by their id in the message store
+        self.messages = _snapshot({})
+        self.campaigns = _snapshot({})
+        # The snapshots the listings were sorted from, and the sorted listings by order
+        self._listings = (self.messages, self.campaigns, {})
+        # Changes waiting for the sender thread, as (kind, item, future) tuples
+        self._writes = queue.Queue()
+        # Changes to the messages as they happen, for the /events stream
+        self.events = EventBus()
+        self.scheduler = Scheduler()
+        # Messages that failed to send or that another sender holds the lease on, as
+        # {id: (failures, epoch time to try again)}
+        self._retries = {}
+        # Campaigns that another sender holds the lease on, as {id: epoch time to try again}
+        self._campaign_retries = {}
+        # Campaigns being sent, as {id: CampaignSend}, and the campaign each of their queued messages is from, as
+        # {id(message): CampaignSend}
+        self._campaign_sends = {}
+        self._campaign_messages = {}
+        # Due messages wait here until the rate limits let them go
+        self.send_queue = SendQueue.SendQueue()
+        # The maximum number of messages handed to the transport at once
+        self.max_batch = 50
+        self.store = MessageStore(self.messages_file)
+        # The name this process leases messages from the store under
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:sender"
+        # The last change to the message store that has been loaded
+        self.change_seq = 0
+        # Changes are written to the write-ahead log before they reach the database file, so watch both
+        self.watcher = FileWatcher([self.messages_file, self.messages_file + "-wal"])
+        # Every send attempt and its outcome, so nothing is sent twice however the sender stops
+        self.deliveries = DeliveryLog(self.messages_file + "-deliveries")
+
+        if os.path.exists(legacy_messages_file):
+            print("Migrating", legacy_messages_file, "to", self.messages_file)
+            print("Migrated", self.store.migrate_from_text(legacy_messages_file), "messages.")
+
+        self._register_metrics()
+        # Load the messages from the message store
+        self.load_messages()
+        self.recover()
+
+    def _register_metrics(self):
+        """
+        Expose the state of this sender's queues and message store on /metrics.
+        """
+        registry = Metrics.registry
+        registry.gauge("scheduler_queue_depth", "Messages and campaigns waiting in the scheduler").set_function(
+            lambda: len(self.scheduler))
+        registry.gauge("scheduler_next_due_timestamp_seconds", "When the next message is due, in epoch seconds"
+                       ).set_function(self.scheduler.next_due_time)
+        registry.gauge("send_queue_depth", "Due messages waiting for the rate limits").set_function(
+            lambda: self.send_queue.stats()["backlog"])
+        registry.gauge("scheduled_messages", "Scheduled messages and campaigns", ("kind",)).set_function(
+            lambda: {("message",): len(self.messages), ("campaign",): len(self.campaigns)})
+        registry.gauge("store_file_bytes", "The size of the message store's files", ("file",)).set_function(
+            lambda: {(os.path.basename(path),): os.path.getsize(path)
+                     for path in (self.messages_file, self.messages_file + "-wal") if os.path.exists(path)})
+
+    def load_messages(self):
+        print("Loading messages from the message store...")
+        self.change_seq = self.store.last_change()
+        self.messages = _snapshot({message.id: message for message in self.retire_old_messages(self.store.all())})
+        self.campaigns = _snapshot({campaign.id: campaign
+                                    for campaign in self.retire_old_campaigns(self.store.all_campaigns())})
+        self._schedule_messages()
+        # Everything may have changed, so subscribers start again from the new messages
+        self.events.publish("reset")
         print("Done.")
 
-    def add_sequential_id_to_csv(self, csv_file):
-        try:
-            with open(csv_file, mode='r', newline='', encoding='utf-8') as file:
-                reader = csv.reader(file)
-                rows = list(reader)
-
-            header = rows[0]
-            id_column_index = None
-
-            # Check if 'ID' column exists, if not, add it
-            if 'ID' not in header:
-                header.append('ID')
-                id_column_index = len(header) - 1
-            else:
-                id_column_index = header.index('ID')
-
-            # Add a sequential ID to each row
-            if id_column_index is not None:
-                for i, row in enumerate(rows[1:], start=1):
-                    if len(row) <= id_column_index:
-                        row.extend([''] * (id_column_index - len(row) + 1))
-                    if not row[id_column_index]:
-                        row[id_column_index] = str(i)
-
-            # Write the modified data back to the CSV file
-            with open(csv_file, mode='w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                writer.writerows(rows)
-
-        except Exception as e:
-            print("Error:", e)
+    def recover(self):
+        """
+        Compare the messages and campaigns that came due while nothing was sending with the delivery log. Those it
+        shows were already sent, e.g. by a sender that stopped before it could move them on, are retired without
+        being sent again. The rest are sent by the next ticks, behind the messages that are on time.
+        """
+        late_after = Clock.clock.time() - self.send_window()
+        overdue = [message for message in itertools.chain(self.messages.values(), self.campaigns.values())
+                   if message.fire_at is not None and message.fire_at < late_after]
+        if overdue:
+            to_send = self._drop_delivered(overdue)
+            print(f"Catching up on {len(to_send)} messages that came due while stopped "
+                  f"({len(overdue) - len(to_send)} had already been sent).")
+
+    def reload_changed_messages(self):
+        """
+        Reload only the messages that have been inserted, updated or deleted since they were last loaded.
+        """
+        self.change_seq, changed_ids = self.store.changes_since(self.change_seq)
+        if changed_ids is None:
+            # Too far behind to catch up from the change log
+            self.load_messages()
+            return
 
-    def csv_validator(self, input_file_path):
-        clean_rows = []
+        old_messages = self.messages
+        changed = self.retire_old_messages(self.store.get_many(changed_ids))
+        self._replace_messages(changed_ids, changed)
+        self._publish_changes(old_messages, self.messages, changed_ids)
 
-        with open(input_file_path, 'r', newline='', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            for row in reader:
-                clean_rows.append(row)
+        # There are few campaigns however many recipients they have, so reload them all
+        old_campaigns = self.campaigns
+        self.campaigns = _snapshot({campaign.id: campaign
+                                    for campaign in self.retire_old_campaigns(self.store.all_campaigns())})
+        for campaign in self.campaigns.values():
+            self._schedule_message(campaign)
+        self._publish_changes(old_campaigns, self.campaigns, set(old_campaigns) | set(self.campaigns))
 
-        # Checking if the file has any content
-        if not clean_rows:
-            print("The file is empty.")
-            return
+    def _publish_changes(self, old, new, ids):
+        """
+        Publish the changes between two snapshots of the messages or campaigns.
+        :param ids: The ids of the messages that may have changed.
+        """
+        added, rescheduled, removed = [], [], []
+        for message_id in ids:
+            if message_id not in new:
+                if message_id in old:
+                    removed.append(old[message_id])
+            elif message_id not in old:
+                added.append(new[message_id])
+            elif _shown(old[message_id]) != _shown(new[message_id]):
+                rescheduled.append(new[message_id])
+        for event_type, messages in (("added", added), ("rescheduled", rescheduled), ("removed", removed)):
+            if messages:
+                self.events.publish(event_type, messages)
+
+    def _replace_messages(self, removed_ids, added):
+        """
+        Publish a new snapshot of the messages without removed_ids and with the added messages, and schedule the
+        added messages.
+        """
+        messages = dict(self.messages)
+        for message_id in removed_ids:
+            messages.pop(message_id, None)
+        for message in added:
+            messages[message.id] = message
+            # Wakes the sender thread early if this message is due before everything else
+            self._schedule_message(message)
+        self.messages = _snapshot(messages)
+
+    def _replace_campaigns(self, removed_ids, added):
+        """
+        Publish a new snapshot of the campaigns without removed_ids and with the added campaigns, and schedule the
+        added campaigns.
+        """
+        campaigns = dict(self.campaigns)
+        for campaign_id in removed_ids:
+            campaigns.pop(campaign_id, None)
+        for campaign in added:
+            campaigns[campaign.id] = campaign
+            self._schedule_message(campaign)
+        self.campaigns = _snapshot(campaigns)
+
+    def send_window(self):
+        """
+        Returns how many seconds after its due time a message can still be sent.
+        """
+        return self.message_send_buffer + self.file_check_interval
 
-        # Assuming the first row is the header
-        header = clean_rows[0]
-        expected_columns = len(header)
+    def catch_up_window(self):
+        """
+        Returns how many seconds after its due time a message is still sent, if it is sent late.
+        """
+        return max(self.send_window(), self.catch_up_seconds)
 
-        # Validate and adjust each row
-        corrected_lines = []
-        for row in clean_rows:
-            if len(row) < expected_columns:
-                # Add missing columns
-                row += [''] * (expected_columns - len(row))
-            elif len(row) > expected_columns:
-                # Truncate extra columns
-                row = row[:expected_columns]
+    def retire_old_messages(self, messages, keep_due=True):
+        """
+        Delete old one-off messages from the store and move recurring messages on to their next date. Only the
+        rows that change are written back.
+        :param messages: The messages to check.
+        :param keep_due: Keep messages that are due but still within the send window, as they are about to be sent.
+        :return: The messages that are still scheduled.
+        """
+        return self._retire(messages, self.store.delete_many, self.store.update_many, keep_due)
 
-            corrected_lines.append(row)
+    def retire_old_campaigns(self, campaigns, keep_due=True):
+        """
+        Delete old one-off campaigns from the store and move recurring campaigns on to their next date.
+        :param campaigns: The campaigns to check.
+        :param keep_due: Keep campaigns that are due but still within the send window, as they are about to be sent.
+        :return: The campaigns that are still scheduled.
+        """
+        return self._retire(campaigns, self.store.delete_campaigns, self.store.update_campaigns, keep_due)
+
+    def _retire(self, messages, delete, update, keep_due):
+        if not keep_due:
+            return retire(messages, delete, update)
+        due_after = Clock.clock.time() - self.catch_up_window()
+        # These are dropped or moved on to their next date without being sent
+        self.deliveries.record("missed", [message for message in messages
+                                          if message.fire_at is not None and message.fire_at < due_after],
+                               owner=self.owner)
+        return retire(messages, delete, update, due_after)
+
+    def _schedule_messages(self):
+        """
+        Rebuild the scheduler queue from self.messages and self.campaigns.
+        """
+        self._retries = {message_id: retry for message_id, retry in self._retries.items()
+                         if message_id in self.messages}
+        self._campaign_retries = {campaign_id: retry_at for campaign_id, retry_at in self._campaign_retries.items()
+                                  if campaign_id in self.campaigns}
+        entries = []
+        for message in itertools.chain(self.messages.values(), self.campaigns.values()):
+            if message.fire_at is not None:
+                entries.append((self._due_time(message), message))
+        self.scheduler.rebuild(entries)
+
+    def _due_time(self, message):
+        """
+        Returns the epoch time a message or campaign is next due to be sent: its scheduled time, or for one that
+        failed to send or was leased by another sender, when it is next tried.
+        """
+        if isinstance(message, Campaign):
+            retry_at = self._campaign_retries.get(message.id)
+        else:
+            retry_at = self._retries.get(message.id, (0, None))[1]
+        return message.fire_at if retry_at is None else max(message.fire_at, retry_at)
 
-        # Write the corrected data back to the file
-        with open(input_file_path, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerows(corrected_lines)
+    def _is_current(self, message):
+        """
+        Returns True if a message or campaign popped from the scheduler hasn't since been changed or deleted.
+        """
+        loaded = self.campaigns if isinstance(message, Campaign) else self.messages
+        return loaded.get(message.id) is message
 
+    def _schedule_message(self, message):
+        if message.fire_at is not None:
+            self.scheduler.push(self._due_time(message), message)
 
     def get_messages(self):
-        messages = []
-        self.read_messages_from_csv()
-        for message_info in self.messages:
-            if not message_info.is_old_message():
-                messages.append(message_info)
-        return sorted(messages, key=lambda message: message.date)
+        return sorted(itertools.chain(self.messages.values(), self.campaigns.values()),
+                      key=lambda message: message.date)
+
+    def list_messages(self, order="date", descending=False, cursor=None, limit=50):
+        """
+        Returns one page of the scheduled messages and campaigns.
+
+        Each listing order is sorted once and kept until the messages change, and pages are found by binary
+        search on the cursor, so a page costs the same however deep into the listing it is.
+        :param order: One of the keys of LISTING_ORDERS.
+        :param descending: List in reverse order.
+        :param cursor: The cursor returned with the previous page, or None for the first page.
+        :param limit: The maximum number of messages in the page.
+        :return: A tuple of (a list of messages and campaigns, the cursor of the next page or None if this is the
+        last page).
+        """
+        messages, campaigns, listings = self._listings
+        if messages is not self.messages or campaigns is not self.campaigns:
+            messages, campaigns, listings = self._listings = (self.messages, self.campaigns, {})
+
+        listing = listings.get(order)
+        if listing is None:
+            sort_value = LISTING_ORDERS[order]
+            # Campaigns are stored apart from messages, so their ids are only unique together with the kind
+            entries = sorted(itertools.chain(
+                (((sort_value(message), 0, message.id), message) for message in messages.values()),
+                (((sort_value(campaign), 1, campaign.id), campaign) for campaign in campaigns.values())),
+                key=lambda entry: entry[0])
+            listing = listings[order] = ([key for key, _ in entries], [message for _, message in entries])
+        keys, messages = listing
+
+        if descending:
+            end = len(keys) if cursor is None else bisect.bisect_left(keys, cursor)
+            start = max(end - limit, 0)
+            page = messages[start:end][::-1]
+            next_cursor = keys[start] if start > 0 else None
+        else:
+            start = 0 if cursor is None else bisect.bisect_right(keys, cursor)
+            end = min(start + limit, len(keys))
+            page = messages[start:end]
+            next_cursor = keys[end - 1] if end < len(keys) else None
+        return page, next_cursor
 
     def add_message(self, recipient, message, hour=None, minute=None, date=None, repeat=None, repeat_unit=None,
                     holiday_name=None):
-        new_message = Message(recipient, message, hour, minute, date, repeat, repeat_unit)
-        self.messages.append(new_message)
-
-        # Save message to file
-        with open(self.messages_file, 'a', encoding='UTF-8') as f:
-            f.write(f"{recipient},{message},{hour},{minute},{date},{repeat},{repeat_unit},{holiday_name}\n")
-
+        self.add_messages([Message(recipient, message, hour, minute, date, repeat, repeat_unit, holiday_name)])
 
-    def delete_old_messages(self):
-        # Open the CSV file in read mode
-        with open(self.messages_file, 'r', encoding='UTF-8') as f:
-            # Create an empty list to store the new lines
-            new_lines = []
-
-            # Iterate through the lines in the CSV file
-            for line in f:
-                if len(line) > 5:
-                    # Create a message object for the line
-                    message = Message(csv_line=line)
-
-                    # If the message is not an old message, add the line to the list of new lines
-                    if not message.is_old_message():
-                        new_lines.append(message.make_line())
-
-        # Open the CSV file in write mode and overwrite the file with the new lines
-        with open(self.messages_file, 'w', encoding='UTF-8') as f:
-            f.writelines(new_lines)
-
-    def _has_message_file_changed(self):
-        hash_of_file = hashlib.md5(open(self.messages_file, 'rb').read()).hexdigest()
-        output = False
-
-        if self.hash_of_file != hash_of_file:
-            output = True
-            self.hash_of_file = hash_of_file
-        return output
-
-    @staticmethod
-    def sendwhatmsg_instantly(
-            phone_no: str,
-            message: str,
-            wait_time: int = 15
-    ) -> None:
+    def add_messages(self, messages):
         """
-        Send WhatsApp Message Instantly
-
-        Taken and modified from pywhatkit https://github.com/Ankit404butfound/PyWhatKit
+        Save several messages to the message store in a single transaction and schedule them. Returns once they
+        are saved.
+        :param messages: A list of Message objects.
         """
+        self._write("messages", messages)
 
-        # Prepare message for URL
-        message = Utils.prepare_string_for_url(message)
-
-        web.open(f"https://web.whatsapp.com/send?phone={phone_no}&text={message}")
-
-        time.sleep(2)
-
-        pyautogui.press("F11")
-
-        time.sleep(4)
-
-        time.sleep(wait_time - 4)
-
-        # 61.66666666666667%, 95.0%
-        x, y = Utils.get_coord(61.66666666666667, 95.0)
-        pyautogui.click(x, y)
-
-        pyautogui.press("enter")
-
-    @staticmethod
-    def send_another(recipient, message_string):
-        # Coordinates where the mouse will click
-        # %, %
-        x, y = Utils.get_coord(15.416666666666668, 12.314814814814815)
-
-        # Move the mouse to the specified coordinates
-        pyautogui.moveTo(x, y)
-
-        # Click at the current mouse location
-        pyautogui.click()
+    def get_queue_stats(self):
+        """
+        Returns the backlog depth and throughput of the send queue.
+        """
+        return self.send_queue.stats()
 
-        # Wait a moment for any window or field to activate
-        time.sleep(1)
+    def add_campaign(self, campaign):
+        """
+        Save a campaign to the message store and schedule it. Returns once it is saved.
+        """
+        self._write("campaign", campaign)
 
-        # Type phone number
-        pyautogui.write(recipient)
+    def _write(self, kind, item):
+        """
+        Hand a change to the sender thread and wait for it to be applied, or apply it now if the sender thread
+        isn't running.
+        """
+        if self.thread is None or not self.thread.is_alive() or threading.current_thread() is self.thread:
+            self._apply_writes([(kind, item, None)])
+            return
+        future = Future()
+        self._writes.put((kind, item, future))
+        self.scheduler.wake()
+        future.result()
 
-        time.sleep(1)
+    def _apply_writes(self, writes=None):
+        """
+        Apply queued changes: every new message and campaign is saved in one transaction, then published in one
+        new snapshot.
+        :param writes: The changes to apply. Defaults to everything in the queue.
+        """
+        if writes is None:
+            writes = []
+            while True:
+                try:
+                    writes.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+        if not writes:
+            return
 
-        x, y = Utils.get_coord(16.40625, 27.777777777777775)
-        # Click the contact
-        pyautogui.moveTo(x, y)
+        messages = [message for kind, item, _ in writes if kind == "messages" for message in item]
+        campaigns = [item for kind, item, _ in writes if kind == "campaign"]
+        try:
+            self.store.add_many(messages, campaigns)
+        except Exception as e:
+            for _, _, future in writes:
+                if future is not None:
+                    future.set_exception(e)
+            # Changes applied by their caller raise there, queued ones in the thread that queued them
+            if any(future is None for _, _, future in writes):
+                raise
+            return
 
-        pyautogui.click()
+        if messages:
+            self._replace_messages((), messages)
+        if campaigns:
+            self._replace_campaigns((), campaigns)
+        if messages or campaigns:
+            self.events.publish("added", messages + campaigns)
+        for _, _, future in writes:
+            if future is not None:
+                future.set_result(None)
+
+    def send_messages(self, send=True):
+        try:
+            while self.is_running:
+                self._wait()
+                if not self.is_running:
+                    break
+                self._tick(send)
+        finally:
+            self._finish()
+
+    async def run(self, is_leader=None):
+        """
+        Run the scheduler as a task on the running event loop, until stop_thread() is called.
 
-        time.sleep(1)
+        The waits, store writes and sends block, so they run on one worker thread, which is the only thread that
+        changes the messages (as the sender thread is when started with start()). A step that has started always
+        finishes, so stopping never abandons a batch part way through sending.
+        :param is_leader: A function called before each step that returns True if this process should send.
+        Processes that aren't the leader only keep their messages up to date. Defaults to always sending.
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sender")
+        self.thread = await loop.run_in_executor(executor, threading.current_thread)
+        leader = False
+        try:
+            while self.is_running:
+                await loop.run_in_executor(executor, self._wait)
+                if not self.is_running:
+                    break
+                was_leader, leader = leader, is_leader is None or is_leader()
+                if leader and not was_leader:
+                    # Catch up with everything the previous leader sent before taking over
+                    await loop.run_in_executor(executor, self.load_messages)
+                await loop.run_in_executor(executor, self._tick, leader)
+        finally:
+            await loop.run_in_executor(executor, self._finish)
+            executor.shutdown()
+            # Later changes are applied by their caller
+            self.thread = None
+
+    def _wait(self):
+        # Sleep until the next message is due or the send queue can release more, waking early to pick up
+        # changes to the messages file
+        queue_wait = self.send_queue.time_until_ready()
+        self.scheduler.wait_until_due(
+            self.file_check_interval if queue_wait is None else min(queue_wait, self.file_check_interval))
+
+    def _tick(self, send=True):
+        """
+        Apply queued changes, reload changes made elsewhere, and send the messages that are due.
+        :param send: If False, due messages are dropped from the scheduler rather than sent, as another process
+        sends them.
+        """
+        with Metrics.timed(TICK_SECONDS, "tick"):
+            self._send_due(send)
 
-        pyautogui.write(message_string)
+    def _send_due(self, send):
+        self._apply_writes()
+        if self.watcher.has_changed():
+            self.reload_changed_messages()
 
-        pyautogui.press("enter")
+        now = Clock.clock.time()
+        if not send:
+            self.scheduler.pop_due(now)
+            return
 
-    def send_messages(self):
-        wait_time = 10
-        while self.is_running:
-            if self._has_message_file_changed():
-                self.read_messages_from_csv()
-                self.delete_old_messages()
-                self.messages = self.get_messages()
+        now_campaigns = []
+        missed = []
+        due = []
+        for _, message in self.scheduler.pop_due(now):
+            # Skip queue entries for messages that have since been changed or deleted, and campaigns that are
+            # already being sent
+            if not self._is_current(message) or isinstance(message, Campaign) and message.id in self._campaign_sends:
+                continue
+            # Messages being retried are as late as their scheduled time, not the time they were retried at
+            if now - message.fire_at > self.catch_up_window():
+                print("Skipping missed message:", message)
+                missed.append(message)
+            elif isinstance(message, Campaign):
+                now_campaigns.append(message)
+            else:
+                due.append(message)
+        if missed:
+            self._retire_missed(missed)
+        for message in self._drop_delivered(due):
+            # Messages that are late, e.g. after a restart, are sent behind those that are on time
+            self.send_queue.put(message, SendQueue.NORMAL if now - message.fire_at <= self.send_window()
+                                else SendQueue.BULK)
+
+        if now_campaigns:
+            # Sender workers (see Workers.py) may have taken some of the campaigns already
+            claimed = self.store.claim_campaigns([campaign.id for campaign in now_campaigns], self.owner, now,
+                                                 LEASE_SECONDS)
+            self._wait_for_leases([campaign for campaign in now_campaigns if campaign.id not in claimed],
+                                  self.store.campaign_lease_expiries)
+            now_campaigns = [campaign for campaign in now_campaigns if campaign.id in claimed]
+            for campaign in now_campaigns:
+                self._campaign_retries.pop(campaign.id, None)
+            for campaign in now_campaigns:
+                # Campaigns are expanded into individual messages as the send queue reads them
+                sending = self._campaign_sends[campaign.id] = CampaignSend(campaign, now + LEASE_SECONDS)
+                self.send_queue.put_stream(
+                    sending.expand(self.deliveries, not self.resend_unconfirmed, self._campaign_messages),
+                    SendQueue.BULK)
+        self._renew_campaign_leases()
+
+        batch = self.send_queue.next_batch(self.max_batch)
+        if not batch:
+            self._retire_sent_campaigns()
+            return
 
-            now_messages = [message for message in self.messages if Utils.within_time(message, wait_time, self.message_send_buffer)]
+        # Only send messages this process holds the lease on, so a message a sender worker has taken isn't sent
+        # twice
+        claimed = self.store.claim([part.id for _, parts in batch for part in parts if part.id is not None],
+                                   self.owner, Clock.clock.time(), LEASE_SECONDS)
+        leased_batch = []
+        unclaimed = []
+        for message, parts in batch:
+            if all(part.id is None or part.id in claimed for part in parts):
+                leased_batch.append((message, parts))
+            else:
+                self.store.release([part.id for part in parts if part.id in claimed], self.owner)
+                unclaimed += [part for part in parts if part.id is not None]
+                # Campaign messages have no lease of their own, so they go back in the queue
+                for part in parts:
+                    if part.id is None:
+                        self.send_queue.put(part, SendQueue.BULK)
+        batch = leased_batch
+        self._wait_for_leases(unclaimed, self.store.lease_expiries)
+
+        queued_messages = {id(message): parts for message, parts in batch}
+        sent_messages = []
+        failed_messages = []
+        # Each attempt is on disk before the message is handed over, so a message can't be sent twice
+        for message, error in self.transport.send_batch(self.deliveries.attempting(batch, self.owner)):
+            MESSAGES_SENT.inc(result="sent" if error is None else "failed")
+            observe_lateness(queued_messages[id(message)])
+            self.deliveries.record("sent" if error is None else "failed", queued_messages[id(message)], error,
+                                   self.owner)
+            # Campaign messages have no row of their own
+            for part in queued_messages[id(message)]:
+                if part.id is None:
+                    self._campaign_messages.pop(id(part)).pending -= 1
+            parts = [part for part in queued_messages[id(message)] if part.id is not None]
+            if error is not None:
+                print("Failed to send message:", message, error)
+            if parts:
+                self.events.publish("sent" if error is None else "failed", parts,
+                                    None if error is None else str(error))
+            if error is None:
+                sent_messages += parts
+            else:
+                failed_messages += parts
+
+        # Drop sent one-off messages and move recurring ones on to their next date
+        for message in sent_messages:
+            self._retries.pop(message.id, None)
+        still_scheduled = self.retire_old_messages(sent_messages, keep_due=False)
+        self.store.release([message.id for message in still_scheduled], self.owner)
+        self._replace_messages([message.id for message in sent_messages], still_scheduled)
+        if still_scheduled:
+            self.events.publish("rescheduled", still_scheduled)
+        if failed_messages:
+            self._retry(failed_messages)
+        self._retire_sent_campaigns()
+
+    def _renew_campaign_leases(self):
+        """
+        Keep the leases on the campaigns being sent, renewing them once they are half over.
+        """
+        now = Clock.clock.time()
+        renew = [sending for sending in self._campaign_sends.values()
+                 if sending.lease_expires - now < LEASE_SECONDS / 2]
+        if renew:
+            self.store.renew_campaigns([sending.campaign.id for sending in renew], self.owner, now, LEASE_SECONDS)
+            for sending in renew:
+                sending.lease_expires = now + LEASE_SECONDS
+
+    def _retire_sent_campaigns(self):
+        """
+        Move campaigns that every message has been sent for on to their next date, or drop them, and give up their
+        leases.
+        """
+        done = [sending.campaign for sending in self._campaign_sends.values() if sending.is_done()]
+        if not done:
+            return
+        for campaign in done:
+            del self._campaign_sends[campaign.id]
+        self.deliveries.record("sent", done, owner=self.owner)
+        still_scheduled = self.retire_old_campaigns(done, keep_due=False)
+        self.store.release_campaigns([campaign.id for campaign in still_scheduled], self.owner)
+        old_campaigns = self.campaigns
+        self._replace_campaigns([campaign.id for campaign in done], still_scheduled)
+        self._publish_changes(old_campaigns, self.campaigns, [campaign.id for campaign in done])
+
+    def _retry(self, messages):
+        """
+        Keep messages that failed to send, and schedule them to be tried again after a delay that doubles with each
+        failure. Those still failing once they are too late to catch up on are retired as missed.
+        """
+        now = Clock.clock.time()
+        for message in messages:
+            failures = self._retries.get(message.id, (0, None))[0] + 1
+            self._retries[message.id] = (failures, now + RETRY_SECONDS * 2 ** (failures - 1))
+            self._schedule_message(message)
+        self.store.release([message.id for message in messages], self.owner)
+
+    def _wait_for_leases(self, messages, lease_expiries):
+        """
+        Schedule messages or campaigns that couldn't be leased to be tried again once their leases run out, so
+        those held by a sender that has stopped are still sent. Those that nobody holds a lease on, e.g. because
+        another sender has just moved them on, are tried again after RETRY_SECONDS unless they are reloaded first.
+        :param lease_expiries: MessageStore.lease_expiries or campaign_lease_expiries.
+        """
+        if not messages:
+            return
+        expiries = lease_expiries([message.id for message in messages])
+        retry_after = Clock.clock.time() + RETRY_SECONDS
+        for message in messages:
+            # A lease can only be taken once it has expired, not at the moment it does
+            retry_at = expiries[message.id] + 1 if message.id in expiries else retry_after
+            if isinstance(message, Campaign):
+                self._campaign_retries[message.id] = retry_at
+            else:
+                self._retries[message.id] = (self._retries.get(message.id, (0, None))[0], retry_at)
+            self._schedule_message(message)
 
-            for message in now_messages:
-                # if first message
-                if message == now_messages[0]:
-                    # Send the message
-                    self.sendwhatmsg_instantly(message.recipient, message.message, self.message_send_buffer)
-                    time.sleep(1)
-                else:
-                    self.send_another(message.recipient, message.message)
-                    time.sleep(1)
-            self.delete_old_messages()
-            if len(now_messages) > 0:
-                pyautogui.hotkey("ctrl", "w")
-            time.sleep(wait_time)
+    def _drop_delivered(self, messages):
+        """
+        Retire the messages that the delivery log shows were already sent, or may have been, without sending them
+        again.
+        :return: The other messages.
+        """
+        if not messages:
+            return messages
+        delivered = self.deliveries.delivered(messages, include_unconfirmed=not self.resend_unconfirmed)
+        if not delivered:
+            return messages
+        sent = [message for message in messages if delivery_key(message) in delivered]
+        print("Skipping", len(sent), "messages that were already sent")
+        self.deliveries.record("skipped", sent, owner=self.owner)
+        self._retire_unsent(sent, "sent", "duplicate")
+        return [message for message in messages if delivery_key(message) not in delivered]
+
+    def _retire_missed(self, missed):
+        """
+        Drop missed one-off messages and campaigns, and move missed recurring ones on to their next date rather
+        than leave them unscheduled until the messages are next reloaded.
+        """
+        self.deliveries.record("missed", missed, owner=self.owner)
+        self._retire_unsent(missed, "missed", "missed")
 
-    def start(self):
-        self.thread = threading.Thread(target=self.send_messages)
+    def _retire_unsent(self, messages, event_type, result):
+        """
+        Retire messages and campaigns that are due but aren't being sent.
+        :param event_type: The event to publish the messages in.
+        :param result: Their result in MESSAGES_SENT.
+        """
+        MESSAGES_SENT.inc(len(messages), result=result)
+        self.events.publish(event_type, messages)
+        campaigns = [message for message in messages if isinstance(message, Campaign)]
+        messages = [message for message in messages if not isinstance(message, Campaign)]
+        for message in messages:
+            self._retries.pop(message.id, None)
+        if messages:
+            old_messages = self.messages
+            self._replace_messages([message.id for message in messages],
+                                   self.retire_old_messages(messages, keep_due=False))
+            self._publish_changes(old_messages, self.messages, [message.id for message in messages])
+        if campaigns:
+            old_campaigns = self.campaigns
+            self._replace_campaigns([campaign.id for campaign in campaigns],
+                                    self.retire_old_campaigns(campaigns, keep_due=False))
+            self._publish_changes(old_campaigns, self.campaigns, [campaign.id for campaign in campaigns])
+
+    def _finish(self):
+        # Changes queued while stopping are still saved. Any that can't be fail rather than leave their callers
+        # waiting for a sender that has stopped.
+        try:
+            self._apply_writes()
+        finally:
+            self.transport.close()
+            while True:
+                try:
+                    _, _, future = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                future.set_exception(RuntimeError("The sender has stopped"))
+
+    def start(self, send=True):
+        """
+        Start the sender thread.
+        :param send: If False, due messages are left for other processes, e.g. sender workers, to send.
+        """
+        self.thread = threading.Thread(target=self.send_messages, args=(send,))
         self.thread.daemon = True
         self.thread.start()
 
     def stop_thread(self):
         self.is_running = False
+        self.scheduler.wake()
 
 
 if __name__ == "__main__":
-    # Create messages.txt file if it doesn't exist
-    if not os.path.exists('messages.txt'):
-        open('messages.txt', 'w').close()
-
-    messageSender = MessageSender('messages.txt')
-    messageSender.start_thread()
+    messageSender = MessageSender('messages.db')
+    messageSender.start()
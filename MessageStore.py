@@ -0,0 +1,429 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+import Metrics
+from Campaign import Campaign
+from Message import Message
+
+# The number of changes kept for readers that are catching up with changes_since()
+CHANGE_LOG_SIZE = 10000
+
+OPERATION_SECONDS = Metrics.registry.histogram("store_operation_seconds", "Time spent in message store operations",
+                                               ("operation",))
+
+# Seconds a sender's lease on a message lasts. Once it expires another sender can take the message.
+LEASE_SECONDS = 120
+
+FIELDS = Message.FIELDS
+CAMPAIGN_FIELDS = ("message", "hour", "minute", "date", "repeat", "repeat_unit", "holiday")
+
+
+def recipient_shard(recipient):
+    """
+    Returns a stable hash of a recipient, so every process puts a recipient in the same shard.
+    """
+    return zlib.crc32((recipient or "").encode())
+
+
+class MessageStore:
+    """
+    An indexed, persistent store of scheduled messages backed by SQLite in WAL mode.
+
+    Each message is a row with its own id, and the time it is next due (fire_at, in epoch seconds) is indexed,
+    so inserts, deletes and "next due before T" queries are O(log n) and never rewrite the whole store.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path of the SQLite database file. It is created if it does not exist.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "recipient TEXT, message TEXT, hour TEXT, minute TEXT, date TEXT, "
+                "repeat TEXT, repeat_unit TEXT, holiday TEXT, fire_at REAL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS messages_fire_at ON messages (fire_at)")
+            # Every insert, update and delete is recorded here so readers can reload just the changed rows
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS message_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER)"
+            )
+            for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+                self._connection.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS messages_{event.lower()} AFTER {event} ON messages "
+                    f"BEGIN INSERT INTO message_changes (message_id) VALUES ({row}.id); END"
+                )
+            # Campaigns hold one template and a recipient list (as JSON) or group, however many recipients
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS campaigns ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "recipients TEXT, group_name TEXT, message TEXT, hour TEXT, minute TEXT, date TEXT, "
+                "repeat TEXT, repeat_unit TEXT, holiday TEXT, fire_at REAL)"
+            )
+            # Columns added since the tables were first made. Sender workers lease the rows they are sending, so no
+            # two workers send the same one (see Workers.py), and anchor is the date each recurring series started,
+            # which its dates are counted from (see Message.anchor).
+            for table in ("messages", "campaigns"):
+                columns = {row[1] for row in self._connection.execute(f"PRAGMA table_info({table})")}
+                for column, column_type in (("lease_owner", "TEXT"), ("lease_expires", "REAL"), ("anchor", "TEXT")):
+                    if column not in columns:
+                        self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        self._connection.create_function("recipient_shard", 1, recipient_shard, deterministic=True)
+
+    @staticmethod
+    def _values(message):
+        return ["" if value is None else str(value) for value in message.fields()] + [message.fire_at, message.anchor]
+
+    @staticmethod
+    def _to_message(row):
+        message = Message(*row[1:9], anchor=row[9])
+        message.id = row[0]
+        return message
+
+    def _select(self, where="", params=()):
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT id, {', '.join(FIELDS)}, anchor FROM messages {where}", params
+            ).fetchall()
+        return [self._to_message(row) for row in rows]
+
+    def add(self, message):
+        """
+        Insert a message and set its id.
+        :return: The id of the new row.
+        """
+        self.add_many([message])
+        return message.id
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="add_many")
+    def add_many(self, messages, campaigns=()):
+        """
+        Insert several messages, and optionally campaigns, in a single transaction, setting the id of each.
+        """
+        with self._lock, self._connection:
+            for message in messages:
+                cursor = self._connection.execute(
+                    f"INSERT INTO messages ({', '.join(FIELDS)}, fire_at, anchor) "
+                    f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self._values(message)
+                )
+                message.id = cursor.lastrowid
+            for campaign in campaigns:
+                self._insert_campaign(campaign)
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="update_many")
+    def update_many(self, messages):
+        """
+        Write back the fields of several existing messages in a single transaction.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"UPDATE messages SET {', '.join(f'{field} = ?' for field in FIELDS)}, fire_at = ?, anchor = ? "
+                f"WHERE id = ?",
+                [self._values(message) + [message.id] for message in messages]
+            )
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="delete_many")
+    def delete_many(self, ids):
+        """
+        Delete the messages with the given ids in a single transaction.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM messages WHERE id = ?", [(message_id,) for message_id in ids])
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="all")
+    def all(self):
+        """
+        Returns every stored message, earliest first.
+        """
+        return self._select("ORDER BY fire_at")
+
+    def due_before(self, timestamp):
+        """
+        Returns the messages due at or before the given epoch time, earliest first.
+        """
+        return self._select("WHERE fire_at <= ? ORDER BY fire_at", (timestamp,))
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="get_many")
+    def get_many(self, ids):
+        """
+        Returns the stored messages with the given ids. Ids that no longer exist are left out.
+        """
+        ids = list(ids)
+        messages = []
+        # Stay under SQLite's limit on the number of query parameters
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            messages += self._select(f"WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+        return messages
+
+    def last_change(self):
+        """
+        Returns the sequence number of the most recent change, to be passed to changes_since() later.
+        """
+        with self._lock:
+            return self._connection.execute("SELECT COALESCE(MAX(seq), 0) FROM message_changes").fetchone()[0]
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="changes_since")
+    def changes_since(self, seq):
+        """
+        Returns the ids of the messages that were inserted, updated or deleted after the given change.
+        :param seq: A sequence number from last_change() or a previous call to changes_since().
+        :return: A tuple of (the latest sequence number, a set of message ids), or (the latest sequence number,
+        None) if the changes have already been pruned and the caller has to reload everything.
+        """
+        with self._lock, self._connection:
+            oldest, latest = self._connection.execute(
+                "SELECT MIN(seq), COALESCE(MAX(seq), 0) FROM message_changes"
+            ).fetchone()
+            if oldest is not None and oldest > seq + 1:
+                return latest, None
+            ids = {row[0] for row in self._connection.execute(
+                "SELECT message_id FROM message_changes WHERE seq > ?", (seq,)
+            )}
+            # Keep the change log from growing without bound
+            self._connection.execute("DELETE FROM message_changes WHERE seq <= ?", (latest - CHANGE_LOG_SIZE,))
+        return latest, ids
+
+    def add_campaign(self, campaign):
+        """
+        Insert a campaign and set its id.
+        :return: The id of the new row.
+        """
+        with self._lock, self._connection:
+            self._insert_campaign(campaign)
+        return campaign.id
+
+    def _insert_campaign(self, campaign):
+        cursor = self._connection.execute(
+            f"INSERT INTO campaigns (recipients, group_name, {', '.join(CAMPAIGN_FIELDS)}, fire_at, anchor) "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            self._campaign_values(campaign)
+        )
+        campaign.id = cursor.lastrowid
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="update_campaigns")
+    def update_campaigns(self, campaigns):
+        """
+        Write back the fields of several existing campaigns in a single transaction.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"UPDATE campaigns SET recipients = ?, group_name = ?, "
+                f"{', '.join(f'{field} = ?' for field in CAMPAIGN_FIELDS)}, fire_at = ?, anchor = ? WHERE id = ?",
+                [self._campaign_values(campaign) + [campaign.id] for campaign in campaigns]
+            )
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="delete_campaigns")
+    def delete_campaigns(self, ids):
+        """
+        Delete the campaigns with the given ids in a single transaction.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM campaigns WHERE id = ?", [(campaign_id,) for campaign_id in ids])
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="all_campaigns")
+    def all_campaigns(self):
+        """
+        Returns every stored campaign, earliest first.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT id, recipients, group_name, {', '.join(CAMPAIGN_FIELDS)}, anchor FROM campaigns "
+                f"ORDER BY fire_at"
+            ).fetchall()
+        return [self._to_campaign(row) for row in rows]
+
+    @staticmethod
+    def _to_campaign(row):
+        campaign = Campaign(row[3], json.loads(row[1] or "[]"), row[2], *row[4:10], anchor=row[10])
+        campaign.id = row[0]
+        return campaign
+
+    @staticmethod
+    def _campaign_values(campaign):
+        values = [getattr(campaign, field) for field in CAMPAIGN_FIELDS]
+        return [json.dumps(campaign.recipients), campaign.group] + \
+            ["" if value is None else str(value) for value in values] + [campaign.fire_at, campaign.anchor]
+
+    def _claim(self, table, columns, owner, now, lease_seconds, where="", params=(), limit=50):
+        """
+        Lease up to limit due rows of a table that nobody holds a lease on, earliest first, in one statement so
+        that no two processes can lease the same row.
+        :return: The leased rows, with the given columns.
+        """
+        with self._lock, self._connection:
+            rows = self._connection.execute(
+                f"UPDATE {table} SET lease_owner = ?, lease_expires = ? WHERE id IN ("
+                f"SELECT id FROM {table} WHERE fire_at <= ? AND (lease_expires IS NULL OR lease_expires < ?) "
+                f"{where} ORDER BY fire_at LIMIT ?) RETURNING {columns}",
+                (owner, now + lease_seconds, now, now) + tuple(params) + (limit,)
+            ).fetchall()
+        return rows
+
+    def _release(self, table, ids, owner):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"UPDATE {table} SET lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ?",
+                [(row_id, owner) for row_id in ids]
+            )
+
+    def _lease_expiries(self, table, ids):
+        ids = list(ids)
+        if not ids:
+            return {}
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT id, lease_expires FROM {table} WHERE lease_expires IS NOT NULL "
+                f"AND id IN ({', '.join('?' * len(ids))})", ids
+            ).fetchall()
+        return dict(rows)
+
+    def _renew(self, table, ids, owner, now, lease_seconds):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"UPDATE {table} SET lease_expires = ? WHERE id = ? AND lease_owner = ?",
+                [(now + lease_seconds, row_id, owner) for row_id in ids]
+            )
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="claim_due")
+    def claim_due(self, owner, now, lease_seconds, shard_count=1, shard_index=0, takeover_before=None, limit=50):
+        """
+        Lease the due messages in one shard of the recipients.
+        :param owner: A name for the worker taking the lease.
+        :param now: The current epoch time.
+        :param lease_seconds: How long the lease lasts. Once it expires the messages can be leased again.
+        :param shard_count: The number of shards the recipients are split into.
+        :param shard_index: The shard to lease from.
+        :param takeover_before: Also lease messages from other shards that were due before this epoch time, e.g.
+        because the worker for their shard has stopped.
+        :param limit: The maximum number of messages to lease.
+        :return: The leased messages, earliest first.
+        """
+        where, params = "", ()
+        if shard_count > 1:
+            where = "AND (recipient_shard(recipient) % ? = ? OR fire_at < ?)"
+            params = (shard_count, shard_index, -1 if takeover_before is None else takeover_before)
+        rows = self._claim("messages", f"id, {', '.join(FIELDS)}, anchor", owner, now, lease_seconds, where, params,
+                           limit)
+        return sorted((self._to_message(row) for row in rows), key=lambda message: message.fire_at or 0)
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="claim")
+    def claim(self, ids, owner, now, lease_seconds):
+        """
+        Lease the due messages with the given ids that nobody else holds a lease on.
+        :return: The set of ids that were leased.
+        """
+        ids = list(ids)
+        if not ids:
+            return set()
+        rows = self._claim("messages", "id", owner, now, lease_seconds, f"AND id IN ({', '.join('?' * len(ids))})",
+                           ids, len(ids))
+        return {row[0] for row in rows}
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="release")
+    def release(self, ids, owner):
+        """
+        Give up the leases owner holds on the messages with the given ids.
+        """
+        self._release("messages", ids, owner)
+
+    def lease_expiries(self, ids):
+        """
+        Returns when the leases on the messages with the given ids run out, as {id: epoch time}, leaving out the
+        messages nobody holds a lease on.
+        """
+        return self._lease_expiries("messages", ids)
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="renew")
+    def renew(self, ids, owner, now, lease_seconds):
+        """
+        Extend the leases owner holds on the messages with the given ids, e.g. while they wait for the rate limits.
+        """
+        self._renew("messages", ids, owner, now, lease_seconds)
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="claim_due_campaigns")
+    def claim_due_campaigns(self, owner, now, lease_seconds, limit=1):
+        """
+        Lease due campaigns, like claim_due() but without shards.
+        """
+        rows = self._claim("campaigns", f"id, recipients, group_name, {', '.join(CAMPAIGN_FIELDS)}, anchor", owner,
+                           now, lease_seconds, limit=limit)
+        return [self._to_campaign(row) for row in rows]
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="claim_campaigns")
+    def claim_campaigns(self, ids, owner, now, lease_seconds):
+        """
+        Lease the due campaigns with the given ids that nobody else holds a lease on.
+        :return: The set of ids that were leased.
+        """
+        ids = list(ids)
+        if not ids:
+            return set()
+        rows = self._claim("campaigns", "id", owner, now, lease_seconds, f"AND id IN ({', '.join('?' * len(ids))})",
+                           ids, len(ids))
+        return {row[0] for row in rows}
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="release_campaigns")
+    def release_campaigns(self, ids, owner):
+        """
+        Give up the leases owner holds on the campaigns with the given ids.
+        """
+        self._release("campaigns", ids, owner)
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="renew_campaigns")
+    def renew_campaigns(self, ids, owner, now, lease_seconds):
+        """
+        Extend the leases owner holds on the campaigns with the given ids, e.g. while a long campaign is being sent.
+        """
+        self._renew("campaigns", ids, owner, now, lease_seconds)
+
+    def campaign_lease_expiries(self, ids):
+        """
+        Returns when the leases on the campaigns with the given ids run out, like lease_expiries().
+        """
+        return self._lease_expiries("campaigns", ids)
+
+    def next_due_time(self):
+        """
+        Returns the epoch time of the earliest stored message, or None if there are none.
+        """
+        with self._lock:
+            return self._connection.execute("SELECT MIN(fire_at) FROM messages").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    @Metrics.timed_method(OPERATION_SECONDS, operation="migrate_from_text")
+    def migrate_from_text(self, messages_file):
+        """
+        One-shot import of a legacy comma-separated messages file. The file is renamed to <name>.migrated
+        afterwards so it is never imported twice.
+        :param messages_file: The path of the legacy messages file.
+        :return: The number of messages imported.
+        """
+        if not os.path.exists(messages_file):
+            return 0
+
+        messages = []
+        with open(messages_file, 'r', encoding='UTF-8') as f:
+            for line in f:
+                if len(line) > 5:
+                    messages.append(Message(csv_line=line))
+        self.add_many(messages)
+        os.replace(messages_file, messages_file + ".migrated")
+        return len(messages)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,254 @@
+"""
+Counters, gauges and histograms for the /metrics endpoint in the Prometheus text format, and optional trace spans
+for /trace in the Chrome trace format (open the JSON in chrome://tracing or https://ui.perfetto.dev).
+
+Modules define their metrics once at import, e.g.
+    TICK_SECONDS = Metrics.registry.histogram("scheduler_tick_seconds", "How long each sender tick takes")
+and time their hot paths with Metrics.timed(), which also records a trace span while tracing is on.
+"""
+import bisect
+import collections
+import contextlib
+import functools
+import math
+import os
+import threading
+import time
+
+# Histogram buckets in seconds, from a quick store write to a slow browser send
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# The number of spans kept for /trace. Older spans are dropped.
+TRACE_SIZE = 20000
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [(name, value) for name, value in zip(names, values)] + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    A metric with a value for each combination of label values.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def set_function(self, function):
+        """
+        Read the metric from a function when the metrics are collected, instead of keeping a value. The function
+        returns a number, or for a metric with labels a {label values tuple: number} dict.
+        """
+        self._function = function
+        return self
+
+    def samples(self):
+        """
+        Returns the lines of the metric in the Prometheus text format.
+        """
+        if self._function is not None:
+            values = self._function()
+            values = values if isinstance(values, dict) else {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in sorted(values.items()) if value is not None]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # A count for each bucket and +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        lines = []
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    The metrics exposed on /metrics. Asking for a metric that already exists returns it.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_type, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_type(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    """
+    Records timed spans while enabled, e.g. each send and its steps, for viewing as a Chrome trace. It is off
+    unless the MESSAGE_TRACE environment variable is set or it is turned on through /trace, and costs nothing
+    while off.
+    """
+
+    def __init__(self, size=TRACE_SIZE):
+        self.enabled = bool(os.environ.get("MESSAGE_TRACE"))
+        self._spans = collections.deque(maxlen=size)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._spans.append({
+                "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": round(start * 1000000), "dur": round((end - start) * 1000000), "args": args,
+            })
+
+    def clear(self):
+        self._spans.clear()
+
+    def chrome_trace(self):
+        """
+        Returns the recorded spans in the Chrome trace event format.
+        """
+        return {"traceEvents": list(self._spans), "displayTimeUnit": "ms"}
+
+
+registry = Registry()
+tracer = Tracer()
+
+# Reading and writing files other than the message store, e.g. the contact CSVs and the holiday store
+FILE_IO_SECONDS = registry.histogram("file_io_seconds", "Time spent reading and writing files",
+                                     ("file", "operation"))
+FILE_IO_BYTES = registry.counter("file_io_bytes_total", "Bytes read and written", ("file", "operation"))
+
+
+@contextlib.contextmanager
+def timed(histogram, span=None, **labels):
+    """
+    Observe how long a block takes in a histogram, and record it as a trace span while tracing.
+    :param histogram: The Histogram to observe the time in.
+    :param span: The name of the span. Defaults to the values of the labels, or the histogram's name if it has none.
+    :param labels: The histogram's labels, which are also the span's arguments.
+    """
+    start = time.perf_counter()
+    with tracer.span(span or " ".join(map(str, labels.values())) or histogram.name, **labels):
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start, **labels)
+
+
+def timed_method(histogram, **labels):
+    """
+    A decorator that times every call of a function with timed().
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(histogram, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def file_io(file, operation, path):
+    """
+    Time reading or writing a file, then count its size in bytes.
+    :param file: What the file is, e.g. "contacts".
+    :param operation: "read" or "write".
+    :param path: The path of the file.
+    """
+    with timed(FILE_IO_SECONDS, f"{operation} {file}", file=file, operation=operation):
+        yield
+    try:
+        FILE_IO_BYTES.inc(os.path.getsize(path), file=file, operation=operation)
+    except OSError:
+        pass
@@ -0,0 +1,85 @@
+import collections
+import functools
+import re
+
+# Numbers without a country code are taken to be from this country
+DEFAULT_COUNTRY = "GB"
+
+# How a country writes its phone numbers: the country calling code, the trunk prefix dialled before national
+# numbers (replaced by the calling code), and the lengths of a national number without the trunk prefix.
+DiallingRule = collections.namedtuple("DiallingRule", ["calling_code", "trunk_prefix", "national_lengths"])
+
+DIALLING_RULES = {
+    "GB": DiallingRule("44", "0", (9, 10)),
+    "IE": DiallingRule("353", "0", (7, 8, 9)),
+    "US": DiallingRule("1", "1", (10,)),
+    "CA": DiallingRule("1", "1", (10,)),
+    "FR": DiallingRule("33", "0", (9,)),
+    "DE": DiallingRule("49", "0", (6, 7, 8, 9, 10, 11)),
+    "ES": DiallingRule("34", "", (9,)),
+    "IT": DiallingRule("39", "", (6, 7, 8, 9, 10, 11)),
+    "NL": DiallingRule("31", "0", (9,)),
+    "BE": DiallingRule("32", "0", (8, 9)),
+    "PT": DiallingRule("351", "", (9,)),
+    "PL": DiallingRule("48", "", (9,)),
+    "IN": DiallingRule("91", "0", (10,)),
+    "AU": DiallingRule("61", "0", (9,)),
+    "NZ": DiallingRule("64", "0", (8, 9, 10)),
+    "ZA": DiallingRule("27", "0", (9,)),
+    "BR": DiallingRule("55", "0", (10, 11)),
+    "MX": DiallingRule("52", "", (10,)),
+}
+
+# Spaces, dashes, dots, slashes and brackets people put in numbers
+_FORMATTING = re.compile(r"[\s\-./()]")
+_DIGITS = re.compile(r"\+?\d+")
+
+
+@functools.lru_cache(maxsize=65536)
+def normalise(number, country=DEFAULT_COUNTRY):
+    """
+    Returns a phone number in E.164 format (e.g. "+447700900123").
+
+    Formatting characters are removed, an international "00" prefix becomes "+", and a national number has its
+    trunk prefix replaced by the country's calling code. Anything that doesn't look like a phone number, such as
+    a campaign's recipient description, is returned stripped but otherwise unchanged.
+    :param number: The phone number as written.
+    :param country: The ISO 3166-1 alpha-2 code of the country to read national numbers as.
+    """
+    if not isinstance(number, str):
+        return number
+    number = number.strip()
+    digits = _FORMATTING.sub("", number)
+    if not _DIGITS.fullmatch(digits):
+        return number
+
+    if digits.startswith("+"):
+        return digits
+    if digits.startswith("00"):
+        return "+" + digits[2:]
+
+    rule = DIALLING_RULES.get(country.upper())
+    if rule is None:
+        return digits
+    if rule.trunk_prefix and digits.startswith(rule.trunk_prefix):
+        return "+" + rule.calling_code + digits[len(rule.trunk_prefix):]
+    if len(digits) in rule.national_lengths:
+        return "+" + rule.calling_code + digits
+    if digits.startswith(rule.calling_code) and len(digits) - len(rule.calling_code) in rule.national_lengths:
+        # Written with the country code but without the +
+        return "+" + digits
+    return digits
+
+
+def normalise_many(numbers, country=DEFAULT_COUNTRY):
+    """
+    Normalise a whole column of phone numbers at once. Each distinct number is only normalised once.
+    :return: A list of the normalised numbers, in the same order.
+    """
+    normalised = {}
+    result = []
+    for number in numbers:
+        if number not in normalised:
+            normalised[number] = normalise(number, country)
+        result.append(normalised[number])
+    return result
@@ -0,0 +1,132 @@
+import calendar
+import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Repeat units that are a fixed number of days apart, and the number of days in one of each
+DAY_UNITS = {"d": 1, "w": 7}
+# Repeat units that are a number of calendar months apart, and the number of months in one of each
+MONTH_UNITS = {"m": 1, "y": 12}
+
+
+def _repeat_count(repeat):
+    """
+    Returns the number of units between occurrences. The UI sends 0 when no repeat count is entered, which means
+    every unit.
+    """
+    try:
+        return max(int(repeat), 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+def add_months(start, months):
+    """
+    Returns the datetime the given number of calendar months after start. If the day of the month doesn't exist
+    in the target month (e.g. the 31st), the last day of that month is used instead.
+    """
+    month_index = start.year * 12 + start.month - 1 + months
+    year, month = divmod(month_index, 12)
+    day = min(start.day, calendar.monthrange(year, month + 1)[1])
+    return start.replace(year=year, month=month + 1, day=day)
+
+
+def next_occurrence(start, repeat_unit, repeat, after):
+    """
+    Returns the first occurrence of a recurring schedule strictly after a given time, in constant time however
+    far behind the schedule is.
+    :param start: The datetime of the first occurrence.
+    :param repeat_unit: 'y', 'm', 'w' or 'd'. Any other unit only occurs once, at start.
+    :param repeat: The number of units between occurrences.
+    :param after: The datetime to find the next occurrence after.
+    :return: A datetime, or None if the schedule has no occurrences after the given time.
+    """
+    if start > after:
+        return start
+
+    count = _repeat_count(repeat)
+    if repeat_unit in DAY_UNITS:
+        step = datetime.timedelta(days=count * DAY_UNITS[repeat_unit])
+        return start + ((after - start) // step + 1) * step
+
+    if repeat_unit in MONTH_UNITS:
+        months = count * MONTH_UNITS[repeat_unit]
+        elapsed = (after.year - start.year) * 12 + after.month - start.month
+        steps = max(elapsed // months, 0)
+        # The month difference can overshoot by the days and times within the months, so step at most twice more
+        occurrence = add_months(start, steps * months)
+        while occurrence <= after:
+            steps += 1
+            occurrence = add_months(start, steps * months)
+        return occurrence
+
+    return None
+
+
+def next_occurrences(starts, repeat_units, repeats, after, count):
+    """
+    Expands the next occurrences of many recurring schedules at once. Uses NumPy datetime64 arithmetic when
+    NumPy is installed.
+    :param starts: The datetimes of the first occurrence of each schedule.
+    :param repeat_units: The repeat unit of each schedule.
+    :param repeats: The repeat count of each schedule.
+    :param after: The datetime to find the next occurrences after.
+    :param count: The number of occurrences to expand for each schedule.
+    :return: A list with a list of up to count datetimes for each schedule.
+    """
+    if np is None:
+        return [_next_occurrences(start, repeat_unit, repeat, after, count)
+                for start, repeat_unit, repeat in zip(starts, repeat_units, repeats)]
+
+    starts = np.array(starts, dtype="datetime64[m]")
+    units = np.array(repeat_units, dtype=object)
+    counts = np.array([_repeat_count(repeat) for repeat in repeats], dtype=np.int64)
+    after = np.datetime64(after, "m")
+    steps = np.arange(count, dtype=np.int64)
+    occurrences = np.full((len(starts), count), np.datetime64("NaT"), dtype="datetime64[m]")
+
+    # Schedules that only occur once
+    once = ~np.isin(units, list(DAY_UNITS) + list(MONTH_UNITS)) & (starts > after)
+    occurrences[once, 0] = starts[once]
+
+    days = np.isin(units, list(DAY_UNITS))
+    if days.any():
+        step = counts[days] * np.where(units[days] == "w", 7, 1) * 1440
+        elapsed = (after - starts[days]).astype(np.int64)
+        first = np.where(starts[days] > after, 0, elapsed // step + 1)
+        occurrences[days] = starts[days, None] + ((first[:, None] + steps) * step[:, None]).astype("timedelta64[m]")
+
+    months = np.isin(units, list(MONTH_UNITS))
+    if months.any():
+        step = (counts[months] * np.where(units[months] == "y", 12, 1))[:, None]
+        start_month = starts[months].astype("datetime64[M]")[:, None]
+        start_day = starts[months].astype("datetime64[D]")[:, None]
+        day_offset = start_day - start_month.astype("datetime64[D]")
+        time_of_day = starts[months, None] - start_day
+
+        def occurrence(k):
+            # Clamp days that don't exist in the target month to its last day
+            month = start_month + (k * step).astype("timedelta64[M]")
+            day = np.minimum(month.astype("datetime64[D]") + day_offset, (month + 1).astype("datetime64[D]") - 1)
+            return day.astype("datetime64[m]") + time_of_day
+
+        elapsed = (after.astype("datetime64[M]") - start_month).astype(np.int64)
+        first = np.maximum(elapsed // step, 0)
+        # The month difference can overshoot by the days and times within the months, so step at most twice more
+        for _ in range(2):
+            first = np.where(occurrence(first) <= after, first + 1, first)
+        occurrences[months] = occurrence(first + steps)
+
+    return [[value.astype(datetime.datetime) for value in row if not np.isnat(value)] for row in occurrences]
+
+
+def _next_occurrences(start, repeat_unit, repeat, after, count):
+    occurrences = []
+    occurrence = next_occurrence(start, repeat_unit, repeat, after)
+    while occurrence is not None and len(occurrences) < count:
+        occurrences.append(occurrence)
+        occurrence = next_occurrence(start, repeat_unit, repeat, occurrence)
+    return occurrences
@@ -0,0 +1,99 @@
+import heapq
+import itertools
+import threading
+
+import Clock
+
+
+class Scheduler:
+    """
+    A priority queue of messages keyed on the time they are next due to be sent.
+
+    The earliest message is always at the top of the heap, so the sender thread can sleep until exactly that
+    moment instead of polling the whole message list. Pushing a message that is due sooner than the current
+    earliest one wakes any thread blocked in wait_until_due() so it can re-arm its timer.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        # Set by wake() so a wake-up isn't lost when no thread is waiting yet
+        self._woken = False
+
+    def __len__(self):
+        with self._condition:
+            return len(self._heap)
+
+    def push(self, fire_at, message):
+        """
+        Add a message to the queue.
+        :param fire_at: The epoch time (in seconds) the message is due.
+        :param message: The message to send.
+        """
+        with self._condition:
+            is_earliest = not self._heap or fire_at < self._heap[0][0]
+            # The counter breaks ties so messages themselves are never compared
+            heapq.heappush(self._heap, (fire_at, next(self._counter), message))
+            if is_earliest:
+                self._condition.notify_all()
+
+    def rebuild(self, entries):
+        """
+        Replace the contents of the queue.
+        :param entries: An iterable of (fire_at, message) pairs.
+        """
+        with self._condition:
+            self._heap = [(fire_at, next(self._counter), message) for fire_at, message in entries]
+            heapq.heapify(self._heap)
+            self._condition.notify_all()
+
+    def next_due_time(self):
+        """
+        Returns the epoch time of the earliest message, or None if the queue is empty.
+        """
+        with self._condition:
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """
+        Remove and return every message that is due at or before now.
+        :param now: The epoch time to compare against. Defaults to the current time.
+        :return: A list of (fire_at, message) pairs in the order they became due.
+        """
+        if now is None:
+            now = Clock.clock.time()
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, _, message = heapq.heappop(self._heap)
+                due.append((fire_at, message))
+        return due
+
+    def wait_until_due(self, timeout=None):
+        """
+        Block until the earliest message is due, a sooner message is pushed, wake() is called or the timeout
+        expires, whichever happens first. Due messages are left in the queue for pop_due().
+        :param timeout: The maximum number of seconds to wait, or None to wait indefinitely.
+        """
+        with self._condition:
+            if self._woken:
+                self._woken = False
+                return
+            now = Clock.clock.time()
+            wait_until = self._heap[0][0] if self._heap else None
+            if timeout is not None and (wait_until is None or now + timeout < wait_until):
+                wait_until = now + timeout
+            if wait_until is None:
+                self._condition.wait()
+            elif wait_until > now:
+                self._condition.wait(wait_until - now)
+            self._woken = False
+
+    def wake(self):
+        """
+        Wake any thread blocked in wait_until_due(), or make the next call return at once if none is.
+        """
+        with self._condition:
+            self._woken = True
+            self._condition.notify_all()
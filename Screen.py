@@ -0,0 +1,137 @@
+import collections
+import time
+
+import pyautogui
+
+# A screen position (as percentages of the screen size, like Utils.get_coord) and the colour expected there when
+# a part of WhatsApp Web is ready. Use get_coords.py to find the position and colour on your screen.
+PixelSignature = collections.namedtuple("PixelSignature", ["percent_x", "percent_y", "rgb", "tolerance"])
+
+# The message box at the bottom of an open chat. It is white in every chat, including the one open before the next
+# is picked, so it is only waited for after it has changed (see ScreenProvider.wait_until).
+CHAT_READY = (PixelSignature(61.66666666666667, 95.0, (255, 255, 255), 12),)
+
+# The first result under the search box once a search has finished. The chat list under it is white before the
+# search too, so this is also only waited for after it has changed.
+SEARCH_RESULT_READY = (PixelSignature(16.40625, 27.777777777777775, (255, 255, 255), 12),)
+
+# Seconds between polls while waiting for the screen to change
+CHANGE_INTERVAL = 0.02
+
+
+class ScreenProvider:
+    """
+    Reads the screen, so the GUI transport can check whether WhatsApp Web is ready instead of sleeping.
+    """
+
+    def size(self):
+        """
+        Returns the (width, height) of the screen in pixels.
+        """
+        raise NotImplementedError
+
+    def pixel(self, x, y):
+        """
+        Returns the (r, g, b) colour of the pixel at (x, y).
+        """
+        raise NotImplementedError
+
+    def coord(self, percent_x, percent_y):
+        """
+        Returns the pixel position of a point given as percentages of the screen size.
+        """
+        width, height = self.size()
+        return (width / 100) * percent_x, (height / 100) * percent_y
+
+    def read(self, signatures):
+        """
+        Returns the (r, g, b) colours of the screen at the positions of some pixel signatures.
+        """
+        colours = []
+        for signature in signatures:
+            x, y = self.coord(signature.percent_x, signature.percent_y)
+            colours.append(tuple(self.pixel(int(x), int(y))))
+        return colours
+
+    @staticmethod
+    def _close(signatures, colours, expected_colours):
+        # True if every colour is within its signature's tolerance of the expected one
+        return all(all(abs(actual - expected) <= signature.tolerance for actual, expected in zip(rgb, expected_rgb))
+                   for signature, rgb, expected_rgb in zip(signatures, colours, expected_colours))
+
+    def _matches(self, signatures, colours):
+        return self._close(signatures, colours, [signature.rgb for signature in signatures])
+
+    def matches(self, signatures):
+        """
+        Returns True if every pixel signature matches the screen.
+        """
+        return self._matches(signatures, self.read(signatures))
+
+    def wait_until(self, signatures, timeout, interval=0.25, changed_from=None):
+        """
+        Poll the screen until every pixel signature matches or the timeout expires.
+        :param changed_from: The colours read() returned before the click or key press that brings up what is waited
+        for. The signatures then only count once the screen has changed from them, so a screen that already matched
+        before, e.g. the previous chat, isn't mistaken for the next. The change may be short, e.g. while a chat
+        loads, so the screen is polled more often until it is seen.
+        :return: True if the signatures matched, False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        changed = changed_from is None
+        while True:
+            colours = self.read(signatures)
+            changed = changed or not self._close(signatures, colours, changed_from)
+            if changed and self._matches(signatures, colours):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval if changed else min(interval, CHANGE_INTERVAL))
+
+
+class PyAutoGuiScreen(ScreenProvider):
+    """
+    Reads the real screen with pyautogui. The screen size is read once, and pixels are read by capturing just a
+    1x1 region rather than the whole screen.
+    """
+
+    def __init__(self):
+        self._size = None
+
+    def size(self):
+        if self._size is None:
+            self._size = tuple(pyautogui.size())
+        return self._size
+
+    def pixel(self, x, y):
+        return pyautogui.screenshot(region=(x, y, 1, 1)).getpixel((0, 0))[:3]
+
+
+class FakeScreen(ScreenProvider):
+    """
+    An in-memory framebuffer for testing. Every pixel starts as the background colour, and regions can be
+    painted to simulate WhatsApp Web becoming ready.
+    """
+
+    def __init__(self, width=1920, height=1080, background=(0, 0, 0)):
+        self.width = width
+        self.height = height
+        self.background = background
+        self.pixels = {}
+
+    def size(self):
+        return self.width, self.height
+
+    def pixel(self, x, y):
+        return self.pixels.get((x, y), self.background)
+
+    def paint(self, signatures):
+        """
+        Paint the pixels described by the given signatures, so they match.
+        """
+        for signature in signatures:
+            x, y = self.coord(signature.percent_x, signature.percent_y)
+            self.pixels[(int(x), int(y))] = signature.rgb
+
+    def clear(self):
+        self.pixels = {}
@@ -0,0 +1,217 @@
+import collections
+import heapq
+import itertools
+import threading
+
+import Clock
+from Message import Message
+
+# Priority classes. Lower values are sent first.
+HIGH = 0
+NORMAL = 1
+BULK = 2
+
+
+class TokenBucket:
+    """
+    Allows up to capacity sends at once, refilling at rate sends per second.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = Clock.clock.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Returns the number of seconds until a send is allowed, 0 if one is allowed now.
+        """
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Entry:
+    __slots__ = ("priority", "seq", "message", "taken")
+
+    def __init__(self, priority, seq, message):
+        self.priority = priority
+        self.seq = seq
+        self.message = message
+        self.taken = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SendQueue:
+    """
+    Holds due messages between the scheduler and the transport, and releases them in batches.
+
+    Messages are released highest priority first, then in the order they were queued, within a global token bucket
+    and a token bucket per recipient so bursts drain at a predictable rate. When a message is released, every other
+    queued message to the same recipient is merged into it and sent as one.
+
+    Campaigns can be queued as streams, which are only read when the queue runs low.
+    """
+
+    def __init__(self, rate=10.0, burst=20, recipient_rate=0.2, recipient_burst=3, coalesce=True, lookahead=100):
+        """
+        :param rate: The maximum average number of sends per second.
+        :param burst: The number of sends that may go at once after a quiet period.
+        :param recipient_rate: The maximum average number of sends per second to any one recipient.
+        :param recipient_burst: The number of sends to one recipient that may go at once.
+        :param coalesce: Whether to merge queued messages to the same recipient.
+        :param lookahead: The number of messages to read ahead from queued streams.
+        """
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.coalesce = coalesce
+        self.lookahead = lookahead
+        self._bucket = TokenBucket(rate, burst)
+        self._recipient_buckets = {}
+        self._heap = []
+        self._by_recipient = collections.defaultdict(list)
+        self._streams = collections.deque()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._released = collections.deque()
+        self.sent = 0
+        self.coalesced = 0
+
+    def put(self, message, priority=NORMAL):
+        """
+        Queue a message to send.
+        """
+        with self._lock:
+            self._push(message, priority)
+
+    def put_stream(self, messages, priority=BULK):
+        """
+        Queue an iterable of messages, e.g. an expanding campaign, without reading it all in.
+        """
+        with self._lock:
+            self._streams.append((priority, iter(messages)))
+
+    def _push(self, message, priority):
+        entry = _Entry(priority, next(self._counter), message)
+        heapq.heappush(self._heap, entry)
+        self._by_recipient[message.recipient].append(entry)
+        self._pending += 1
+
+    def _refill(self):
+        while self._streams and self._pending < self.lookahead:
+            priority, stream = self._streams[0]
+            message = next(stream, None)
+            if message is None:
+                self._streams.popleft()
+            else:
+                self._push(message, priority)
+
+    def _recipient_bucket(self, recipient):
+        bucket = self._recipient_buckets.get(recipient)
+        if bucket is None:
+            bucket = self._recipient_buckets[recipient] = TokenBucket(self.recipient_rate, self.recipient_burst)
+        return bucket
+
+    def next_batch(self, max_size=50):
+        """
+        Release the messages that can be sent now.
+        :param max_size: The maximum number of sends to release.
+        :return: A list of (message to send, list of the queued messages it was merged from) pairs.
+        """
+        now = Clock.clock.monotonic()
+        batch = []
+        deferred = []
+        with self._lock:
+            self._refill()
+            while self._heap and len(batch) < max_size and self._bucket.wait_time(now) == 0:
+                entry = heapq.heappop(self._heap)
+                if entry.taken:
+                    continue
+                recipient = entry.message.recipient
+                recipient_bucket = self._recipient_bucket(recipient)
+                if recipient_bucket.wait_time(now) > 0:
+                    deferred.append(entry)
+                    continue
+
+                if self.coalesce:
+                    entries = sorted(queued for queued in self._by_recipient.pop(recipient) if not queued.taken)
+                else:
+                    entries = [entry]
+                    self._by_recipient[recipient].remove(entry)
+                    if not self._by_recipient[recipient]:
+                        del self._by_recipient[recipient]
+                for queued in entries:
+                    queued.taken = True
+                self._pending -= len(entries)
+                self.coalesced += len(entries) - 1
+
+                self._bucket.take(now)
+                recipient_bucket.take(now)
+                parts = [queued.message for queued in entries]
+                if len(parts) == 1:
+                    batch.append((parts[0], parts))
+                else:
+                    merged = Message(recipient, "\n".join(part.message for part in parts))
+                    # A merged send is as late as its earliest part
+                    merged.fire_at = min((part.fire_at for part in parts if part.fire_at is not None), default=None)
+                    batch.append((merged, parts))
+                self._refill()
+
+            for entry in deferred:
+                heapq.heappush(self._heap, entry)
+
+            self.sent += len(batch)
+            self._released.extend([now] * len(batch))
+            self._prune(now)
+        return batch
+
+    def _prune(self, now):
+        while self._released and self._released[0] < now - 60:
+            self._released.popleft()
+        # A full bucket is the same as a new one, so only keep buckets that are limiting someone
+        if len(self._recipient_buckets) > 10000:
+            self._recipient_buckets = {recipient: bucket for recipient, bucket in self._recipient_buckets.items()
+                                       if not bucket.is_full(now)}
+
+    def time_until_ready(self):
+        """
+        Returns the number of seconds until next_batch() can release a message, 0 if it can now, or None if the
+        queue is empty.
+        """
+        now = Clock.clock.monotonic()
+        with self._lock:
+            if not self._pending and not self._streams:
+                return None
+            recipient_wait = min((self._recipient_bucket(recipient).wait_time(now)
+                                  for recipient in self._by_recipient), default=0)
+            return max(self._bucket.wait_time(now), recipient_wait)
+
+    def stats(self):
+        """
+        Returns the backlog depth and throughput of the queue.
+        """
+        now = Clock.clock.monotonic()
+        with self._lock:
+            self._prune(now)
+            return {
+                "backlog": self._pending,
+                "streams": len(self._streams),
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "sent_last_minute": len(self._released),
+            }
@@ -0,0 +1,194 @@
+"""
+The production serving mode: the web UI and the scheduler share one asyncio event loop under an ASGI server.
+
+Run it with `python Server.py [port] [workers]`, or with any ASGI server, e.g. `uvicorn Server:app --workers 4`.
+Every worker serves the web UI, but only the one holding the leader lock sends messages. The others keep their
+messages up to date from the shared message store, and one of them takes over within a few seconds if the leader
+exits. With MESSAGE_SEND_FROM_WORKERS=1 none of them sends, and the sender workers of Workers.py do. On shutdown the
+leader finishes the batch it is sending before it exits, and messages that were due but not yet sent are still in
+the message store, so they are sent after the restart.
+"""
+import asyncio
+import os
+import sys
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+import Assets
+import main
+from ContactIndex import ContactIndex
+from MessageSender import SEND_FROM_WORKERS, MessageSender
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks (e.g. on Windows) every worker would send, so run a single worker
+    fcntl = None
+
+MESSAGES_FILE = "messages.db"
+
+# The number of seconds to wait for the leader to finish sending when shutting down
+DRAIN_TIMEOUT = 60
+
+
+class LeaderLock:
+    """
+    An exclusive lock on a file that at most one process holds. The operating system releases it when the
+    holder exits, however it exits, so another process can take over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """
+        Try to take the lock without waiting.
+        :return: True if this process holds the lock.
+        """
+        if self._file is not None or fcntl is None:
+            return True
+        lock_file = open(self.path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        print("This worker is now sending messages (pid", os.getpid(), ")")
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Server:
+    """
+    An ASGI application. The holiday routes are served asynchronously, so lookups that wait on Calendarific run
+    off the event loop, and every other route is served by the Flask app in main.py.
+    """
+
+    def __init__(self, messages_file=MESSAGES_FILE):
+        self.messages_file = messages_file
+        self.wsgi = WsgiToAsgi(main.app)
+        self.leader_lock = LeaderLock(messages_file + ".leader")
+        self.scheduler_task = None
+        self.async_routes = {
+            "/holidays": self.holidays,
+            "/holiday_date": self.holiday_date,
+            "/events": self.events,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http" and scope["path"] in self.async_routes:
+            await self.async_routes[scope["path"]](scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self):
+        # Loading the messages and contacts reads files, so keep it off the event loop
+        main.message_sender = await asyncio.to_thread(MessageSender, self.messages_file)
+        main.contact_index = ContactIndex()
+        await asyncio.to_thread(Assets.bundle.load)
+        # With sender workers, no worker of the server sends. They only keep their messages up to date.
+        is_leader = (lambda: False) if SEND_FROM_WORKERS else self.leader_lock.acquire
+        self.scheduler_task = asyncio.create_task(main.message_sender.run(is_leader))
+
+    async def shutdown(self):
+        """
+        Stop the scheduler, letting a batch that is being sent finish.
+        """
+        main.message_sender.stop_thread()
+        try:
+            await asyncio.wait_for(self.scheduler_task, DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("Gave up waiting for the sender to finish")
+        self.leader_lock.release()
+
+    @staticmethod
+    def _query(scope):
+        query = parse_qs(scope["query_string"].decode())
+        return {name: values[0] for name, values in query.items()}
+
+    @staticmethod
+    async def _respond(send, body, status):
+        # The same content type as Flask gives the other routes
+        body = body.encode()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"text/html; charset=utf-8"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def holidays(self, scope, receive, send):
+        query = self._query(scope)
+        await self._respond(send, *await asyncio.to_thread(main.holiday_names, query.get("country_code")))
+
+    async def holiday_date(self, scope, receive, send):
+        query = self._query(scope)
+        await self._respond(send, *await asyncio.to_thread(main.holiday_date, query.get("country_code"),
+                                                           query.get("holiday")))
+
+    async def events(self, scope, receive, send):
+        """
+        The /events stream of main.py, waiting for events on the event loop rather than holding a thread per
+        browser.
+        """
+        bus = main.message_sender.events
+        last_event_id = dict(scope["headers"]).get(b"last-event-id", b"").decode()
+        seq = main.event_seq(last_event_id or self._query(scope).get("after"))
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                                (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]})
+
+        disconnected = asyncio.ensure_future(self._disconnected(receive))
+        deadline = time.monotonic() + main.EVENTS_STREAM_SECONDS
+        events = None if seq is None else bus.since(seq)
+        try:
+            while True:
+                # Encoding an event looks up contact names, which may load the contacts
+                text, seq = await asyncio.to_thread(main.event_text, seq, events)
+                await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+                if time.monotonic() > deadline:
+                    break
+                waiting = asyncio.ensure_future(bus.wait_async(seq, main.EVENTS_KEEPALIVE))
+                await asyncio.wait((waiting, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiting.cancel()
+                    return
+                events = waiting.result()
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+
+    @staticmethod
+    async def _disconnected(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+
+app = Server()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    uvicorn.run("Server:app", host="0.0.0.0", port=port, workers=workers)
@@ -0,0 +1,250 @@
+"""
+Replays a message store against a virtual clock, as fast as it can run, to plan capacity before big campaigns and
+to check that recurring messages land on the right dates across month and year boundaries.
+
+Run it with `python Simulation.py [messages.db] --days 365 --latency 40 --senders 1`. The store is copied first,
+so it is never changed. Sends take --latency virtual seconds each on each of --senders senders, and the send queue
+uses the given rate limits. The report gives sends per hour, the peak backlog, late and missed sends, and any
+recurring message whose sends drifted from its schedule.
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import Clock
+import Recurrence
+import SendQueue
+import Transport
+from EventBus import EventBus
+from MessageSender import MessageSender
+from Watcher import FileWatcher
+
+# Repeat units whose dates can be checked without looking up holidays
+CHECKED_UNITS = ("d", "w", "m", "y")
+
+# The number of events kept between ticks
+EVENT_HISTORY = 100000
+
+# How far the clock is moved on if a tick leaves something due at the time it ran
+STALL_SECONDS = 1
+
+
+class SimulatedTransport(Transport.Transport):
+    """
+    Sends nothing, but takes latency seconds of virtual time for each message on each of several senders working
+    in parallel, and records when each message would have been sent.
+    """
+
+    def __init__(self, clock, latency=40.0, senders=1):
+        """
+        :param clock: The VirtualClock to move on as messages are sent.
+        :param latency: The number of seconds each send takes.
+        :param senders: The number of messages that can be sent at once.
+        """
+        self.clock = clock
+        self.latency = latency
+        self.senders = senders
+        # (sent at, due at) for every message sent
+        self.sends = []
+
+    def send_batch(self, messages):
+        start = self.clock.time()
+        senders = [start] * self.senders
+        results = []
+        for message in messages:
+            # The sender that is free first takes the next message
+            sender = senders.index(min(senders))
+            senders[sender] += self.latency
+            self.sends.append((senders[sender], message.fire_at))
+            results.append((message, None))
+        self.clock.advance_to(max(senders))
+        return results
+
+
+def copy_store(source, destination):
+    """
+    Copy a SQLite message store, including changes still in its write-ahead log.
+    """
+    with sqlite3.connect(source) as source_connection, sqlite3.connect(destination) as destination_connection:
+        source_connection.backup(destination_connection)
+
+
+def check_recurrence(series):
+    """
+    Compare the times recurring messages came due with their schedules.
+    :param series: {message id: (repeat unit, repeat, the datetime the series started (see Message.series_start),
+    [the epoch times it came due, in order])}.
+    :return: The first wrong time of each message that went wrong, as dicts.
+    """
+    problems = []
+    for message_id, (repeat_unit, repeat, start, due_times) in series.items():
+        expected = datetime.datetime.fromtimestamp(due_times[0])
+        for due_at in due_times[1:]:
+            expected = Recurrence.next_occurrence(start, repeat_unit, repeat, expected)
+            actual = datetime.datetime.fromtimestamp(due_at)
+            if actual != expected:
+                problems.append({"id": message_id, "repeat_unit": repeat_unit, "repeat": repeat,
+                                 "expected": expected.isoformat(), "actual": actual.isoformat()})
+                break
+    return problems
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return round(sorted(values)[min(int(len(values) * fraction), len(values) - 1)], 1)
+
+
+def simulate(messages_file, days=30, latency=40.0, senders=1, rate=10.0, burst=20, recipient_rate=0.2,
+             recipient_burst=3, max_batch=50, late_after=60, start=None):
+    """
+    Replay a message store against a virtual clock.
+    :param messages_file: The message store to replay. It is copied, not changed.
+    :param days: The number of days to simulate.
+    :param latency: The number of seconds each send takes.
+    :param senders: The number of messages that can be sent at once.
+    :param rate: The send queue's overall rate limit, in messages per second.
+    :param burst: The number of messages the send queue can release at once.
+    :param recipient_rate: The send queue's rate limit per recipient, in messages per second.
+    :param recipient_burst: The number of messages a recipient can be sent at once.
+    :param max_batch: The maximum number of messages handed to the transport at once.
+    :param late_after: Sends more than this many seconds after they were due count as late.
+    :param start: The epoch time to start at. Defaults to now.
+    :return: The report, as a dict.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        store_copy = os.path.join(directory, "messages.db")
+        copy_store(messages_file, store_copy)
+
+        clock = Clock.VirtualClock(start)
+        real_clock = Clock.use(clock)
+        wall_start = time.perf_counter()
+        sender = None
+        try:
+            transport = SimulatedTransport(clock, latency, senders)
+            sender = MessageSender(store_copy, os.path.join(directory, "messages.txt"), transport)
+            sender.send_queue = SendQueue.SendQueue(rate, burst, recipient_rate, recipient_burst)
+            sender.max_batch = max_batch
+            # Nothing else writes to the copy of the store, so there are no changes to reload
+            sender.watcher.close()
+            sender.watcher = FileWatcher([])
+            # The copy's delivery log is thrown away, so there is no need to wait for it to reach the disk
+            sender.deliveries.sync_attempts = False
+            # Keep every event of a tick, however many messages it sends
+            sender.events = EventBus(EVENT_HISTORY)
+            start_time = clock.time()
+            end_time = start_time + days * 24 * 60 * 60
+
+            seq = sender.events.last_seq
+            missed = 0
+            series = {}
+            peak_backlog = (0, start_time)
+            ticks = 0
+            last_tick = None
+            while True:
+                # Jump straight to the next time there is something to do
+                next_times = []
+                next_due = sender.scheduler.next_due_time()
+                if next_due is not None:
+                    next_times.append(next_due)
+                queue_wait = sender.send_queue.time_until_ready()
+                if queue_wait is not None:
+                    next_times.append(clock.time() + max(queue_wait, 0.001))
+                if not next_times or min(next_times) > end_time:
+                    break
+                next_time = min(next_times)
+                if last_tick is not None and next_time <= last_tick:
+                    # Everything due by the last tick was taken then, so something due again at once is a bug.
+                    # Move on anyway rather than loop forever at the same time.
+                    print("Nothing was taken at", datetime.datetime.fromtimestamp(last_tick).isoformat(),
+                          "- moving the clock on")
+                    next_time = last_tick + STALL_SECONDS
+                clock.advance_to(next_time)
+                last_tick = clock.time()
+                sender._tick()
+                ticks += 1
+
+                backlog = sender.send_queue.stats()["backlog"]
+                if backlog > peak_backlog[0]:
+                    peak_backlog = (backlog, clock.time())
+                events = sender.events.since(seq)
+                seq = sender.events.last_seq
+                for event in events:
+                    if event.type == "missed":
+                        missed += len(event.messages)
+                    if event.type not in ("sent", "failed", "missed"):
+                        continue
+                    for message in event.messages:
+                        if message.repeat_unit in CHECKED_UNITS and message.fire_at is not None:
+                            series.setdefault(message.id, (message.repeat_unit, message.repeat,
+                                                           message.series_start(), []))[3].append(message.fire_at)
+        finally:
+            Clock.use(real_clock)
+            # Close the copy's files so the directory can be removed
+            if sender is not None:
+                sender.watcher.close()
+                sender.deliveries.close()
+                sender.store.close()
+        wall_seconds = time.perf_counter() - wall_start
+
+    lateness = [sent_at - due_at for sent_at, due_at in transport.sends if due_at is not None]
+    per_hour = collections.Counter(int((sent_at - start_time) // 3600) for sent_at, _ in transport.sends)
+    # Messages that only came due once have nothing to check
+    series = {message_id: entry for message_id, entry in series.items() if len(entry[3]) > 1}
+    problems = check_recurrence(series)
+    return {
+        "start": datetime.datetime.fromtimestamp(start_time).isoformat(timespec="seconds"),
+        "days": days,
+        "settings": {"latency": latency, "senders": senders, "rate": rate, "burst": burst,
+                     "recipient_rate": recipient_rate, "recipient_burst": recipient_burst, "max_batch": max_batch},
+        "wall_seconds": round(wall_seconds, 2),
+        "ticks": ticks,
+        "sends": len(transport.sends),
+        "sends_per_hour": {
+            "mean": round(len(transport.sends) / max(days * 24, 1), 2),
+            "mean_busy_hours": round(statistics.mean(per_hour.values()), 2) if per_hour else 0,
+            "peak": max(per_hour.values(), default=0),
+        },
+        "peak_backlog": {"messages": peak_backlog[0],
+                         "at": datetime.datetime.fromtimestamp(peak_backlog[1]).isoformat(timespec="seconds")},
+        "lateness_seconds": {"p50": percentile(lateness, 0.5), "p95": percentile(lateness, 0.95),
+                             "p99": percentile(lateness, 0.99),
+                             "max": round(max(lateness), 1) if lateness else None},
+        "late": sum(late > late_after for late in lateness),
+        "missed": missed,
+        "recurrence": {"checked": len(series), "wrong": len(problems), "examples": problems[:10]},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a message store against a virtual clock.")
+    parser.add_argument("messages_file", nargs="?", default="messages.db")
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--start", help="the date to start at (YYYY-MM-DD), defaults to now")
+    parser.add_argument("--latency", type=float, default=40.0, help="seconds per send")
+    parser.add_argument("--senders", type=int, default=1, help="messages sent at once")
+    parser.add_argument("--rate", type=float, default=10.0, help="messages per second")
+    parser.add_argument("--burst", type=int, default=20)
+    parser.add_argument("--recipient-rate", type=float, default=0.2, help="messages per second to one recipient")
+    parser.add_argument("--recipient-burst", type=int, default=3)
+    parser.add_argument("--max-batch", type=int, default=50)
+    parser.add_argument("--late-after", type=float, default=60, help="seconds after which a send counts as late")
+    parser.add_argument("--output", help="a file to save the report to as JSON")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.messages_file):
+        sys.exit(f"No message store at {args.messages_file}")
+    report = simulate(args.messages_file, args.days, args.latency, args.senders, args.rate, args.burst,
+                      args.recipient_rate, args.recipient_burst, args.max_batch, args.late_after,
+                      datetime.datetime.fromisoformat(args.start).timestamp() if args.start else None)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,264 @@
+import json
+import os
+import time
+import webbrowser as web
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pyautogui
+import requests
+from requests.adapters import HTTPAdapter
+
+import Metrics
+import Screen
+import Utils
+
+# Optional configuration for the HTTP transport. If it exists, MessageSender sends through the HTTP API instead of
+# the browser.
+CLOUD_API_CONFIG = os.path.join("data", "cloud_api.json")
+
+SEND_SECONDS = Metrics.registry.histogram("transport_send_seconds", "Time spent sending each message",
+                                          ("transport",))
+STEP_SECONDS = Metrics.registry.histogram("transport_step_seconds", "Time spent in each step of sending a message",
+                                          ("transport", "step"))
+
+
+class Transport:
+    """
+    Delivers messages. MessageSender hands each batch of due messages to its transport.
+    """
+
+    def send_batch(self, messages):
+        """
+        Send a batch of messages.
+        :param messages: An iterable of Message objects. It may be a generator, e.g. an expanding campaign, and is
+        only consumed once.
+        :return: A list of (message, error) pairs, where error is None if the message was sent.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class GuiTransport(Transport):
+    """
+    Sends messages by driving WhatsApp Web in the default browser with pyautogui.
+
+    The first message of a batch opens a chat in a new tab, the rest are typed into that tab's search box, and the
+    tab is closed at the end. If the chat doesn't load, the next message opens another tab instead. Instead of
+    sleeping for fixed times, it polls the screen for pixel signatures (see Screen.py) and moves on as soon as
+    WhatsApp Web is ready.
+    """
+
+    def __init__(self, message_send_buffer=50, screen=None, retries=1, chat_ready=Screen.CHAT_READY,
+                 search_ready=Screen.SEARCH_RESULT_READY):
+        """
+        :param message_send_buffer: The maximum number of seconds to wait for WhatsApp Web to load a chat.
+        :param screen: The ScreenProvider to check readiness with. Defaults to the real screen.
+        :param retries: The number of times to reload a chat that doesn't become ready in time.
+        :param chat_ready: The pixel signatures of an open chat.
+        :param search_ready: The pixel signatures of a finished contact search.
+        """
+        self.message_send_buffer = message_send_buffer
+        self.screen = screen or Screen.PyAutoGuiScreen()
+        self.retries = retries
+        self.chat_ready = chat_ready
+        self.search_ready = search_ready
+        # Seconds for a new browser tab to take focus before it can be made full screen
+        self.browser_open_delay = 2
+        # Seconds to wait for the UI to react to a click or key press that can't be detected on screen
+        self.settle_time = 0.2
+
+    def send_batch(self, messages):
+        results = []
+        # The tabs opened, and whether a chat has loaded in the last one, so later messages can search from it
+        tabs_open = 0
+        chat_open = False
+        for message in messages:
+            try:
+                with Metrics.timed(SEND_SECONDS, "send", transport="gui"):
+                    if not chat_open:
+                        # Open the chat in a new tab, as the last one never loaded if there was one
+                        tabs_open += 1
+                        self.sendwhatmsg_instantly(message.recipient, message.message, self.message_send_buffer)
+                        chat_open = True
+                    else:
+                        self.send_another(message.recipient, message.message)
+                results.append((message, None))
+            except Exception as e:
+                results.append((message, e))
+        with self._step("close"):
+            for _ in range(tabs_open):
+                pyautogui.hotkey("ctrl", "w")
+        return results
+
+    @staticmethod
+    def _step(step):
+        return Metrics.timed(STEP_SECONDS, transport="gui", step=step)
+
+    def _wait_for(self, signatures, timeout, what, changed_from=None):
+        if not self.screen.wait_until(signatures, timeout, changed_from=changed_from):
+            raise TimeoutError(f"Timed out after {timeout} s waiting for {what}")
+
+    def sendwhatmsg_instantly(self, phone_no, message, wait_time=15):
+        """
+        Send WhatsApp Message Instantly
+
+        Taken and modified from pywhatkit https://github.com/Ankit404butfound/PyWhatKit
+        """
+
+        # Prepare message for URL
+        message = Utils.prepare_string_for_url(message)
+
+        with self._step("open"):
+            # The tab open before, e.g. the last chat, may look ready already, so wait for the new one to appear
+            before = self.screen.read(self.chat_ready)
+            web.open(f"https://web.whatsapp.com/send?phone={phone_no}&text={message}")
+
+            time.sleep(self.browser_open_delay)
+
+            pyautogui.press("F11")
+
+        # Wait for the chat to load, reloading the page if it takes too long
+        with self._step("wait"):
+            for attempt in range(self.retries + 1):
+                if self.screen.wait_until(self.chat_ready, wait_time, changed_from=before):
+                    break
+                if attempt == self.retries:
+                    raise TimeoutError(f"Timed out waiting for the chat with {phone_no} to load")
+                before = self.screen.read(self.chat_ready)
+                pyautogui.press("F5")
+
+        with self._step("type"):
+            # 61.66666666666667%, 95.0%
+            x, y = self.screen.coord(61.66666666666667, 95.0)
+            pyautogui.click(x, y)
+
+            pyautogui.press("enter")
+            time.sleep(self.settle_time)
+
+    def send_another(self, recipient, message_string):
+        with self._step("type"):
+            # Coordinates where the mouse will click
+            # %, %
+            x, y = self.screen.coord(15.416666666666668, 12.314814814814815)
+
+            # The chat list looks like finished search results until the search changes it
+            before = self.screen.read(self.search_ready)
+
+            # Move the mouse to the specified coordinates
+            pyautogui.moveTo(x, y)
+
+            # Click at the current mouse location
+            pyautogui.click()
+
+            # Wait a moment for the search box to activate
+            time.sleep(self.settle_time)
+
+            # Type phone number
+            pyautogui.write(recipient)
+
+        with self._step("wait"):
+            self._wait_for(self.search_ready, self.message_send_buffer, f"search results for {recipient}", before)
+
+        with self._step("type"):
+            x, y = self.screen.coord(16.40625, 27.777777777777775)
+            # The chat open before looks ready too, so wait for the one clicked to replace it
+            before = self.screen.read(self.chat_ready)
+            # Click the contact
+            pyautogui.moveTo(x, y)
+
+            pyautogui.click()
+
+        with self._step("wait"):
+            self._wait_for(self.chat_ready, self.message_send_buffer, f"the chat with {recipient} to open", before)
+
+        with self._step("type"):
+            pyautogui.write(message_string)
+
+            pyautogui.press("enter")
+            time.sleep(self.settle_time)
+
+
+class HttpTransport(Transport):
+    """
+    Sends messages through a WhatsApp Business Cloud style HTTP API, with up to max_in_flight requests at once
+    over a pooled keep-alive session.
+
+    Each message is a POST to {base_url}/{phone_number_id}/messages. FakeCloudApi.py is a local stand-in for
+    testing.
+    """
+
+    def __init__(self, base_url, token, phone_number_id, max_in_flight=8, timeout=10):
+        """
+        :param base_url: The API base URL, e.g. "https://graph.facebook.com/v17.0".
+        :param token: The bearer token to authenticate with.
+        :param phone_number_id: The id of the sending phone number.
+        :param max_in_flight: The maximum number of requests in progress at once.
+        :param timeout: The number of seconds to wait for each response.
+        """
+        self.url = f"{base_url.rstrip('/')}/{phone_number_id}/messages"
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {token}"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="HttpTransport")
+
+    @classmethod
+    def from_config(cls, config_file=CLOUD_API_CONFIG):
+        """
+        Returns an HttpTransport configured from a JSON file with base_url, token and phone_number_id, and
+        optionally max_in_flight and timeout.
+        """
+        with open(config_file, 'r') as f:
+            return cls(**json.load(f))
+
+    def send(self, message):
+        """
+        Send a single message.
+        :raises requests.RequestException: If the request fails or is rejected.
+        """
+        with Metrics.timed(SEND_SECONDS, "send", transport="http"):
+            response = self.session.post(self.url, timeout=self.timeout, json={
+                "messaging_product": "whatsapp",
+                "to": message.recipient,
+                "type": "text",
+                "text": {"body": message.message},
+            })
+            response.raise_for_status()
+            return response.json()
+
+    def send_batch(self, messages):
+        results = []
+        in_flight = {}
+
+        def collect(futures):
+            for future in futures:
+                message = in_flight.pop(future)
+                error = future.exception()
+                results.append((message, error))
+
+        # Only take more messages from the iterable once a request slot is free
+        for message in messages:
+            if len(in_flight) >= self.max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[self.executor.submit(self.send, message)] = message
+        collect(list(in_flight))
+        return results
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+
+def default_transport(message_send_buffer=50):
+    """
+    Returns an HttpTransport if data/cloud_api.json exists, otherwise a GuiTransport.
+    """
+    if os.path.exists(CLOUD_API_CONFIG):
+        return HttpTransport.from_config()
+    return GuiTransport(message_send_buffer)
@@ -1,34 +1,42 @@
-import datetime
+import functools
+from urllib.parse import quote
 
 import pyautogui
 
-import MessageSender
+import Clock
 
 
 def within_time(message, loop_buffer=2, message_send_buffer=50):
-    # Get timestamp of message
-
-    message_timestamp = datetime.datetime.strptime(f"{message.date} {message.hour}:{message.minute}",
-                                                   "%Y-%m-%d %H:%M")
+    if message.fire_at is None:
+        return False
 
     # Get timestamp of now
-    now_timestamp = datetime.datetime.now()
+    now_timestamp = Clock.clock.time()
 
-    return message_timestamp >= now_timestamp - datetime.timedelta(seconds=message_send_buffer + loop_buffer) and not (message_timestamp >= now_timestamp)
+    return now_timestamp - (message_send_buffer + loop_buffer) <= message.fire_at < now_timestamp
 
 
 def prepare_string_for_url(message_string):
     # Make sure the message is a string
     message_string = str(message_string)
 
-    # Replace spaces with %20
-    message_string = message_string.replace(" ", "%20")
+    # Percent-encode everything that isn't safe in a query string: spaces, the newlines between coalesced
+    # messages, and characters such as & and # that would otherwise cut the message short
+    message_string = quote(message_string, safe="")
 
     return message_string
 
 
+@functools.lru_cache(maxsize=None)
+def screen_size():
+    """
+    Returns the (width, height) of the screen, read once.
+    """
+    return tuple(pyautogui.size())
+
+
 def get_coord(percent_x, percent_y):
-    WIDTH, HEIGHT = pyautogui.size()
+    WIDTH, HEIGHT = screen_size()
 
     x = (WIDTH / 100) * percent_x
     y = (HEIGHT / 100) * percent_y
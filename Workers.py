@@ -0,0 +1,281 @@
+"""
+Sends messages from several worker processes at once, each with its own transport, sharing one message store.
+
+Run it with `python Workers.py [workers] [messages file]` alongside `python Server.py` or `python main.py`, started
+with MESSAGE_SEND_FROM_WORKERS=1 so the web server leaves the sending to the workers. Each worker leases the due
+messages of its own shard of the recipients from the store, and without that setting the web server's own sender
+leases messages before it sends them too, so no two senders send the same message. A recipient's messages always go
+out through the same worker. If a worker stops, the leases it held expire and the messages in its shard are taken
+over by the other workers once they are overdue.
+
+Worker n uses data/cloud_api_{n}.json if it exists, so each worker can send from its own number, and otherwise
+the default transport. That is WhatsApp Web unless data/cloud_api.json exists, which only one worker can drive, so
+several workers won't start without an HTTP API config for each.
+"""
+import os
+import socket
+import sys
+import threading
+import time
+from multiprocessing import Process
+
+import Clock
+import SendQueue
+import Transport
+from DeliveryLog import DeliveryLog, delivery_key
+from MessageSender import CATCH_UP_SECONDS, MESSAGES_SENT, CampaignSend, observe_lateness, retire
+from MessageStore import LEASE_SECONDS, MessageStore
+
+# A worker stops sending a batch this many seconds (or a quarter of a short lease) before its leases run out
+LEASE_MARGIN = 10
+
+
+class SenderWorker:
+    """
+    Leases due messages in one shard of the recipients and sends them through its own send queue.
+    """
+
+    def __init__(self, store, index=0, count=1, transport=None, lease_seconds=LEASE_SECONDS, poll_interval=1.0,
+                 max_batch=50, send_window=60, takeover_after=None, deliveries=None,
+                 catch_up_seconds=CATCH_UP_SECONDS, resend_unconfirmed=False):
+        """
+        :param store: The shared MessageStore.
+        :param index: The shard this worker sends, from 0 to count - 1.
+        :param count: The number of workers.
+        :param transport: The Transport to send with. Defaults to transport_for(index, count).
+        :param lease_seconds: How long the leases on claimed messages last.
+        :param poll_interval: Seconds between checks for due messages when there are none.
+        :param max_batch: The maximum number of messages to lease and send at once.
+        :param send_window: How many seconds after its due time a message can still be sent.
+        :param takeover_after: Seconds after which an overdue message in another worker's shard is taken over.
+        Defaults to the lease length, so a stopped worker's messages are sent within two leases.
+        :param deliveries: The DeliveryLog shared with the other senders. Defaults to the message store's.
+        :param catch_up_seconds: How late a message can be and still be sent, as in MessageSender.
+        :param resend_unconfirmed: Send messages again if the delivery log doesn't show how their last attempt went.
+        """
+        self.store = store
+        self.index = index
+        self.count = count
+        self.transport = transport or transport_for(index, count)
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_batch = max_batch
+        self.send_window = send_window
+        self.takeover_after = lease_seconds if takeover_after is None else takeover_after
+        self.deliveries = deliveries or DeliveryLog(store.path + "-deliveries")
+        self.catch_up_seconds = catch_up_seconds
+        self.resend_unconfirmed = resend_unconfirmed
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{index}"
+        self.is_running = True
+        self.sent = 0
+        # Due messages wait here until the rate limits let them go, as in MessageSender. Each worker has its own
+        # limits, as it sends from its own number.
+        self.send_queue = SendQueue.SendQueue()
+        # The leased messages waiting in the send queue, by id, and the campaigns being sent, as in MessageSender
+        self._queued = {}
+        self._campaign_sends = {}
+        self._campaign_messages = {}
+        # When the leases on them were last renewed
+        self._renewed_at = 0
+
+    def run_once(self):
+        """
+        Lease due messages and any due campaign, and send a batch of those the rate limits allow.
+        :return: The number of messages sent, missed or skipped.
+        """
+        retired = self._queue_campaigns() + self._queue_messages()
+        self._renew_leases()
+        return retired + self._send_batch()
+
+    def _queue_messages(self):
+        now = Clock.clock.time()
+        # Only lease as many messages as can go in one batch, as their leases are renewed while they are queued
+        limit = self.max_batch - len(self._queued)
+        if limit <= 0:
+            return 0
+        messages = [message for message in self.store.claim_due(self.owner, now, self.lease_seconds, self.count,
+                                                                 self.index, now - self.takeover_after, limit)
+                    if message.id not in self._queued]
+        if not messages:
+            return 0
+
+        to_send = []
+        missed = []
+        for message in messages:
+            if now - message.fire_at > max(self.send_window, self.catch_up_seconds):
+                print("Skipping missed message:", message)
+                missed.append(message)
+            else:
+                to_send.append(message)
+        self.deliveries.record("missed", missed, owner=self.owner)
+        retired = missed
+
+        # Messages another sender sent before it could retire them aren't sent again
+        delivered = self.deliveries.delivered(to_send, include_unconfirmed=not self.resend_unconfirmed)
+        if delivered:
+            skipped = [message for message in to_send if delivery_key(message) in delivered]
+            self.deliveries.record("skipped", skipped, owner=self.owner)
+            retired += skipped
+            to_send = [message for message in to_send if delivery_key(message) not in delivered]
+        if retired:
+            still_scheduled = retire(retired, self.store.delete_many, self.store.update_many)
+            self.store.release([message.id for message in still_scheduled], self.owner)
+
+        for message in to_send:
+            self._queued[message.id] = message
+            # As in MessageSender, messages that are late are sent behind those that are on time
+            self.send_queue.put(message, SendQueue.NORMAL if now - message.fire_at <= self.send_window
+                                else SendQueue.BULK)
+        return len(retired)
+
+    def _queue_campaigns(self):
+        # One campaign at a time, which stays leased until all of its messages have been sent, as in MessageSender,
+        # so if this worker stops part way through, another sends the rest once the lease runs out
+        if self._campaign_sends:
+            return 0
+        now = Clock.clock.time()
+        for campaign in self.store.claim_due_campaigns(self.owner, now, self.lease_seconds):
+            sending = self._campaign_sends[campaign.id] = CampaignSend(campaign, now + self.lease_seconds)
+            self.send_queue.put_stream(
+                sending.expand(self.deliveries, not self.resend_unconfirmed, self._campaign_messages),
+                SendQueue.BULK)
+        return 0
+
+    def _renew_leases(self):
+        """
+        Keep the leases on the messages waiting in the send queue and the campaigns being sent, renewing them every
+        quarter of a lease.
+        """
+        now = Clock.clock.time()
+        if now - self._renewed_at < self.lease_seconds / 4:
+            return
+        self._renewed_at = now
+        self.store.renew(list(self._queued), self.owner, now, self.lease_seconds)
+        self.store.renew_campaigns(list(self._campaign_sends), self.owner, now, self.lease_seconds)
+        for sending in self._campaign_sends.values():
+            sending.lease_expires = now + self.lease_seconds
+
+    def _send_batch(self):
+        batch = self.send_queue.next_batch(self.max_batch)
+        if not batch:
+            self._retire_sent_campaigns()
+            return 0
+        ids = [part.id for _, parts in batch for part in parts if part.id is not None]
+        for message_id in ids:
+            del self._queued[message_id]
+        # Leave time to record the sends before the leases run out
+        self.store.renew(ids, self.owner, Clock.clock.time(), self.lease_seconds)
+        deadline = time.monotonic() + self.lease_seconds - min(LEASE_MARGIN, self.lease_seconds / 4)
+
+        # Messages are only handed over while the leases are safely held
+        queued_messages = {id(message): parts for message, parts in batch}
+        results = self.transport.send_batch(self.deliveries.attempting(
+            ((message, parts) for message, parts in batch if time.monotonic() < deadline), self.owner))
+        sent_messages = []
+        handed_over = set()
+        for message, error in results:
+            parts = queued_messages[id(message)]
+            handed_over.add(id(message))
+            MESSAGES_SENT.inc(result="sent" if error is None else "failed")
+            observe_lateness(parts)
+            self.deliveries.record("sent" if error is None else "failed", parts, error, self.owner)
+            if error is not None:
+                print("Failed to send message:", message, error)
+            for part in parts:
+                # Campaign messages have no row of their own
+                if part.id is None:
+                    self._campaign_messages.pop(id(part)).pending -= 1
+                elif error is None:
+                    sent_messages.append(part)
+
+        # Those left over go back in the queue, still leased
+        for message, parts in batch:
+            if id(message) not in handed_over:
+                for part in parts:
+                    if part.id is not None:
+                        self._queued[part.id] = part
+                    self.send_queue.put(part, SendQueue.BULK)
+
+        # Drop sent one-off messages, move recurring ones on to their next date, then give up the leases. Messages
+        # that failed keep theirs, so they are tried again once it runs out, and recurring messages that can't be
+        # moved on keep theirs so they aren't taken again straight away.
+        still_scheduled = retire(sent_messages, self.store.delete_many, self.store.update_many)
+        self.store.release([message.id for message in still_scheduled], self.owner)
+        self._retire_sent_campaigns()
+        self.sent += len(results)
+        return len(results)
+
+    def _retire_sent_campaigns(self):
+        done = [sending.campaign for sending in self._campaign_sends.values() if sending.is_done()]
+        if not done:
+            return
+        for campaign in done:
+            del self._campaign_sends[campaign.id]
+        self.deliveries.record("sent", done, owner=self.owner)
+        still_scheduled = retire(done, self.store.delete_campaigns, self.store.update_campaigns)
+        self.store.release_campaigns([campaign.id for campaign in still_scheduled], self.owner)
+
+    def run(self):
+        while self.is_running:
+            if not self.run_once():
+                queue_wait = self.send_queue.time_until_ready()
+                time.sleep(min(queue_wait, self.poll_interval) if queue_wait else self.poll_interval)
+        self.transport.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.is_running = False
+
+
+def _config_file(index):
+    return os.path.join("data", f"cloud_api_{index}.json")
+
+
+def gui_workers(count):
+    """
+    Returns the indexes of the workers, out of count, that have no HTTP API config and would send through the GUI
+    transport.
+    """
+    if os.path.exists(Transport.CLOUD_API_CONFIG):
+        return []
+    return [index for index in range(count) if not os.path.exists(_config_file(index))]
+
+
+def transport_for(index, count=1):
+    """
+    Returns the transport for worker index: an HttpTransport configured by data/cloud_api_{index}.json if it
+    exists, otherwise the default transport.
+    :param count: The number of workers.
+    :raises ValueError: If there are several workers and this one would use the GUI transport, which drives the
+    one mouse, keyboard and browser there are, so it can't be shared.
+    """
+    config_file = _config_file(index)
+    if os.path.exists(config_file):
+        return Transport.HttpTransport.from_config(config_file)
+    if count > 1 and index in gui_workers(count):
+        raise ValueError(f"Worker {index} of {count} has no {config_file} or {Transport.CLOUD_API_CONFIG}, and only "
+                         f"one worker can send through WhatsApp Web")
+    return Transport.default_transport()
+
+
+def run_worker(messages_file, index, count):
+    print(f"Worker {index} of {count} sending (pid {os.getpid()})")
+    SenderWorker(MessageStore(messages_file), index, count).run()
+
+
+if __name__ == "__main__":
+    worker_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    messages_path = sys.argv[2] if len(sys.argv) > 2 else "messages.db"
+    without_config = gui_workers(worker_count)
+    if worker_count > 1 and without_config:
+        sys.exit(f"Only one worker can send through WhatsApp Web. Create {Transport.CLOUD_API_CONFIG}, or "
+                 f"data/cloud_api_{{n}}.json for workers {', '.join(map(str, without_config))}, or start one worker.")
+    processes = [Process(target=run_worker, args=(messages_path, n, worker_count)) for n in range(worker_count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -0,0 +1,59 @@
+"""
+Measures the memory and time cost of holding scheduled messages in memory.
+
+Parses N synthetic message lines, then reports the memory held by the resulting Message objects, the time taken
+to parse them and the time taken by one pass of Utils.within_time over all of them (the check the sender runs to
+find due messages).
+
+Usage: python benchmarks/message_footprint.py [N]
+"""
+import datetime
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Utils
+from Message import Message
+
+
+def make_lines(count):
+    random.seed(0)
+    now = datetime.datetime.now()
+    lines = []
+    for i in range(count):
+        when = now + datetime.timedelta(minutes=random.randrange(1, 60 * 24 * 365))
+        unit = random.choice("nnnymwd")
+        lines.append(f"07{i:09d},Message number {i},{when.hour},{when.minute:02d},{when:%Y-%m-%d},1,{unit},None\n")
+    return lines
+
+
+def main(count):
+    lines = make_lines(count)
+
+    start = time.perf_counter()
+    messages = [Message(csv_line=line) for line in lines]
+    parse_time = time.perf_counter() - start
+
+    # Parse again while tracing, as tracing allocations slows parsing down
+    del messages
+    tracemalloc.start()
+    messages = [Message(csv_line=line) for line in lines]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    due = [message for message in messages if Utils.within_time(message)]
+    check_time = time.perf_counter() - start
+
+    print(f"messages:           {count}")
+    print(f"memory:             {memory / 1024 / 1024:.1f} MiB ({memory / count:.0f} bytes per message)")
+    print(f"parse:              {parse_time:.3f} s")
+    print(f"due check (1 pass): {check_time * 1000:.1f} ms ({len(due)} due)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
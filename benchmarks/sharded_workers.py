@@ -0,0 +1,126 @@
+"""
+Measures how sending throughput scales with the number of sender workers, and checks that no message is sent twice.
+
+Each run stores N due messages, then starts 1, 2, 4 and 8 SenderWorker threads over the same message store, each
+with its own HttpTransport sending one message at a time to a FakeCloudApi with a fixed latency, as a worker per
+WhatsApp number would. It reports the messages sent per second and any duplicates.
+
+It then checks failover: a worker leases its shard's messages and stops without sending them, and the remaining
+worker must send them once the lease has expired.
+
+Usage: python benchmarks/sharded_workers.py [messages] [latency in seconds]
+"""
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import SendQueue
+import Transport
+from FakeCloudApi import FakeCloudApi
+from Message import Message
+from MessageStore import MessageStore
+from Workers import SenderWorker
+
+
+def make_store(path, count):
+    store = MessageStore(path)
+    # Due a few seconds ago, so every message is sendable straight away
+    now = datetime.datetime.now() - datetime.timedelta(seconds=5)
+    store.add_many([Message(f"+4477{i:08d}", f"Message {i}", now.hour, now.minute, now.strftime("%Y-%m-%d"),
+                            0, "n", None) for i in range(count)])
+    return store
+
+
+def make_transport(api):
+    return Transport.HttpTransport(api.base_url, "test", "1", max_in_flight=1)
+
+
+def unlimited(worker):
+    # Measure the workers and the transport, not the send queue's rate limits
+    worker.send_queue = SendQueue.SendQueue(rate=100000, burst=100000, recipient_rate=100, recipient_burst=100)
+    return worker
+
+
+def wait_until_sent(store, timeout):
+    deadline = time.monotonic() + timeout
+    while len(store) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def run_throughput(directory, count, latency, worker_count):
+    api = FakeCloudApi(latency=latency).start()
+    store = make_store(os.path.join(directory, f"throughput_{worker_count}.db"), count)
+    workers = [unlimited(SenderWorker(store, index, worker_count, make_transport(api), poll_interval=0.05,
+                                      max_batch=10, send_window=3600))
+               for index in range(worker_count)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    wait_until_sent(store, 120)
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.stop()
+    api.shutdown()
+
+    received = Counter(message["text"]["body"] for message in api.received)
+    return {
+        "workers": worker_count,
+        "sent": len(api.received),
+        "duplicates": sum(n - 1 for n in received.values()),
+        "unsent": len(store),
+        "seconds": round(elapsed, 2),
+        "messages_per_second": round(len(api.received) / elapsed, 1),
+        "per_worker": [worker.sent for worker in workers],
+    }
+
+
+def run_failover(directory, count, latency):
+    api = FakeCloudApi(latency=latency).start()
+    store = make_store(os.path.join(directory, "failover.db"), count)
+    lease_seconds = 2
+    # Worker 0 leases its first batch, then dies without sending or releasing it
+    lost = store.claim_due("crashed", time.time(), lease_seconds, 2, 0, limit=count)
+    survivor = unlimited(SenderWorker(store, 1, 2, make_transport(api), lease_seconds=lease_seconds,
+                                      poll_interval=0.05, send_window=3600, takeover_after=0))
+    start = time.perf_counter()
+    survivor.start()
+    wait_until_sent(store, 30 + lease_seconds)
+    elapsed = time.perf_counter() - start
+    survivor.stop()
+    api.shutdown()
+
+    received = Counter(message["text"]["body"] for message in api.received)
+    return {
+        "leased_by_crashed_worker": len(lost),
+        "sent": len(api.received),
+        "duplicates": sum(n - 1 for n in received.values()),
+        "unsent": len(store),
+        "seconds": round(elapsed, 2),
+        "lease_seconds": lease_seconds,
+    }
+
+
+def run(count, latency):
+    directory = tempfile.mkdtemp()
+    results = {
+        "messages": count,
+        "latency_seconds": latency,
+        "throughput": [run_throughput(directory, count, latency, n) for n in (1, 2, 4, 8)],
+        "failover": run_failover(directory, min(count, 100), latency),
+    }
+    results["ok"] = all(run["sent"] == count and not run["duplicates"] for run in results["throughput"]) and (
+        results["failover"]["sent"] == min(count, 100) and not results["failover"]["duplicates"]
+        and results["failover"]["seconds"] >= results["failover"]["lease_seconds"])
+    print(json.dumps(results, indent=2))
+    return results["ok"]
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(int(sys.argv[1]) if len(sys.argv) > 1 else 400,
+                      float(sys.argv[2]) if len(sys.argv) > 2 else 0.02) else 1)
@@ -0,0 +1,131 @@
+"""
+Hammers the /add route from many threads while the sender thread is running, then checks that no message was lost
+or sent twice.
+
+Half of the messages are due now and should each be sent exactly once. The other half are due next year and should
+each be scheduled exactly once, in both the in-memory snapshot and the message store. Readers load the index page
+and /messages throughout.
+
+Usage: python benchmarks/stress_add.py [threads] [messages per thread]
+"""
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import SendQueue
+import Transport
+import main
+from ContactCache import ContactCache
+from ContactIndex import ContactIndex
+from MessageSender import MessageSender
+
+
+class RecordingTransport(Transport.Transport):
+    """
+    Sends nothing, but records every message it is given.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_batch(self, messages):
+        messages = list(messages)
+        with self._lock:
+            self.sent.extend(message.message for message in messages)
+        return [(message, None) for message in messages]
+
+
+def add_messages(client, thread_number, count, now, errors):
+    next_year = f"{now.year + 1}-01-01"
+    for i in range(count):
+        due_now = i % 2 == 0
+        response = client.post("/add", data={
+            # Every message has its own recipient, so the send queue never merges them
+            "recipient[]": f"+4477{thread_number:03d}{i:05d}",
+            "message": f"{'now' if due_now else 'later'} {thread_number} {i}",
+            "time": f"{now.hour:02d}:{now.minute:02d}" if due_now else "09:00",
+            "date": now.strftime("%Y-%m-%d") if due_now else next_year,
+            "repeat": "0",
+            "repeat_unit": "n",
+            "holiday": "",
+            "country-code": "",
+        })
+        if response.status_code != 201:
+            errors.append(response.status_code)
+
+
+def read_pages(client, stop, errors):
+    while not stop.is_set():
+        for path in ("/", "/messages?sort=recipient", "/messages?order=desc"):
+            if client.get(path).status_code != 200:
+                errors.append(path)
+
+
+def run(threads, per_thread):
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    # Start in the first half of a minute, so messages due "now" stay within the send window while they are added
+    if datetime.datetime.now().second > 30:
+        time.sleep(61 - datetime.datetime.now().second)
+    now = datetime.datetime.now()
+
+    transport = RecordingTransport()
+    sender = MessageSender(os.path.join(directory, "messages.db"), transport=transport)
+    sender.send_queue = SendQueue.SendQueue(rate=10000, burst=10000, recipient_rate=100, recipient_burst=100)
+    main.message_sender = sender
+    main.contact_index = ContactIndex(ContactCache(os.path.join(directory, "contacts.db"), sources=()))
+    sender.start()
+
+    errors = []
+    stop = threading.Event()
+    writers = [threading.Thread(target=add_messages, args=(main.app.test_client(), n, per_thread, now, errors))
+               for n in range(threads)]
+    readers = [threading.Thread(target=read_pages, args=(main.app.test_client(), stop, errors)) for _ in range(4)]
+    start = time.perf_counter()
+    for thread in writers + readers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    add_time = time.perf_counter() - start
+
+    # Let the sender catch up with the messages that are due
+    total = threads * per_thread
+    due = (per_thread + 1) // 2 * threads
+    deadline = time.monotonic() + 30
+    while len(transport.sent) < due and time.monotonic() < deadline:
+        time.sleep(0.1)
+    stop.set()
+    for thread in readers:
+        thread.join()
+    sender.stop_thread()
+    sender.thread.join()
+
+    later = [message.message for message in sender.messages.values()]
+    stored = [message.message for message in sender.store.all()]
+    results = {
+        "added": total,
+        "add_seconds": round(add_time, 2),
+        "adds_per_second": round(total / add_time),
+        "due": due,
+        "sent": len(transport.sent),
+        "sent_twice": len(transport.sent) - len(set(transport.sent)),
+        "scheduled": len(later),
+        "stored": len(stored),
+        "errors": len(errors),
+    }
+    results["ok"] = (results["sent"] == due and not results["sent_twice"] and not errors
+                     and sorted(later) == sorted(stored) and len(set(later)) == total - due)
+    print(json.dumps(results, indent=2))
+    return results["ok"]
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(int(sys.argv[1]) if len(sys.argv) > 1 else 16,
+                      int(sys.argv[2]) if len(sys.argv) > 2 else 200) else 1)
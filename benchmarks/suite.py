@@ -0,0 +1,213 @@
+"""
+Times startup, the scheduler tick, the message listings and the web routes at several sizes, and saves the results
+as JSON so runs can be compared.
+
+For each size it generates a legacy messages.txt with a mix of one-off, yearly, monthly, weekly, daily and holiday
+messages (a tenth of them already in the past, so startup has messages to delete and move on) and contact CSVs
+with a contact for every ten messages. Then it times:
+- startup_migrate_s: MessageSender.__init__ importing messages.txt into a new message store, then loading it.
+- startup_s: MessageSender.__init__ on the existing store: the load, delete and reschedule passes.
+- tick_idle_ms: one sender tick with nothing due (the median of 50).
+- tick_send_ms: one sender tick that sends and retires 50 due messages.
+- get_messages_ms: MessageSender.get_messages().
+- list_cold_ms and list_warm_ms: the first page of the message table after a change, and again once sorted.
+- render_cold_ms and render_warm_ms: GET / after a change, and the median of 20 more.
+- adds_per_second: POST /add, one message at a time, with the sender thread running.
+
+Messages go to a transport that sends nothing, and holidays come from a stub that never uses the network.
+
+Usage: python benchmarks/suite.py [--sizes 1000,10000,100000,1000000] [--output results.json]
+                                  [--compare earlier.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import Holidays
+import SendQueue
+import Transport
+import main
+from ContactCache import ContactCache
+from ContactIndex import ContactIndex
+from Message import Message
+from MessageSender import MessageSender
+
+SIZES = (1000, 10000, 100000, 1000000)
+UNITS = ("n", "n", "y", "m", "w", "d", "hol")
+COUNTRIES = ("GB", "US", "FR", "DE", "IN")
+
+
+class NullTransport(Transport.Transport):
+    """
+    Sends nothing, and reports every message as sent.
+    """
+
+    def send_batch(self, messages):
+        return [(message, None) for message in messages]
+
+
+class StubHolidaySource:
+    """
+    The same few holidays for every country and year, without the network.
+    """
+
+    def fetch(self, country_code, year):
+        return {"New Year's Day": f"{year}-01-01", "Midsummer": f"{year}-06-21", "Christmas Day": f"{year}-12-25"}
+
+
+def make_messages_file(path, count):
+    random.seed(count)
+    now = datetime.datetime.now()
+    with open(path, "w", encoding="UTF-8") as f:
+        for i in range(count):
+            # A tenth of the messages are already in the past
+            minutes = random.randrange(-60 * 24 * 365, 0) if i % 10 == 0 else random.randrange(1, 60 * 24 * 365)
+            when = now + datetime.timedelta(minutes=minutes)
+            unit = UNITS[i % len(UNITS)]
+            holiday = f"{random.choice(('Christmas Day', 'Midsummer'))}___{COUNTRIES[i % len(COUNTRIES)]}" \
+                if unit == "hol" else "None"
+            f.write(f"+4477{i % 1000000:08d},Message number {i},{when.hour},{when.minute:02d},{when:%Y-%m-%d},"
+                    f"{0 if unit == 'n' else 1},{unit},{holiday}\n")
+
+
+def make_contact_files(contacts_file, groups_file, count):
+    with open(contacts_file, "w", encoding="utf-8") as f:
+        f.write("First name,Last name,Telephone (mobile),Group Membership\n")
+        for i in range(count):
+            f.write(f"First{i},Last{i},077{i:08d},Group {i % 20}\n")
+    with open(groups_file, "w", encoding="utf-8") as f:
+        f.write("First name,Last name,Telephone (mobile),Group Membership\n")
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def median_ms(function, repeat):
+    return round(statistics.median(timed(function)[0] for _ in range(repeat)) * 1000, 3)
+
+
+def due_messages(count):
+    now = datetime.datetime.now()
+    return [Message(f"+4478{i:08d}", f"Due {i}", now.hour, now.minute, now.strftime("%Y-%m-%d"), 0, "n", None)
+            for i in range(count)]
+
+
+def add_form(i):
+    return {"recipient[]": f"+4479{i:08d}", "message": f"Added {i}", "time": "09:00", "date": "2099-01-01",
+            "repeat": "0", "repeat_unit": "n", "holiday": "", "country-code": ""}
+
+
+def run_size(directory, count):
+    print(f"Generating {count} messages...")
+    os.makedirs(os.path.join(directory, "static"), exist_ok=True)
+    messages_file = os.path.join(directory, "messages.txt")
+    messages_db = os.path.join(directory, "messages.db")
+    make_messages_file(messages_file, count)
+    contacts = (os.path.join(directory, "static", "contacts.csv"), os.path.join(directory, "static", "groups.csv"))
+    make_contact_files(*contacts, max(count // 10, 1))
+
+    results = {"messages": count}
+    seconds, sender = timed(MessageSender, messages_db, messages_file, NullTransport())
+    results["startup_migrate_s"] = round(seconds, 3)
+    sender.store.close()
+    seconds, sender = timed(MessageSender, messages_db, messages_file, NullTransport())
+    results["startup_s"] = round(seconds, 3)
+    results["scheduled"] = len(sender.messages)
+
+    # Only the tick itself is timed, not the rate limits
+    sender.send_queue = SendQueue.SendQueue(rate=100000, burst=100000, recipient_rate=100, recipient_burst=100)
+    results["tick_idle_ms"] = median_ms(sender._tick, 50)
+    sender.add_messages(due_messages(50))
+    results["tick_send_ms"] = round(timed(sender._tick)[0] * 1000, 3)
+
+    results["get_messages_ms"] = round(timed(sender.get_messages)[0] * 1000, 3)
+    results["list_cold_ms"] = round(timed(sender.list_messages)[0] * 1000, 3)
+    results["list_warm_ms"] = median_ms(sender.list_messages, 20)
+
+    main.message_sender = sender
+    main.contact_index = ContactIndex(ContactCache(os.path.join(directory, "contacts.db"), sources=contacts))
+    client = main.app.test_client()
+    main.contact_index.refresh()
+    sender.add_messages([Message("+447700900000", "Invalidate the listings", 9, 0, "2099-01-01", 0, "n", None)])
+    results["render_cold_ms"] = round(timed(client.get, "/")[0] * 1000, 3)
+    results["render_warm_ms"] = median_ms(lambda: client.get("/"), 20)
+
+    sender.start()
+    adds = min(count, 500)
+    seconds, _ = timed(lambda: [client.post("/add", data=add_form(i)) for i in range(adds)])
+    results["adds_per_second"] = round(adds / seconds, 1)
+    sender.stop_thread()
+    sender.thread.join()
+    sender.store.close()
+    main.contact_index.cache.close()
+    return results
+
+
+def compare(results, earlier):
+    """
+    Print each result next to the same result from an earlier run.
+    """
+    earlier = {run["messages"]: run for run in earlier["runs"]}
+    for run in results["runs"]:
+        before = earlier.get(run["messages"])
+        if before is None:
+            continue
+        print(f"\n{run['messages']} messages:")
+        for name, value in run.items():
+            if name == "messages" or not isinstance(before.get(name), (int, float)) or not before[name]:
+                continue
+            print(f"  {name:18} {before[name]:>12} -> {value:>12} ({value / before[name]:.2f}x)")
+
+
+def run(sizes, output, earlier=None):
+    # Keep the suite's files, and the holidays the stub "looks up", out of the real data directory
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    Holidays.catalog._source = StubHolidaySource()
+    Holidays.catalog.directory = os.path.join(directory, "holidays")
+
+    results = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": [],
+    }
+    for count in sizes:
+        size_directory = os.path.join(directory, str(count))
+        os.makedirs(size_directory)
+        results["runs"].append(run_size(size_directory, count))
+        print(json.dumps(results["runs"][-1], indent=2))
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Saved results to", output)
+    if earlier is not None:
+        compare(results, earlier)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scheduler, storage and web paths.")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="comma-separated numbers of messages to run with")
+    parser.add_argument("--output", default=f"benchmark-{datetime.datetime.now():%Y%m%d-%H%M%S}.json",
+                        help="the file to save the results to")
+    parser.add_argument("--compare", help="the results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    earlier_results = None
+    if args.compare:
+        with open(args.compare) as f:
+            earlier_results = json.load(f)
+    run([int(size) for size in args.sizes.split(",")], os.path.abspath(args.output), earlier_results)
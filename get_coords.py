@@ -1,17 +1,18 @@
 from pynput.mouse import Listener
 
-from pyautogui import size
+from pyautogui import pixel, size
 
+WIDTH, HEIGHT = size()
 
-def on_click(x, y, button, pressed):
-    WIDTH, HEIGHT = size()
 
+def on_click(x, y, button, pressed):
     x_perc = (100/WIDTH) * x
     y_perc = (100/HEIGHT) * y
 
     if pressed:
-        print(f"Mouse clicked at position: X={x}, Y={y} -- ({x_perc}%, {y_perc}%)")
+        # The colour is what a Screen.PixelSignature for this position should expect
+        print(f"Mouse clicked at position: X={x}, Y={y} -- ({x_perc}%, {y_perc}%) colour {pixel(int(x), int(y))}")
 
 # Start the listener
 with Listener(on_click=on_click) as listener:
-    listener.join()
\ No newline at end of file
+    listener.join()
@@ -1,22 +1,245 @@
+import base64
+import binascii
 import datetime
 import json
+import time
 
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, render_template
 
+import Assets
+import BulkImport
+import Metrics
+import Phone
+from ContactIndex import ContactIndex
+from Campaign import Campaign
 from Holidays import Holidays
-from MessageSender import MessageSender
+from Message import Message
+from MessageSender import LISTING_ORDERS, SEND_FROM_WORKERS, MessageSender
 
 app = Flask(__name__)
 
 
+# Assets are named after their contents, so a browser can keep them until the name changes
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# The number of messages on each page of the message table
+PAGE_SIZE = 50
+# The most delivery records /history returns at once
+HISTORY_LIMIT = 1000
+
+# Seconds between keep-alive comments on an idle /events stream, so proxies don't close it
+EVENTS_KEEPALIVE = 15
+# Seconds before an /events stream is closed for the browser to reconnect, so no stream holds up a shutdown
+EVENTS_STREAM_SECONDS = 60
+
+
+# The types of the sort value of a message table cursor in each listing order
+CURSOR_SORT_TYPES = {"date": (int, float), "recipient": str, "message": str}
+
+
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(cursor, order="date"):
+    """
+    Returns a cursor made by encode_cursor as the (sort value, kind, id) key that MessageSender.list_messages takes.
+    :param order: The listing order the cursor is for, which the type of its sort value depends on.
+    :raises ValueError: If the cursor wasn't made by encode_cursor for that order.
+    """
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, TypeError, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+    # Anything else would fail to compare with the listing's keys
+    if not (isinstance(key, list) and len(key) == 3 and isinstance(key[0], CURSOR_SORT_TYPES[order])
+            and not isinstance(key[0], bool) and key[1] in (0, 1) and type(key[2]) is int):
+        raise ValueError("Invalid cursor")
+    return tuple(key)
+
+
+def parse_limit(value, maximum):
+    """
+    Returns a limit from the query string, clamped to between 1 and maximum. Zero and negative limits would
+    otherwise return nothing, or everything.
+    :raises ValueError: If it isn't a whole number.
+    """
+    return max(1, min(int(value), maximum))
+
+
+def message_rows(messages):
+    """
+    Returns the rows of the message table for some messages and campaigns, with the names of the recipients who
+    are contacts.
+    """
+    names = contact_index.names(message.recipient for message in messages if not isinstance(message, Campaign))
+    rows = []
+    for message in messages:
+        campaign = isinstance(message, Campaign)
+        start = message.start_datetime()
+        rows.append({
+            "id": message.id,
+            "kind": "campaign" if campaign else "message",
+            "name": "" if campaign else names.get(message.recipient, ""),
+            "recipient": message.describe_recipients() if campaign else message.recipient,
+            "message": message.message,
+            "datetime": message.formatted_datetime,
+            "start_time": int(start.timestamp()) if start is not None else None,
+        })
+    return rows
+
+
+def list_messages(args):
+    """
+    Returns a page of message table rows and the cursor of the next page for the order, direction and cursor
+    given in the query string.
+    :raises ValueError: If any of them are invalid.
+    """
+    order = args.get("sort", "date")
+    if order not in LISTING_ORDERS:
+        raise ValueError(f"sort should be one of {', '.join(LISTING_ORDERS)}")
+    try:
+        limit = parse_limit(args.get("limit", PAGE_SIZE), 500)
+    except ValueError:
+        raise ValueError("limit should be a whole number")
+    messages, cursor = message_sender.list_messages(order, args.get("order") == "desc",
+                                                    decode_cursor(args.get("cursor"), order), limit)
+    return message_rows(messages), encode_cursor(cursor)
+
+
+def encode_event(event):
+    """
+    Returns an event from MessageSender.events in the text/event-stream format, with the table rows of its
+    messages.
+    """
+    data = {"messages": message_rows(event.messages)}
+    if event.error is not None:
+        data["error"] = event.error
+    return f"id: {message_sender.events.id}:{event.seq}\nevent: {event.type}\ndata: {json.dumps(data)}\n\n"
+
+
+def event_seq(last_event_id):
+    """
+    Returns the seq of the last event a browser has seen from its Last-Event-ID, or None if it is from before the
+    server restarted and the browser should start again.
+    """
+    bus_id, _, seq = (last_event_id or "").partition(":")
+    if bus_id != message_sender.events.id or not seq.isdigit():
+        return None
+    return int(seq)
+
+
+def event_text(seq, events):
+    """
+    Returns the text to send on an /events stream for the result of EventBus.wait(), and the seq of the last event
+    in it.
+    """
+    if events is None:
+        # Too far behind, so the browser reloads the table
+        seq = message_sender.events.last_seq
+        return f"id: {message_sender.events.id}:{seq}\nevent: reset\ndata: {{}}\n\n", seq
+    if not events:
+        return ": keep-alive\n\n", seq
+    return "".join(event.encode(encode_event) for event in events), events[-1].seq
+
+
+def events_position():
+    """
+    Returns the Last-Event-ID for a page rendered now, so its /events stream carries on from it.
+    """
+    return f"{message_sender.events.id}:{message_sender.events.last_seq}"
+
+
+@app.context_processor
+def inject_assets():
+    # While developing, rebuild the assets when their sources change
+    Assets.bundle.load(check=app.debug)
+    return {"assets": Assets.bundle}
+
+
+def asset_response(asset, cache_control):
+    """
+    Returns an asset in the smallest encoding the client accepts, or 304 Not Modified if it has it already.
+    """
+    headers = {"Cache-Control": cache_control, "ETag": f'"{asset.etag}"', "Vary": "Accept-Encoding"}
+    if request.if_none_match.contains(asset.etag):
+        return Response(status=304, headers=headers)
+    encoding, body = asset.encoded(lambda name: request.accept_encodings[name])
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(body, mimetype=asset.mimetype, headers=headers)
+
+
+@app.route("/assets/<name>", methods=["GET"])
+def get_asset(name):
+    """
+    The bundled scripts and styles and the country catalog, by the content-hashed names the page links to.
+    """
+    asset = Assets.bundle.get(name)
+    if asset is None or asset.name != name:
+        return "Unknown asset", 404
+    return asset_response(asset, ASSET_CACHE_CONTROL)
+
+
+@app.route("/countries", methods=["GET"])
+def get_countries():
+    """
+    The country names by their ISO 3166 alpha-2 code, as JSON. Clients should revalidate it with its ETag.
+    """
+    return asset_response(Assets.bundle.get("countries.json"), "no-cache")
+
+
 @app.route("/")
 def index():
     print("index")
-    # Get the list of messages from the MessageSender instance
-    messages = message_sender.get_messages()
+    # Changes after this point are sent to the page by /events
+    after = events_position()
+    # Get the first page of messages from the MessageSender instance
+    rows, cursor = list_messages({})
+
+    # Render the HTML template with the page of messages
+    return render_template("index.html", messages=rows, cursor=cursor, events_after=after,
+                           send_window=message_sender.send_window())
+
+
+@app.route("/events", methods=["GET"])
+def get_events():
+    """
+    A text/event-stream of changes to the scheduled messages: "added", "sent", "failed", "missed", "rescheduled"
+    and "removed" events with the table rows of the messages, and "reset" when the table should be reloaded. The
+    stream carries on from the Last-Event-ID header, or the "after" query parameter given to the index page.
+    """
+    seq = event_seq(request.headers.get("Last-Event-ID") or request.args.get("after"))
 
-    # Render the HTML template with the list of messages
-    return render_template("index.html", messages=messages)
+    def stream(seq):
+        deadline = time.monotonic() + EVENTS_STREAM_SECONDS
+        events = None if seq is None else message_sender.events.since(seq)
+        while True:
+            text, seq = event_text(seq, events)
+            yield text
+            if time.monotonic() > deadline:
+                return
+            events = message_sender.events.wait(seq, EVENTS_KEEPALIVE)
+
+    return Response(stream(seq), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/messages", methods=["GET"])
+def get_messages():
+    """
+    Returns a page of scheduled messages as JSON, e.g. /messages?sort=date&order=desc&limit=50. Pass the "cursor"
+    of one page to get the next.
+    """
+    try:
+        rows, cursor = list_messages(request.args)
+    except ValueError as e:
+        return json.dumps({"error": str(e)}), 400
+    return json.dumps({"messages": rows, "cursor": cursor}), 200
 
 
 @app.route("/add", methods=["POST"])
@@ -49,25 +272,137 @@ def add_message():
     else:
         holiday = None
 
-    # Add the message to the MessageSender instance
-    for recipient in recipients:
-        message_sender.add_message(recipient, message, hour, minute, date, repeat, repeat_unit,
-                                   holiday)
+    # Add the messages to the MessageSender instance in one write
+    message_sender.add_messages([Message(recipient, message, hour, minute, date, repeat, repeat_unit, holiday)
+                                 for recipient in recipients])
 
     return "Message added", 201
 
 
-@app.route("/holidays", methods=["GET"])
-def get_holiday_names():
-    country_code = request.args.get("country_code")
+@app.route("/add/bulk", methods=["POST"])
+def add_messages_in_bulk():
+    """
+    Schedule many messages at once from a JSON list or a CSV upload (as a "file" form field or a text/csv body).
+    Each row has the columns in BulkImport.COLUMNS. Valid rows are saved in one transaction and the errors for
+    invalid rows are returned by row number.
+    """
+    try:
+        if "file" in request.files:
+            rows = BulkImport.rows_from_csv(request.files["file"].read().decode("utf-8-sig"))
+        elif request.mimetype == "text/csv":
+            rows = BulkImport.rows_from_csv(request.get_data(as_text=True))
+        else:
+            rows = BulkImport.rows_from_json(request.get_json(force=True))
+    except (ValueError, UnicodeDecodeError) as e:
+        return json.dumps({"added": 0, "errors": [{"row": None, "error": str(e)}]}), 400
+
+    messages, errors = BulkImport.validate_rows(rows)
+    message_sender.add_messages(messages)
+
+    return json.dumps({"added": len(messages), "errors": errors}), 201 if messages else 400
+
+
+@app.route("/campaigns", methods=["POST"])
+def add_campaign():
+    """
+    Schedule one message template for many recipients. The JSON body has a "template" with placeholders such as
+    {first_name}, a "recipients" list and/or a contact "group", and the scheduling fields of a bulk upload row.
+    """
+    try:
+        campaign = BulkImport.validate_campaign(request.get_json(force=True))
+    except ValueError as e:
+        return json.dumps({"error": str(e)}), 400
+
+    message_sender.add_campaign(campaign)
+    return json.dumps({"id": campaign.id}), 201
+
+
+@app.route("/queue", methods=["GET"])
+def get_queue_stats():
+    return json.dumps(message_sender.get_queue_stats()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    The scheduler, transport, storage and holiday metrics in the Prometheus text format.
+    """
+    return Response(Metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/trace", methods=["GET", "POST"])
+def trace():
+    """
+    GET returns the recorded send spans as Chrome trace JSON. POST with enabled=1 starts recording from scratch,
+    and with enabled=0 stops.
+    """
+    if request.method == "POST":
+        Metrics.tracer.enabled = request.values.get("enabled", "1") not in ("0", "false", "")
+        if Metrics.tracer.enabled:
+            Metrics.tracer.clear()
+        return json.dumps({"enabled": Metrics.tracer.enabled}), 200
+    return json.dumps(Metrics.tracer.chrome_trace()), 200, {"Content-Type": "application/json"}
+
+
+def parse_time(value):
+    """
+    Returns an epoch time given as a number or an ISO 8601 date or date and time, or None if there isn't one.
+    :raises ValueError: If it is neither.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+@app.route("/history", methods=["GET"])
+def get_history():
+    """
+    The delivery log: send attempts and their outcomes, and messages that were missed or skipped as already sent,
+    newest first, e.g. /history?recipient=07700900123&since=2024-01-01&event=sent&limit=50. since and until are
+    epoch seconds or ISO 8601 dates and times.
+    """
+    try:
+        since = parse_time(request.args.get("since"))
+        until = parse_time(request.args.get("until"))
+        limit = parse_limit(request.args.get("limit", 100), HISTORY_LIMIT)
+    except ValueError:
+        return "since and until should be dates or epoch seconds, and limit a whole number", 400
+    recipient = request.args.get("recipient")
+    records = message_sender.deliveries.history(Phone.normalise(recipient) if recipient else None, since, until,
+                                                request.args.get("event"), limit)
+    return json.dumps(records), 200, {"Content-Type": "application/json"}
+
+
+@app.route("/contacts/search", methods=["GET"])
+def search_contacts():
+    """
+    Find contacts by part of their name or phone number, e.g. /contacts/search?q=jo&limit=10. At most 50 results
+    are returned.
+    """
+    query = request.args.get("q", "")
+    try:
+        limit = parse_limit(request.args.get("limit", 10), 50)
+    except ValueError:
+        return "limit should be a whole number", 400
+    return json.dumps(contact_index.search(query, limit)), 200
+
+
+def holiday_names(country_code):
+    """
+    Returns the response to a request for the names of a country's holidays this year, as (body, status).
+    """
     year = datetime.datetime.now().year
     holidays = Holidays(country_code, year)
     return json.dumps(holidays.get_holiday_names_list()), 200
 
-@app.route("/holiday_date", methods=["GET"])
-def get_holiday_name():
-    country_code = request.args.get("country_code")
-    holiday_name = request.args.get("holiday")
+
+def holiday_date(country_code, holiday_name):
+    """
+    Returns the response to a request for the next date of a holiday, as (body, status).
+    """
     if country_code is None or holiday_name is None:
         error_message = ["country_code" if country_code is None else "", "holiday" if holiday_name is None else ""]
         return "Missing parameter" + ",".join(error_message), 400
@@ -76,19 +411,38 @@ def get_holiday_name():
     holidays = Holidays(country_code, year)
     print(holiday_name)
     holiday_date = holidays.get_date_of_holiday(holiday_name)
+    if holiday_date is None:
+        return "Unknown holiday", 404
     # Is holiday date in the past?
     if datetime.datetime.strptime(holiday_date, '%Y-%m-%d') < datetime.datetime.now():
         # Get the date of the holiday next year
         holiday_date = holidays.get_date_of_holiday(holiday_name, year + 1)
+        if holiday_date is None:
+            return "Next year's date of the holiday can't be found", 404
     return holiday_date, 200
 
 
+@app.route("/holidays", methods=["GET"])
+def get_holiday_names():
+    return holiday_names(request.args.get("country_code"))
+
+
+@app.route("/holiday_date", methods=["GET"])
+def get_holiday_name():
+    return holiday_date(request.args.get("country_code"), request.args.get("holiday"))
+
+
 if __name__ == "__main__":
     # Create a MessageSender instance
-    message_sender = MessageSender("messages.txt")
+    message_sender = MessageSender("messages.db")
+    # Index the contacts for the recipient search
+    contact_index = ContactIndex()
+    # Build the web UI's bundles now if they are out of date, rather than on the first request
+    Assets.bundle.load()
 
-    message_sender.start()
+    # Leave the due messages to the sender workers if Workers.py is sending them
+    message_sender.start(send=not SEND_FROM_WORKERS)
 
     print("Starting Flask app")
-    # Run the Flask app
+    # Run the Flask development server. See Server.py for serving in production.
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -1,55 +1,42 @@
-// Load the CSV file and store the contacts in an array
-const contacts = [];
-
-$.get('static/contacts.csv', data => {
-    // Split the text into rows
-    const rows = data.split('\n');
-
-    // Extract the headings from the first row
-    const headings = rows[0].split(',');
-
-    // Iterate through the remaining rows
-    for (let i = 1; i < rows.length; i++) {
-        // Split the row into cells
-        const cells = rows[i].split(',');
-
-        // Create an object for the contact
-        const contact = {};
-
-        // Iterate through the cells and add the cell values to the contact object
-        for (let j = 0; j < cells.length; j++) {
-            contact[headings[j]] = cells[j];
+// Contacts are searched on the server, so only the few that match are ever downloaded.
+// The phone numbers of the latest suggestions, keyed by name
+let suggestedPhones = {};
+// The search that is waiting for the user to stop typing
+let searchTimer = null;
+// Ignore results of searches that were overtaken by newer ones
+let latestSearch = 0;
+
+function searchContacts(query, limit, callback) {
+    const search = ++latestSearch;
+    $.getJSON('contacts/search', {q: query, limit: limit}, results => {
+        if (search === latestSearch) {
+            callback(results);
         }
+    });
+}
 
-        // Add the contact object to the contacts array
-        contacts.push(contact);
+function showSuggestions(results) {
+    $('#autocomplete-items').empty();
+    suggestedPhones = {};
+    if (results.length == 0) {
+        $('.recipient-name-label').css('margin-bottom', '10px');
+        return;
     }
-});
-
-$.get('static/groups.csv', data => {
-    // Split the text into rows
-    const rows = data.split('\n');
 
-    // Extract the headings from the first row
-    const headings = rows[0].split(',');
-
-    // Iterate through the remaining rows
-    for (let i = 1; i < rows.length; i++) {
-        // Split the row into cells
-        const cells = rows[i].split(',');
-
-        // Create an object for the contact
-        const contact = {};
-
-        // Iterate through the cells and add the cell values to the contact object
-        for (let j = 0; j < cells.length; j++) {
-            contact[headings[j]] = cells[j];
-        }
+    $('.recipient-name-label').css('margin-bottom', '0');
+    // Add the matching names as suggestions
+    results.forEach(contact => {
+        suggestedPhones[contact.name] = contact.phone;
+        $('#autocomplete-items').append($('<div>').text(contact.name));
+    });
 
-        // Add the contact object to the contacts array
-        contacts.push(contact);
-    }
-});
+    $('.autocomplete-items div').on('click', event => {
+        const name = event.target.innerText;
+        $('#recipient-name').val(name);
+        $('#autocomplete-items').empty();
+        setPhoneNumberInput(name)
+    });
+}
 
 // Add an event listener to the recipient-name input to provide suggestions
 $(document).ready(function() {
@@ -57,68 +44,32 @@ $(document).ready(function() {
         // Get the value of the input
         const value = event.target.value;
 
-        // Clear the existing suggestions
-        $('#autocomplete-items').empty();
-
-        if (value == "") {
+        clearTimeout(searchTimer);
+        if (value.trim() == "") {
+            latestSearch++;
+            $('#autocomplete-items').empty();
             $('.recipient-name-label').css('margin-bottom', '10px');
             return;
         }
-        // Filter the contacts array to get the matching names
-        const matchingContacts = contacts.filter(contact => {
-            const firstName = contact['First name'] || contact['First name'] == "undefined" ? contact['First name'] : '';
-            const lastName = contact['Last name'] || contact['Last name'] == "undefined"  ? contact['Last name'] : '';
-
-            const fullName = `${firstName} ${lastName}`;
-            return fullName.toLowerCase().includes(value.toLowerCase());
-        });
-
-        $('.recipient-name-label').css('margin-bottom', '0');
-        // Add the matching names as suggestions
-        matchingContacts.forEach(contact => {
-            const firstName = contact['First name'] || contact['First name'] == "undefined" ? contact['First name'] : '';
-            const lastName = contact['Last name'] || contact['Last name'] == "undefined"  ? contact['Last name'] : '';
-
-            const fullName = `${firstName} ${lastName}`;
-            $('#autocomplete-items').append(`<div>${fullName}</div>`);
-        });
-
-        $('.autocomplete-items div').on('click', event => {
-            const name = event.target.innerText;
-            $('#recipient-name').val(name);
-            $('#autocomplete-items').empty();
-            setPhoneNumberInput(name)
-        });
-
+        // Wait for a pause in typing before searching
+        searchTimer = setTimeout(() => searchContacts(value, 10, showSuggestions), 100);
     });
 });
 
 
 function setPhoneNumberInput(name) {
-    // Find the contact with the matching name
-    const contact = contacts.find(contact => {
-        const firstName = contact['First name'] ? contact['First name'].toLowerCase() : "";
-        const lastName = contact['Last name'] ? contact['Last name'].toLowerCase() : "";
-        const inputName = name.toLowerCase();
-        return firstName === inputName || lastName === inputName;
-    });
-    console.log(contact)
-
-    // Update the recipient-number input with the phone number of the matching contact
-    if (contact != null) {
-        let phoneNumberHeadings = ['Telephone (mobile)', 'Telephone (home)', 'Telephone (work)', 'Telephone (main)'];
-        let phoneNumber = null;
-        for (let i = 0; i < phoneNumberHeadings.length; i++) {
-
-            if (contact[phoneNumberHeadings[i]] != "") {
-                phoneNumber = contact[phoneNumberHeadings[i]];
-                console.log(phoneNumber)
-                break;
-            }
+    // Use the number of a suggested contact, or look the name up if it was typed in full
+    if (name in suggestedPhones) {
+        if (suggestedPhones[name]) {
+            $('.recipient-number').last().val(suggestedPhones[name]);
         }
-
-        $('.recipient-number').last().val(phoneNumber);
+        return;
     }
+    searchContacts(name, 1, results => {
+        if (results.length > 0 && results[0].name.toLowerCase() === name.toLowerCase() && results[0].phone) {
+            $('.recipient-number').last().val(results[0].phone);
+        }
+    });
 }
 
 // Add an event listener to the recipient-name input to update the recipient-number input when a suggestion is selected
@@ -128,4 +79,4 @@ $(document).ready(function() {
         const name = event.target.value.trim();
         setPhoneNumberInput(name)
     });
-});
\ No newline at end of file
+});
@@ -1,10 +1,29 @@
-$(document).ready(function() {
-    var messageDateTimeElements = document.getElementsByClassName("message-datetime")
-    var messageCountdownElements = document.getElementsByClassName("message-countdown")
+const relativeTime = new Intl.RelativeTimeFormat(undefined, {numeric: 'auto'});
+// The units a countdown is shown in, with the number of seconds in each
+const countdownUnits = [['year', 31536000], ['month', 2592000], ['day', 86400], ['hour', 3600], ['minute', 60]];
 
-    for (var i = 1; i < messageDateTimeElements.length; i++) {
-        var count_down = moment(messageDateTimeElements[i].innerHTML, "DD/MM/YYYY {hh:mm:ss}").fromNow()
-        messageCountdownElements[i].innerHTML = count_down
+// How long until (or since) an epoch time, e.g. "in 3 hours" or "2 days ago"
+function fromNow(startTime) {
+    const seconds = startTime - Date.now() / 1000;
+    for (const [unit, unitSeconds] of countdownUnits) {
+        if (Math.abs(seconds) >= unitSeconds) {
+            return relativeTime.format(Math.round(seconds / unitSeconds), unit);
+        }
     }
+    return relativeTime.format(Math.round(seconds), 'second');
+}
+
+function updateCountdowns() {
+    $('#message-table .message-row').each((index, row) => {
+        var startTime = $(row).data('start-time')
+        if (startTime) {
+            $(row).find('.message-countdown').text(fromNow(startTime))
+        }
+    })
+}
 
-});
\ No newline at end of file
+$(document).ready(function() {
+    updateCountdowns()
+    // The page is no longer reloaded to see changes, so keep the countdowns moving
+    setInterval(updateCountdowns, 30000)
+});
@@ -1,42 +1,16 @@
-// Load the CSV file and store the country data in an object with the country code as the key
-const countryData = {};
-$( document ).ready(function() {
-    $.get('https://raw.githubusercontent.com/lukes/ISO-3166-Countries-with-Regional-Codes/master/all/all.csv', data => {
-      // Split the text into rows
-      const rows = data.split('\n');
-
-      // Extract the headings from the first row
-      const headings = rows[0].match(/(".*?"|[^",\s]+)(?=\s*,|\s*$)/g);
-
-      // Iterate through the remaining rows
-      for (let i = 1; i < rows.length; i++) {
-        // Split the row into cells
-
-        let cells;
-        Papa.parse(rows[i], {
-          delimiter: ',',
-          quoteChar: '"',
-          complete: function(results) {
-            cells = results.data[0];
-          }
+// The country names by their alpha-2 code, from the catalog the server builds
+let countryData = {};
+let countriesLoading = null;
+
+// Load the country catalog the first time it is needed. The browser caches it, so that is only once.
+function loadCountries() {
+    if (countriesLoading === null) {
+        countriesLoading = $.getJSON($('#country-code').data('countries-url'), data => {
+            countryData = data;
         });
-        if(cells == null){
-          continue;
-        }
-
-        // Create an object for the country
-        const country = {};
-
-        // Iterate through the cells and add the cell values to the country object
-        for (let j = 0; j < cells.length; j++) {
-          country[headings[j]] = cells[j];
-        }
-
-        // Add the country object to the countryData object with the country code as the key
-        countryData[country['alpha-2']] = country['name'];
-      }
-    });
-});
+    }
+    return countriesLoading;
+}
 
 // Set up an autocomplete function for the country input field
 function autocomplete(inp) {
@@ -85,7 +59,8 @@ function autocomplete(inp) {
 // Set up the input field to trigger the autocomplete function
 $( document ).ready(function() {
     $('.country').on('input', function() {
-      autocomplete($(this));
+      const input = $(this);
+      loadCountries().done(() => autocomplete(input));
     });
 });
 
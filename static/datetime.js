@@ -26,27 +26,6 @@ $(function() {
         $("#input-date").prop("min", minDate.toISOString().split("T")[0]);
     }
 
-    // Update the minimum time if the date is changed
-    $("#input-date").on("change", function() {
-      // Get the new minimum date and time
-      var newMinDate = new Date(this.value + "T00:00:00");
-      var newMinTime = newMinDate instanceof Date && !isNaN(newMinDate) ? newMinDate.toTimeString().split(" ")[0] : null;
-
-      if(newMinDate > new Date()) {
-        // Remove min attribute if the new minimum date is in the future
-        $("#input-time").removeAttr("min");
-      }else if (newMinTime) {
-        // Set the new minimum time
-        $("#input-time").prop("min", newMinTime);
-
-        // If the current time is before the new minimum, reset the time input to the new minimum
-        var currentTime = new Date();
-        if (currentTime < newMinDate) {
-          $("#input-time").val(newMinTime);
-        }
-      }
-    });
-
     // Update the time input if it's left blank so that the new minimum is above that
     var selectedTime = new Date($("#input-date").val() + "T" + $("#input-time").val());
 
@@ -55,15 +34,30 @@ $(function() {
     }
   }
 
-  // Function to update the script every second
-  function updateEverySecond() {
-    // Make an HTTP GET request to /message_send_buffer to get the number of seconds to add
-    $.get("/message_send_buffer", function(data) {
-      var secondsToAdd = parseInt(data) + 30;
-      updateMinDateTime(secondsToAdd);
-    });
-  }
+  // Update the minimum time if the date is changed
+  $("#input-date").on("change", function() {
+    // Get the new minimum date and time
+    var newMinDate = new Date(this.value + "T00:00:00");
+    var newMinTime = newMinDate instanceof Date && !isNaN(newMinDate) ? newMinDate.toTimeString().split(" ")[0] : null;
+
+    if(newMinDate > new Date()) {
+      // Remove min attribute if the new minimum date is in the future
+      $("#input-time").removeAttr("min");
+    }else if (newMinTime) {
+      // Set the new minimum time
+      $("#input-time").prop("min", newMinTime);
+
+      // If the current time is before the new minimum, reset the time input to the new minimum
+      var currentTime = new Date();
+      if (currentTime < newMinDate) {
+        $("#input-time").val(newMinTime);
+      }
+    }
+  });
+
+  // Messages can't be scheduled sooner than the sender can send them, which the page gives in seconds
+  var sendWindow = parseInt($("#input-date").data("send-window")) || 0;
 
-  // Call the function to update the script every second
-  setInterval(updateEverySecond, 1000);
+  // Keep the minimum date and time up to date
+  setInterval(() => updateMinDateTime(sendWindow + 30), 1000);
 });
@@ -1,71 +1,112 @@
-// Load the CSV file and store the contacts in an object with the phone number as the key
-const contactArr = {};
-$( document ).ready(function() {
-    $.get('static/contacts.csv', data => {
-      // Split the text into rows
-      const rows = data.split('\n');
+// The message table is rendered a page at a time, with names already filled in by the server, and then kept up
+// to date by the /events stream.
+// The order the table is listed in
+let messageSort = {sort: 'date', order: 'asc'};
 
-      // Extract the headings from the first row
-      const headings = rows[0].split(',');
+function messageRow(message) {
+    const row = $('<tr class="message-row">')
+        .attr('data-key', message.kind + '-' + message.id)
+        .attr('data-start-time', message.start_time || '');
+    row.append($('<td class="message-name">').text(message.name));
+    row.append($('<td class="message-recipient">').text(message.recipient));
+    row.append($('<td class="message-text">').text(message.message));
+    row.append($('<td class="message-datetime">').text(message.datetime));
+    row.append($('<td class="message-countdown">'));
+    return row;
+}
 
-      // Iterate through the remaining rows
-      for (let i = 1; i < rows.length; i++) {
-        // Split the row into cells
-        const cells = rows[i].split(',');
+function appendMessageRows(messages) {
+    messages.forEach(message => $('#message-table').append(messageRow(message)));
+    updateCountdowns();
+}
 
-        // Create an object for the contact
-        const contact = {};
-
-        // Iterate through the cells and add the cell values to the contact object
-        for (let j = 0; j < cells.length; j++) {
-          contact[headings[j]] = cells[j];
-        }
-
-        let phoneNumberHeadings = ['Telephone (mobile)', 'Telephone (home)', 'Telephone (work)', 'Telephone (main)'];
-        let contactPhoneNumber = "";
-        for (let i = 0; i < phoneNumberHeadings.length; i++) {
-            if (contact[phoneNumberHeadings[i]] != "" && contact[phoneNumberHeadings[i]] != undefined) {
-                contactPhoneNumber = contact[phoneNumberHeadings[i]];
-                break;
-            }
+function loadMessages(cursor) {
+    const params = Object.assign({}, messageSort);
+    if (cursor) {
+        params.cursor = cursor;
+    }
+    $.getJSON('messages', params, page => {
+        if (!cursor) {
+            $('#message-table .message-row').remove();
         }
-        if(contactPhoneNumber == "" || contactPhoneNumber == undefined) {
-          //console.log("No phone number found for " + contact['First name'] + " " + contact['Last name']);
-          continue;
-        }
-
-        if(contactPhoneNumber.charAt(0) == '0') {
-            contactPhoneNumber = '+44' + contactPhoneNumber.substring(1);
-        }
-
-        // Add the contact object to the contacts object with the phone number as the key
-        contactArr[contactPhoneNumber] = contact;
-      }
+        appendMessageRows(page.messages);
+        $('#more-messages').data('cursor', page.cursor || '').toggle(Boolean(page.cursor));
+    });
+}
 
-        // Iterate through the rows of the table
-        $('tr').each((index, row) => {
-          // Get the phone number from the row
-          var phone = $(row).find('.message-recipient').text().trim();
+function findRow(message) {
+    return $('#message-table .message-row').filter((index, row) => $(row).data('key') == message.kind + '-' + message.id);
+}
 
-          if(phone.charAt(0) == '0') {
-            phone = '+44' + phone.substring(1);
-          }
+// The value a row is sorted by in the current order
+function sortValue(row) {
+    if (messageSort.sort == 'date') {
+        return Number($(row).attr('data-start-time')) || 0;
+    }
+    return $(row).find('.message-' + (messageSort.sort == 'message' ? 'text' : 'recipient')).text();
+}
 
+function insertMessageRow(message) {
+    const row = messageRow(message);
+    const value = sortValue(row);
+    const descending = messageSort.order == 'desc';
+    const next = $('#message-table .message-row').filter((index, other) => {
+        const otherValue = sortValue(other);
+        return descending ? otherValue < value : otherValue > value;
+    }).first();
+    if (next.length) {
+        next.before(row);
+    } else if (!$('#more-messages').data('cursor')) {
+        // Rows after the last one loaded are added by "Show More"
+        $('#message-table').append(row);
+    }
+}
 
-          // Get the contact with the matching phone number
-          const contact = contactArr[phone];
+// Briefly show what happened to a row, then remove it
+function retireRow(row, className, title) {
+    row.addClass(className).attr('title', title || '');
+    setTimeout(() => row.remove(), 3000);
+}
 
-          // If a matching contact was found
-          if (contact) {
-            const firstName = contact['First name'] || contact['First name'] == "undefined" ? contact['First name'] : '';
-            const lastName = contact['Last name'] || contact['Last name'] == "undefined"  ? contact['Last name'] : '';
+function listenForChanges() {
+    const after = $('#message-table').data('events-after');
+    const events = new EventSource('events' + (after ? '?after=' + encodeURIComponent(after) : ''));
+    events.addEventListener('added', event => {
+        JSON.parse(event.data).messages.forEach(insertMessageRow);
+        updateCountdowns();
+    });
+    events.addEventListener('rescheduled', event => {
+        JSON.parse(event.data).messages.forEach(message => {
+            findRow(message).not('.message-sent, .message-failed').remove();
+            insertMessageRow(message);
+        });
+        updateCountdowns();
+    });
+    events.addEventListener('sent', event => {
+        JSON.parse(event.data).messages.forEach(message => retireRow(findRow(message), 'message-sent', 'Sent'));
+    });
+    events.addEventListener('failed', event => {
+        const data = JSON.parse(event.data);
+        data.messages.forEach(message => retireRow(findRow(message), 'message-failed', data.error));
+    });
+    events.addEventListener('missed', event => {
+        JSON.parse(event.data).messages.forEach(message => retireRow(findRow(message), 'message-failed', 'Missed'));
+    });
+    events.addEventListener('removed', event => {
+        JSON.parse(event.data).messages.forEach(message => findRow(message).remove());
+    });
+    events.addEventListener('reset', () => loadMessages(null));
+}
 
-            // Get the full name of the contact
-            const fullName = `${firstName} ${lastName}`;
+$(document).ready(function() {
+    $('#more-messages').on('click', () => loadMessages($('#more-messages').data('cursor')));
 
-            // Update the "Phone" column with the full name of the contact
-            $(row).find('.message-name').text(fullName);
-          }
-        });
+    // Clicking a heading sorts by it, and clicking it again reverses the order
+    $('#message-table th.sortable').on('click', event => {
+        const sort = $(event.target).data('sort');
+        messageSort = {sort: sort, order: messageSort.sort == sort && messageSort.order == 'asc' ? 'desc' : 'asc'};
+        loadMessages(null);
     });
-});
\ No newline at end of file
+
+    listenForChanges();
+});